@@ -67,6 +67,13 @@ def create_app(config_class=None):
     from app.designs import designs_bp
     app.register_blueprint(designs_bp, url_prefix='/designs')
 
+    from app.webhooks import webhooks_bp
+    app.register_blueprint(webhooks_bp, url_prefix='/webhooks')
+
+    # Số liệu Prometheus: độ trễ theo route, số câu SQL mỗi request, endpoint /metrics
+    from app.metrics import init_metrics
+    init_metrics(app)
+
     # Đăng ký các lệnh CLI
     from . import commands
     commands.register_commands(app)
@@ -7,7 +7,8 @@ from urllib.parse import urlparse # <<< THAY ĐỔI DÒNG NÀY
 from . import auth_bp
 from .forms import LoginForm, RegistrationForm, ChangePasswordForm
 from app import db
-from app.models import AppUser, Setting
+from app.models import AppUser
+from app.settings_cache import settings_store
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -51,8 +52,7 @@ def register():
     if current_user.is_authenticated:
         return redirect(url_for('main.dashboard'))
 
-    enable_registration_setting = Setting.query.filter_by(key='ENABLE_USER_REGISTRATION').first()
-    enable_registration = (enable_registration_setting.value.lower() == 'true') if enable_registration_setting else False
+    enable_registration = settings_store.get_bool('ENABLE_USER_REGISTRATION')
 
     if not enable_registration and AppUser.query.filter_by(role='super_admin').first():
         flash('Chức năng đăng ký tài khoản mới hiện đang bị tắt.', 'warning')
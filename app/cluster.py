@@ -0,0 +1,176 @@
+# app/cluster.py
+
+import bisect
+import hashlib
+import os
+import socket
+import threading
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import db
+from .models import NotificationOutbox, WorkerHeartbeat, WebhookEvent
+
+# Khóa advisory (pg_try_advisory_lock) của scheduler leader; hằng số bất kỳ, chỉ cần cố định
+SCHEDULER_LEADER_LOCK_KEY = 727_100_001
+
+
+def local_worker_id() -> str:
+    """Định danh của tiến trình hiện tại trong cụm worker (cũng là chủ lease polling)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _ring_hash(value: str) -> int:
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """Consistent hashing: mỗi worker có `replicas` điểm trên vòng, cửa hàng thuộc về điểm kế tiếp theo chiều kim đồng hồ."""
+    def __init__(self, members, replicas=64):
+        self.members = sorted(set(members))
+        points = sorted((_ring_hash(f"{member}#{i}"), member) for member in members for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._members = [member for _, member in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _ring_hash(f"store:{key}")) % len(self._hashes)
+        return self._members[index]
+
+
+class WorkerMembership:
+    """
+    Thành viên của cụm worker: ghi heartbeat vào bảng `worker_heartbeat`, dựng hash ring từ các worker
+    còn sống để chia cửa hàng, và giành quyền scheduler leader bằng advisory lock của Postgres.
+    Leader làm các việc chỉ nên chạy một nơi (dọn heartbeat chết, dọn webhook và thông báo đã xử lý, gửi Telegram).
+
+    Hash ring chỉ để chia tải, KHÔNG bảo đảm mỗi cửa hàng chỉ một worker polling: mỗi worker dựng ring từ
+    snapshot heartbeat của riêng mình, nên khi cụm thay đổi hai worker có thể cùng nhận một cửa hàng.
+    Tính đúng đắn dựa vào lease polling theo từng cửa hàng (`poll_lease_until`/`poll_lease_owner`,
+    xem worker.get_store_sync_target): worker không giành được lease thì bỏ qua lượt đó. Cửa hàng không worker
+    nào nhận chỉ bị lỡ tới heartbeat kế tiếp, khi các ring hội tụ lại.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.worker_id = local_worker_id()
+        self.heartbeat_seconds = app.config['WORKER_HEARTBEAT_SECONDS']
+        self.ttl_seconds = app.config['WORKER_TTL_SECONDS']
+        self.is_leader = False
+        self._ring = HashRing([])
+        self._leader_connection = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Heartbeat đầu tiên chạy đồng bộ để engine có ring ngay từ tick đầu
+        self._beat()
+        self._thread = threading.Thread(target=self._loop, name="worker-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.heartbeat_seconds + 5)
+        with self.app.app_context():
+            try:
+                db.session.execute(delete(WorkerHeartbeat.__table__).where(WorkerHeartbeat.__table__.c.worker_id == self.worker_id))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Lỗi khi hủy đăng ký worker {self.worker_id}: {e}")
+        self._release_leadership()
+
+    def owns(self, store_id) -> bool:
+        return self._ring.owner(store_id) == self.worker_id
+
+    def _loop(self):
+        while not self._stop_event.wait(self.heartbeat_seconds):
+            self._beat()
+
+    def _beat(self):
+        with self.app.app_context():
+            try:
+                now = datetime.now(timezone.utc)
+                table = WorkerHeartbeat.__table__
+                stmt = pg_insert(table).values(
+                    worker_id=self.worker_id, hostname=socket.gethostname(), pid=os.getpid(),
+                    started_at=now, last_seen_at=now, is_leader=self.is_leader
+                )
+                db.session.execute(stmt.on_conflict_do_update(
+                    index_elements=[table.c.worker_id],
+                    set_={'last_seen_at': now, 'is_leader': self.is_leader}
+                ))
+                alive = db.session.execute(
+                    select(table.c.worker_id).where(table.c.last_seen_at >= now - timedelta(seconds=self.ttl_seconds))
+                ).scalars().all()
+                db.session.commit()
+
+                members = sorted(set(alive) | {self.worker_id})
+                if members != self._ring.members:
+                    print(f"--- Cụm worker thay đổi: {len(members)} worker đang hoạt động ---")
+                self._ring = HashRing(members)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Lỗi khi ghi heartbeat cho worker {self.worker_id}: {e}")
+
+            self._ensure_leadership()
+            if self.is_leader:
+                self._leader_housekeeping()
+
+    def _ensure_leadership(self):
+        """Advisory lock cấp session: giữ trên một kết nối riêng suốt đời tiến trình; mất kết nối là mất quyền leader."""
+        try:
+            if self._leader_connection is None:
+                self._leader_connection = db.engine.connect()
+            if self.is_leader:
+                self._leader_connection.execute(text("SELECT 1"))
+                # Kết nối SQLAlchemy 2 tự mở transaction: commit ngay để session giữ lock không nằm
+                # "idle in transaction" giữa các heartbeat (idle_in_transaction_session_timeout sẽ cắt nó)
+                self._leader_connection.commit()
+                return
+            acquired = self._leader_connection.execute(
+                text("SELECT pg_try_advisory_lock(:key)"), {'key': SCHEDULER_LEADER_LOCK_KEY}
+            ).scalar()
+            self._leader_connection.commit()
+            if acquired:
+                self.is_leader = True
+                print(f"--- Worker {self.worker_id} trở thành scheduler leader ---")
+        except Exception as e:
+            print(f"Mất kết nối giữ quyền leader của worker {self.worker_id}: {e}")
+            self._release_leadership()
+
+    def _release_leadership(self):
+        if self._leader_connection is not None:
+            try:
+                # Hủy hẳn kết nối DBAPI thay vì trả về pool, để lock cấp session chắc chắn được nhả
+                self._leader_connection.invalidate()
+                self._leader_connection.close()
+            except Exception:
+                pass
+        self._leader_connection = None
+        self.is_leader = False
+
+    def _leader_housekeeping(self):
+        try:
+            now = datetime.now(timezone.utc)
+            db.session.execute(
+                delete(WorkerHeartbeat.__table__)
+                .where(WorkerHeartbeat.__table__.c.last_seen_at < now - timedelta(seconds=self.ttl_seconds * 10))
+            )
+            db.session.execute(
+                delete(WebhookEvent.__table__)
+                .where(WebhookEvent.__table__.c.processed_at < now - timedelta(days=self.app.config['WEBHOOK_RETENTION_DAYS']))
+            )
+            outbox = NotificationOutbox.__table__
+            db.session.execute(
+                delete(outbox)
+                .where(outbox.c.status.in_(('sent', 'failed')))
+                .where(outbox.c.created_at < now - timedelta(days=self.app.config['NOTIFICATION_RETENTION_DAYS']))
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Lỗi khi dọn dẹp của scheduler leader: {e}")
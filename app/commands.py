@@ -8,9 +8,15 @@ from alembic.config import Config as AlembicConfig
 import os
 import sqlalchemy as sa
 import json
+import signal
+import threading
+import uuid
+from datetime import datetime, timezone
+import requests
 
 from . import db
-from .models import Setting
+from .models import Setting, WooCommerceStore
+from .services.webhook_signature import sign_webhook_payload
 
 @click.command('seed-db')
 @with_appcontext
@@ -60,6 +66,7 @@ def seed_db_command():
     else:
         click.echo('Cài đặt cho phép đăng ký đã tồn tại, bỏ qua.')
         
+    Setting.bump_version()
     db.session.commit()
     click.echo('Hoàn tất việc thêm/cập nhật dữ liệu mặc định.')
 
@@ -95,7 +102,103 @@ def reset_db_command():
     click.echo('Hoàn tất quy trình "đập đi xây lại"!')
 
 
+def _sample_order_payload(order_id):
+    """Payload mẫu có cấu trúc giống webhook `order.created` của WooCommerce (chỉ các trường worker dùng)."""
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    return {
+        "id": order_id,
+        "status": "processing",
+        "currency": "USD",
+        "total": "29.99",
+        "shipping_total": "5.00",
+        "customer_note": "",
+        "payment_method_title": "Test webhook",
+        "date_created_gmt": now,
+        "date_modified_gmt": now,
+        "billing": {"first_name": "Test", "last_name": "Webhook", "phone": "0900000000", "email": "test@example.com",
+                    "address_1": "1 Test St", "city": "Test City", "country": "US"},
+        "shipping": {"first_name": "Test", "last_name": "Webhook", "address_1": "1 Test St", "city": "Test City", "country": "US"},
+        "line_items": [
+            {"id": order_id * 10 + 1, "name": "Sản phẩm thử", "product_id": 0, "quantity": 1, "sku": "TEST-SKU",
+             "price": 24.99, "meta_data": []}
+        ]
+    }
+
+
+@click.command('send-test-webhook')
+@click.argument('store_id', type=int)
+@click.option('--topic', default='order.created', type=click.Choice(['order.created', 'order.updated']))
+@click.option('--payload-file', type=click.File('rb'), help='File JSON payload đơn hàng; mặc định dùng payload mẫu.')
+@click.option('--order-id', type=int, default=999999, show_default=True, help='Mã đơn của payload mẫu.')
+@click.option('--url', help='Gửi tới server đang chạy (vd: http://localhost:5000); mặc định gọi trực tiếp qua test client.')
+@with_appcontext
+def send_test_webhook_command(store_id, topic, payload_file, order_id, url):
+    """Gửi một webhook đơn hàng đã ký HMAC tới endpoint /webhooks/woocommerce/<store_id>."""
+    store = db.session.get(WooCommerceStore, store_id)
+    if not store or not store.webhook_secret:
+        click.echo(f'Cửa hàng ID {store_id} không tồn tại hoặc chưa đặt Webhook Secret.')
+        return
+
+    body = payload_file.read() if payload_file else json.dumps(_sample_order_payload(order_id)).encode('utf-8')
+    headers = {
+        'Content-Type': 'application/json',
+        'X-WC-Webhook-Topic': topic,
+        'X-WC-Webhook-Delivery-ID': uuid.uuid4().hex,
+        'X-WC-Webhook-Signature': sign_webhook_payload(store.webhook_secret, body),
+    }
+    path = f'/webhooks/woocommerce/{store_id}'
+    if url:
+        response = requests.post(url.rstrip('/') + path, data=body, headers=headers, timeout=10)
+        status_code, text = response.status_code, response.text
+    else:
+        response = current_app.test_client().post(path, data=body, headers=headers)
+        status_code, text = response.status_code, response.get_data(as_text=True)
+    click.echo(f'Phản hồi {status_code}: {text.strip()}')
+
+
+@click.command('run-tasks')
+@click.option('--concurrency', type=int, help='Số tác vụ chạy song song trong tiến trình này (mặc định TASK_WORKER_CONCURRENCY).')
+@with_appcontext
+def run_tasks_command(concurrency):
+    """Chạy tiến trình xử lý hàng đợi tác vụ nền (đồng bộ lịch sử...). Có thể chạy nhiều tiến trình song song."""
+    from .task_queue import TaskRunner
+    from . import worker  # noqa: F401 - đăng ký các handler tác vụ
+
+    runner = TaskRunner(current_app._get_current_object(), concurrency)
+    runner.start()
+    try:
+        runner.wait()
+    except KeyboardInterrupt:
+        click.echo('Đang dừng task runner...')
+        runner.stop()
+
+
+@click.command('run-worker')
+@with_appcontext
+def run_worker_command():
+    """
+    Chạy tiến trình worker: đồng bộ đơn hàng (polling + webhook) cho phần cửa hàng được chia cho tiến trình này
+    và xử lý hàng đợi tác vụ. Chạy nhiều tiến trình (nhiều máy) để mở rộng; một leader được bầu qua advisory lock.
+    """
+    from . import worker
+
+    app = current_app._get_current_object()
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    worker.init_scheduler(app)
+    try:
+        while not stop_event.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    click.echo('Đang dừng worker...')
+    worker.shutdown_scheduler()
+
+
 def register_commands(app):
     """Đăng ký các lệnh CLI với ứng dụng Flask."""
     app.cli.add_command(seed_db_command)
-    app.cli.add_command(reset_db_command)
\ No newline at end of file
+    app.cli.add_command(reset_db_command)
+    app.cli.add_command(send_test_webhook_command)
+    app.cli.add_command(run_tasks_command)
+    app.cli.add_command(run_worker_command)
\ No newline at end of file
@@ -1,5 +1,6 @@
 # app/jobs/routes.py
 
+from datetime import datetime, timezone
 from flask import render_template, jsonify, flash, redirect, url_for
 from flask_login import current_user, login_required
 from . import jobs_bp
@@ -54,7 +55,14 @@ def cancel(job_id):
     if not can_cancel:
         return jsonify({'status': 'error', 'message': 'Bạn không có quyền hủy tác vụ này.'}), 403
 
-    if task.status in ['running', 'queued']:
+    if task.status == 'queued':
+        # Chưa có runner nào nhận: hủy ngay
+        task.requested_cancellation = True
+        task.status = 'cancelled'
+        task.end_time = datetime.now(timezone.utc)
+        db.session.commit()
+        return jsonify({'status': 'success', 'message': 'Đã hủy tác vụ.'})
+    elif task.status == 'running':
         task.requested_cancellation = True
         task.status = 'cancelling'
         db.session.commit()
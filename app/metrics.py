@@ -0,0 +1,178 @@
+# app/metrics.py
+
+import os
+import re
+import time
+from functools import wraps
+
+from flask import Response, abort, current_app, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+    start_http_server,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Khi chạy nhiều tiến trình (gunicorn nhiều worker, `flask run-worker` trên cùng máy), đặt biến môi trường
+# PROMETHEUS_MULTIPROC_DIR trỏ tới một thư mục trống dùng chung TRƯỚC khi khởi động: mỗi tiến trình ghi số liệu
+# vào file riêng trong thư mục đó và /metrics gộp lại. Chỉ dùng Counter/Histogram nên không cần mark_process_dead.
+# Không dùng nhãn theo cửa hàng/người dùng: số chuỗi thời gian phải cố định khi số cửa hàng tăng. Số liệu theo từng
+# cửa hàng nằm trong DB (nhịp đơn, circuit breaker, last_checked) và trong log tổng kết mỗi lượt đồng bộ.
+
+SYNC_DURATION_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+
+SYNC_RUN_DURATION = Histogram(
+    'sync_run_duration_seconds', 'Thời gian một lượt đồng bộ đơn hàng của cửa hàng',
+    ['result'], buckets=SYNC_DURATION_BUCKETS
+)
+ORDERS_SYNCED = Counter(
+    'orders_synced_total', 'Số đơn được ghi vào DB khi đồng bộ',
+    ['source', 'kind']
+)
+WOO_API_REQUESTS = Counter(
+    'woo_api_requests_total', 'Số lời gọi HTTP tới WooCommerce (mỗi lần thử tính một lần)',
+    ['endpoint', 'method', 'status']
+)
+WOO_API_LATENCY = Histogram(
+    'woo_api_request_duration_seconds', 'Độ trễ lời gọi HTTP tới WooCommerce',
+    ['endpoint', 'method'], buckets=LATENCY_BUCKETS
+)
+PRODUCT_LOOKUPS = Counter(
+    'product_lookups_total', 'Số sản phẩm cần ảnh/permalink, theo nguồn trả lời (cache, api, stale, missing)',
+    ['source']
+)
+TELEGRAM_SEND_LATENCY = Histogram(
+    'telegram_send_duration_seconds', 'Độ trễ gửi một tin nhắn Telegram', buckets=LATENCY_BUCKETS
+)
+TELEGRAM_SEND_FAILURES = Counter(
+    'telegram_send_failures_total', 'Số tin nhắn Telegram gửi thất bại', ['reason']
+)
+SCHEDULER_LAG = Histogram(
+    'scheduler_lag_seconds', 'Độ trễ giữa thời điểm dự kiến và thời điểm thực tế một cửa hàng được đồng bộ',
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+)
+HTTP_REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Độ trễ xử lý request của giao diện web',
+    ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+HTTP_REQUEST_SQL_QUERIES = Histogram(
+    'http_request_sql_queries', 'Số câu SQL chạy trong một request của giao diện web',
+    ['endpoint'], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def woo_endpoint_label(endpoint: str) -> str:
+    """`orders/123/notes` -> `orders/:id/notes`, để nhãn Prometheus không phình theo id."""
+    return _ID_SEGMENT.sub('/:id', f"/{endpoint.strip('/')}")[1:]
+
+
+def observe_woo_request(endpoint, method, status, seconds):
+    label = woo_endpoint_label(endpoint)
+    WOO_API_REQUESTS.labels(endpoint=label, method=method, status=str(status)).inc()
+    WOO_API_LATENCY.labels(endpoint=label, method=method).observe(seconds)
+
+
+def observe_sync_run(seconds, error=None):
+    SYNC_RUN_DURATION.labels(result='error' if error is not None else 'ok').observe(seconds)
+
+
+def count_synced_orders(source, new_count, updated_count):
+    if new_count:
+        ORDERS_SYNCED.labels(source=source, kind='new').inc(new_count)
+    if updated_count:
+        ORDERS_SYNCED.labels(source=source, kind='updated').inc(updated_count)
+
+
+# --- Request web: độ trễ theo route và số câu SQL ---
+
+def _start_request_timer():
+    g.metrics_started_at = time.perf_counter()
+    g.metrics_sql_queries = 0
+
+
+def _record_request(response):
+    started_at = g.pop('metrics_started_at', None)
+    if started_at is not None:
+        endpoint = request.endpoint or 'unknown'
+        HTTP_REQUEST_LATENCY.labels(endpoint=endpoint, method=request.method, status=str(response.status_code)).observe(
+            time.perf_counter() - started_at
+        )
+        HTTP_REQUEST_SQL_QUERIES.labels(endpoint=endpoint).observe(g.pop('metrics_sql_queries', 0))
+    return response
+
+
+def _count_sql_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'metrics_sql_queries' in g:
+        g.metrics_sql_queries += 1
+
+
+def query_budget(config_key):
+    """
+    Decorator theo dõi số câu SQL của view (tính cả lúc render template, nơi lazy-load hay lọt vào) so với
+    `app.config[config_key]`. Số câu SQL đã được ghi vào histogram http_request_sql_queries; vượt ngân sách
+    thì chỉ ghi cảnh báo vào log, không làm hỏng request. Test trong tests/ mới là nơi chặn hồi quy.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = view(*args, **kwargs)
+            used = g.get('metrics_sql_queries')
+            limit = current_app.config[config_key]
+            if used is not None and used > limit:
+                current_app.logger.warning(
+                    f"{request.endpoint} chạy {used} câu SQL, vượt ngân sách {limit} ({config_key})"
+                )
+            return response
+        return wrapper
+    return decorator
+
+
+def _metrics_registry():
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_view():
+    """
+    Trả về số liệu theo định dạng text của Prometheus, chỉ khi có header `Authorization: Bearer <METRICS_TOKEN>`.
+    Chưa đặt METRICS_TOKEN thì endpoint bị tắt (404), không bao giờ mở công khai.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        abort(404)
+    if request.headers.get('Authorization') != f"Bearer {token}":
+        abort(401)
+    return Response(generate_latest(_metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app):
+    """Gắn đo độ trễ/số câu SQL cho mọi request và mở endpoint /metrics."""
+    app.before_request(_start_request_timer)
+    app.after_request(_record_request)
+    if not event.contains(Engine, 'before_cursor_execute', _count_sql_query):
+        event.listen(Engine, 'before_cursor_execute', _count_sql_query)
+    app.add_url_rule('/metrics', endpoint='metrics', view_func=metrics_view)
+
+
+_worker_server_started = False
+
+
+def start_worker_metrics_server(app):
+    """
+    `flask run-worker` không phục vụ HTTP: nếu không dùng chung PROMETHEUS_MULTIPROC_DIR với web,
+    đặt METRICS_WORKER_PORT để worker tự mở một endpoint Prometheus riêng. Endpoint này không xác thực nên
+    chỉ lắng nghe trên METRICS_WORKER_BIND (mặc định 127.0.0.1).
+    """
+    global _worker_server_started
+    port = app.config.get('METRICS_WORKER_PORT')
+    if port and not _worker_server_started and not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        bind = app.config['METRICS_WORKER_BIND']
+        start_http_server(port, addr=bind)
+        _worker_server_started = True
+        print(f"--- Worker mở số liệu Prometheus tại {bind}:{port} ---")
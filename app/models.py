@@ -4,6 +4,8 @@ from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timezone
 import json
+from sqlalchemy import Integer, Text, cast
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 class AppUser(UserMixin, db.Model):
     __tablename__ = 'app_user'
@@ -25,6 +27,8 @@ class AppUser(UserMixin, db.Model):
     can_customize_telegram_delay = db.Column(db.Boolean, default=False, nullable=False)
     telegram_template_new_order = db.Column(db.Text, nullable=True)
     telegram_template_user_test = db.Column(db.Text, nullable=True)
+    # Chế độ gộp thông báo đơn mới: None = theo hệ thống, 'on' / 'off' = riêng của người dùng
+    telegram_digest_mode = db.Column(db.String(10), nullable=True)
     stores = db.relationship('WooCommerceStore', backref='owner', lazy='dynamic', cascade="all, delete-orphan")
     children = db.relationship('AppUser', backref=db.backref('parent', remote_side=[id]), lazy='dynamic')
     designs = db.relationship('Design', backref='owner', lazy='dynamic', cascade="all, delete-orphan")
@@ -43,14 +47,58 @@ class WooCommerceStore(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('app_user.id'), nullable=True)
     is_active = db.Column(db.Boolean, default=True, nullable=False)
     last_checked = db.Column(db.DateTime(timezone=True), default=None, nullable=True)
+    # Cùng với last_checked tạo thành con trỏ (date_modified_gmt, id) của đồng bộ tăng dần
+    last_checked_order_id = db.Column(db.Integer, nullable=True)
     note = db.Column(db.Text, nullable=True)
     
-    # === START: THÊM CỘT MỚI ĐỂ GIẢI QUYẾT XUNG ĐỘT WORKER ===
-    is_syncing_history = db.Column(db.Boolean, default=False, nullable=False)
-    # === END: THÊM CỘT MỚI ===
+    # Lease của tác vụ đồng bộ lịch sử (thay cho cờ is_syncing_history): được gia hạn bằng heartbeat,
+    # nên tác vụ chết giữa chừng không chặn polling của cửa hàng mãi mãi
+    history_lease_until = db.Column(db.DateTime(timezone=True), nullable=True)
+    history_lease_job_id = db.Column(db.String(36), nullable=True)
+    # Lease của một lượt polling: chỉ worker giữ lease mới được polling cửa hàng, kể cả khi hash ring
+    # của các worker tạm lệch nhau (worker mới vào/ra cụm). Gia hạn sau mỗi trang, nhả khi kết thúc lượt.
+    poll_lease_until = db.Column(db.DateTime(timezone=True), nullable=True)
+    poll_lease_owner = db.Column(db.String(100), nullable=True)
+
+    # None: chưa biết; False: cửa hàng bỏ qua tham số `_fields` của REST API
+    supports_field_projection = db.Column(db.Boolean, nullable=True)
+    # Timeout (giây) riêng cho API của cửa hàng; None dùng WOO_DEFAULT_TIMEOUT
+    api_timeout_seconds = db.Column(db.Integer, nullable=True)
+
+    # Chu kỳ polling thích ứng: trung bình trượt số đơn mới/cập nhật mỗi giờ và chu kỳ đang áp dụng
+    order_rate_ewma = db.Column(db.Float, nullable=True)
+    order_rate_updated_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    poll_interval_seconds = db.Column(db.Integer, nullable=True)
+    poll_interval_reason = db.Column(db.String(100), nullable=True)
+
+    # Circuit breaker cho API của cửa hàng: closed -> open (tạm dừng, thăm dò thưa) -> half_open (một lượt thử)
+    breaker_state = db.Column(db.String(20), default='closed', server_default='closed', nullable=False)
+    breaker_failures = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    breaker_opened_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    breaker_next_probe_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    breaker_last_error = db.Column(db.String(500), nullable=True)
+
+    # Secret dùng để xác thực chữ ký HMAC của webhook WooCommerce; None = cửa hàng chỉ dùng polling
+    webhook_secret = db.Column(db.String(255), nullable=True)
+    webhook_last_received_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    # Lần gần nhất polling đối soát tìm thấy thay đổi mà webhook đã bỏ sót
+    webhook_missed_at = db.Column(db.DateTime(timezone=True), nullable=True)
     
     orders = db.relationship('WooCommerceOrder', backref='store', lazy='dynamic', cascade="all, delete-orphan")
+    products = db.relationship('ProductCache', backref='store', lazy='dynamic', cascade="all, delete-orphan")
+    webhook_events = db.relationship('WebhookEvent', backref='store', lazy='dynamic', cascade="all, delete-orphan")
+    # Khóa phân trang của danh sách cửa hàng (name, id)
+    __table_args__ = (db.Index('ix_woocommerce_store_name_id', 'name', 'id'),)
     def __repr__(self): return f'<WooCommerceStore {self.name}>'
+    @property
+    def is_syncing_history(self):
+        return bool(self.history_lease_until and self.history_lease_until > datetime.now(timezone.utc))
+    @property
+    def webhook_healthy(self):
+        """Webhook đã từng gửi tới và không bị đối soát phát hiện bỏ sót kể từ lần nhận gần nhất."""
+        if not self.webhook_secret or not self.webhook_last_received_at:
+            return False
+        return self.webhook_missed_at is None or self.webhook_last_received_at > self.webhook_missed_at
 
 class WooCommerceOrder(db.Model):
     __tablename__ = 'woocommerce_order'
@@ -71,8 +119,26 @@ class WooCommerceOrder(db.Model):
     billing_address = db.Column(db.String(500), nullable=True)
     shipping_address = db.Column(db.String(500), nullable=True)
     note = db.Column(db.Text, nullable=True)
+    # SHA-256 trên các trường đã chuẩn hóa (xem worker._order_fingerprint), dùng để bỏ qua đơn không đổi
+    content_hash = db.Column(db.String(64), nullable=True)
+    # Phục vụ ô tìm kiếm (xem services/order_search.py): tên khách, SĐT, email, tên sản phẩm và SKU gộp lại,
+    # và SĐT chỉ còn chữ số. Worker tính khi ghi đơn; cả hai được đánh index GIN pg_trgm.
+    search_document = db.Column(db.Text, nullable=False, default='', server_default='')
+    billing_phone_digits = db.Column(db.String(100), nullable=True)
+    # 'fulfilled' khi đã gửi thành công sang nhà cung cấp fulfillment (chi tiết ở bảng fulfillment_record), NULL nếu chưa
+    fulfillment_status = db.Column(db.String(20), nullable=True)
     line_items = db.relationship('OrderLineItem', backref='order', cascade="all, delete-orphan")
-    __table_args__ = (db.UniqueConstraint('wc_order_id', 'store_id', name='_wc_order_store_uc'),)
+    fulfillment_records = db.relationship('FulfillmentRecord', backref='order', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
+    __table_args__ = (
+        db.UniqueConstraint('wc_order_id', 'store_id', name='_wc_order_store_uc'),
+        db.Index('ix_woocommerce_order_search_trgm', 'search_document', postgresql_using='gin', postgresql_ops={'search_document': 'gin_trgm_ops'}),
+        db.Index('ix_woocommerce_order_phone_digits_trgm', 'billing_phone_digits', postgresql_using='gin', postgresql_ops={'billing_phone_digits': 'gin_trgm_ops'}),
+        db.Index('ix_woocommerce_order_search_tsv', db.text("to_tsvector('simple'::regconfig, search_document)"), postgresql_using='gin'),
+        # Khóa phân trang của danh sách đơn hàng (order_created_at DESC, id DESC)
+        db.Index('ix_woocommerce_order_created_id', 'order_created_at', 'id'),
+        # Bộ lọc "đã/chưa fulfill" của danh sách đơn hàng, cùng thứ tự với khóa phân trang
+        db.Index('ix_woocommerce_order_fulfillment_created', 'fulfillment_status', 'order_created_at', 'id'),
+    )
     def __repr__(self): return f'<WooCommerceOrder ID:{self.wc_order_id} from Store ID:{self.store_id}>'
 
 class OrderLineItem(db.Model):
@@ -93,22 +159,107 @@ class OrderLineItem(db.Model):
         try: return json.loads(self.variations)
         except json.JSONDecodeError: return []
 
+class ProductCache(db.Model):
+    """Bộ nhớ đệm bền vững cho ảnh và permalink sản phẩm WooCommerce, dùng chung cho worker và export."""
+    __tablename__ = 'product_cache'
+    id = db.Column(db.Integer, primary_key=True)
+    store_id = db.Column(db.Integer, db.ForeignKey('woocommerce_store.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    image_url = db.Column(db.String(1000), nullable=True)
+    permalink = db.Column(db.String(1000), nullable=True)
+    product_modified_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    fetched_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True, default=lambda: datetime.now(timezone.utc))
+    __table_args__ = (db.UniqueConstraint('store_id', 'product_id', name='_store_product_uc'),)
+    def __repr__(self): return f'<ProductCache {self.product_id} of Store ID:{self.store_id}>'
+
+class WebhookEvent(db.Model):
+    """Payload webhook đã xác thực, lưu bền vững trước khi trả lời WooCommerce; sync engine sẽ xử lý sau."""
+    __tablename__ = 'webhook_event'
+    id = db.Column(db.Integer, primary_key=True)
+    store_id = db.Column(db.Integer, db.ForeignKey('woocommerce_store.id'), nullable=False, index=True)
+    topic = db.Column(db.String(50), nullable=False)
+    delivery_id = db.Column(db.String(64), nullable=True)
+    payload = db.Column(db.Text, nullable=False)
+    received_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    processed_at = db.Column(db.DateTime(timezone=True), nullable=True, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    __table_args__ = (db.UniqueConstraint('store_id', 'delivery_id', name='_store_delivery_uc'),)
+    def __repr__(self): return f'<WebhookEvent {self.topic} of Store ID:{self.store_id}>'
+
+class NotificationOutbox(db.Model):
+    """
+    Thông báo Telegram chờ gửi, mỗi dòng một (sự kiện, người nhận). Được ghi cùng transaction với đơn hàng;
+    NotificationDispatcher gửi sau đó. `recipient_user_id` rỗng nghĩa là kênh hệ thống.
+    """
+    __tablename__ = 'notification_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    message_type = db.Column(db.String(50), nullable=False)
+    store_id = db.Column(db.Integer, db.ForeignKey('woocommerce_store.id', ondelete='CASCADE'), nullable=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('app_user.id', ondelete='SET NULL'), nullable=True)
+    recipient_user_id = db.Column(db.Integer, db.ForeignKey('app_user.id', ondelete='CASCADE'), nullable=True)
+    chat_id = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    # Người nhận bật chế độ gộp: dispatcher gửi các dòng cùng (chat, cửa hàng) thành một tin digest
+    digest = db.Column(db.Boolean, default=False, nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    sent_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    __table_args__ = (db.Index('ix_notification_outbox_claim', 'status', 'next_attempt_at'),)
+    def __repr__(self): return f'<NotificationOutbox {self.message_type} to {self.chat_id}>'
+
+class WorkerHeartbeat(db.Model):
+    """Mỗi tiến trình `flask run-worker` đang sống có một dòng; dùng để chia cửa hàng bằng consistent hashing."""
+    __tablename__ = 'worker_heartbeat'
+    worker_id = db.Column(db.String(100), primary_key=True)
+    hostname = db.Column(db.String(255), nullable=False)
+    pid = db.Column(db.Integer, nullable=False)
+    started_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    last_seen_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True, default=lambda: datetime.now(timezone.utc))
+    is_leader = db.Column(db.Boolean, default=False, nullable=False)
+    def __repr__(self): return f'<WorkerHeartbeat {self.worker_id}>'
+
 class Setting(db.Model):
     __tablename__ = 'setting'
+    # Dòng đặc biệt: số phiên bản tăng mỗi lần cài đặt đổi, để cache ở các tiến trình khác biết mà đọc lại
+    VERSION_KEY = 'SETTINGS_VERSION'
     key = db.Column(db.String(100), primary_key=True)
     value = db.Column(db.Text, nullable=True)
     @classmethod
     def get_value(cls, key, default=None):
+        """Đọc thẳng từ DB; đường nóng (worker, trang đơn hàng, thông báo) dùng `settings_store` đã cache."""
         setting = cls.query.get(key)
         return setting.value if setting else default
     @classmethod
     def set_value(cls, key, value):
-        setting = cls.query.get(key)
-        if setting: setting.value = str(value)
-        else:
-            setting = cls(key=key, value=str(value))
-            db.session.add(setting)
+        cls.set_values({key: value})
+    @classmethod
+    def set_values(cls, values: dict):
+        """Ghi nhiều cài đặt và tăng phiên bản trong cùng một transaction, rồi bỏ cache của tiến trình này."""
+        for key, value in values.items():
+            setting = cls.query.get(key)
+            if setting: setting.value = str(value)
+            else:
+                setting = cls(key=key, value=str(value))
+                db.session.add(setting)
+        cls.bump_version()
         db.session.commit()
+        from .settings_cache import settings_store
+        settings_store.invalidate()
+    @classmethod
+    def bump_version(cls):
+        """Tăng SETTINGS_VERSION (không commit). Gọi cả khi đổi dữ liệu mà cache dựa vào, ví dụ cài đặt Telegram của người dùng."""
+        table = cls.__table__
+        stmt = pg_insert(table).values(key=cls.VERSION_KEY, value='1')
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={'value': cast(cast(table.c.value, Integer) + 1, Text)}
+        )
+        db.session.execute(stmt)
 
 class BackgroundTask(db.Model):
     __tablename__ = 'background_task'
@@ -124,6 +275,20 @@ class BackgroundTask(db.Model):
     total = db.Column(db.Integer, default=0)
     log = db.Column(db.Text)
     requested_cancellation = db.Column(db.Boolean, default=False)
+    # Cửa hàng của tác vụ đồng bộ lịch sử, checkpoint (JSON) để chạy tiếp và heartbeat gần nhất
+    store_id = db.Column(db.Integer, db.ForeignKey('woocommerce_store.id', ondelete='SET NULL'), nullable=True, index=True)
+    checkpoint = db.Column(db.Text, nullable=True)
+    heartbeat_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    # Hàng đợi tác vụ (xem app/task_queue.py)
+    task_type = db.Column(db.String(50), nullable=True, index=True)
+    payload = db.Column(db.Text, nullable=True)
+    priority = db.Column(db.Integer, default=0, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    max_attempts = db.Column(db.Integer, default=3, nullable=False)
+    run_after = db.Column(db.DateTime(timezone=True), nullable=True)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_until = db.Column(db.DateTime(timezone=True), nullable=True)
+    __table_args__ = (db.Index('ix_background_task_claim', 'status', 'priority', 'id'),)
     def __repr__(self): return f'<Task {self.name} {self.id}>'
 
 class Design(db.Model):
@@ -142,4 +307,18 @@ class FulfillmentSetting(db.Model):
     api_key = db.Column(db.String(255), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('app_user.id'), nullable=False)
     __table_args__ = (db.UniqueConstraint('user_id', 'provider_name', name='_user_provider_uc'),)
-    def __repr__(self): return f'<FulfillmentSetting for User ID {self.user_id} - {self.provider_name}>'
\ No newline at end of file
+    def __repr__(self): return f'<FulfillmentSetting for User ID {self.user_id} - {self.provider_name}>'
+
+class FulfillmentRecord(db.Model):
+    """Mỗi lần gửi một đơn sang nhà cung cấp fulfillment: thành công ('submitted') hoặc lỗi ('failed')."""
+    __tablename__ = 'fulfillment_record'
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('woocommerce_order.id', ondelete='CASCADE'), nullable=False, index=True)
+    provider = db.Column(db.String(50), nullable=False)
+    provider_order_id = db.Column(db.String(100), nullable=True)
+    status = db.Column(db.String(20), nullable=False)
+    message = db.Column(db.Text, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('app_user.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    def __repr__(self): return f'<FulfillmentRecord {self.provider} {self.status} for Order ID:{self.order_id}>'
\ No newline at end of file
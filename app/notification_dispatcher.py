@@ -0,0 +1,309 @@
+# app/notification_dispatcher.py
+
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+
+import httpx
+from sqlalchemy import and_, func, or_, select, tuple_, update
+
+from app import db
+from .metrics import TELEGRAM_SEND_FAILURES, TELEGRAM_SEND_LATENCY
+from .models import NotificationOutbox
+from .notifications import get_recipient_plan, render_digest, render_notification
+from .services.request_governor import RequestGovernor, parse_retry_after
+from .settings_cache import settings_store
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+# Thông báo đã nhận nhưng tiến trình chết giữa chừng sẽ được nhận lại sau khoảng này
+CLAIM_LEASE_SECONDS = 300
+# Telegram giới hạn 4096 ký tự mỗi tin; chừa chỗ cho phần thoát MarkdownV2
+TELEGRAM_MESSAGE_LIMIT = 4000
+# Mỗi lô nhận tối đa limit * hệ số này dòng digest (chúng chỉ thành vài tin)
+DIGEST_CLAIM_FACTOR = 10
+
+
+def _claim_rows(table, condition, now, limit):
+    claimable = (
+        select(table.c.id)
+        .where(table.c.status == 'pending', or_(table.c.next_attempt_at.is_(None), table.c.next_attempt_at <= now), condition)
+        .order_by(table.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return db.session.execute(
+        update(table)
+        .where(table.c.id.in_(claimable.scalar_subquery()))
+        .values(attempts=table.c.attempts + 1, next_attempt_at=now + timedelta(seconds=CLAIM_LEASE_SECONDS))
+        .returning(
+            table.c.id, table.c.message_type, table.c.store_id, table.c.user_id, table.c.recipient_user_id, table.c.chat_id,
+            table.c.digest, table.c.payload, table.c.attempts
+        )
+    ).all()
+
+
+def _ready_digest_groups(table, now, window_seconds, threshold):
+    """
+    Các cặp (chat, cửa hàng) đến lượt gửi digest: đơn cũ nhất đã chờ hết cửa sổ, hoặc đã gom đủ `threshold` đơn
+    và cặp đó chưa nhận digest nào trong cửa sổ vừa qua. Nhờ vậy số tin gửi đi tăng theo thời gian, không theo số đơn.
+    """
+    window_start = now - timedelta(seconds=window_seconds)
+    sent = table.alias('sent_digest')
+    last_sent_at = (
+        select(func.max(sent.c.sent_at))
+        .where(sent.c.chat_id == table.c.chat_id, sent.c.store_id == table.c.store_id)
+        .where(sent.c.digest.is_(True), sent.c.status == 'sent')
+        .scalar_subquery()
+    )
+    return (
+        select(table.c.chat_id, table.c.store_id)
+        .where(table.c.status == 'pending', table.c.digest.is_(True))
+        .where(or_(table.c.next_attempt_at.is_(None), table.c.next_attempt_at <= now))
+        .group_by(table.c.chat_id, table.c.store_id)
+        .having(or_(
+            func.min(table.c.created_at) <= window_start,
+            and_(func.count() >= threshold, func.coalesce(last_sent_at, window_start) <= window_start),
+        ))
+    )
+
+
+def _digest_messages(template, items, username):
+    """
+    items: [(row, data)] của một (chat, cửa hàng) -> [(rows, text)]. Phần nào render vượt giới hạn độ dài của
+    Telegram được tách đôi cho tới khi vừa.
+    """
+    chunks = [items]
+    while True:
+        texts = [
+            render_digest(template, [data for _, data in chunk], username, index + 1, len(chunks), len(items))
+            for index, chunk in enumerate(chunks)
+        ]
+        too_long = next(
+            (index for index, (chunk, text) in enumerate(zip(chunks, texts)) if len(text) > TELEGRAM_MESSAGE_LIMIT and len(chunk) > 1),
+            None
+        )
+        if too_long is None:
+            return [([row for row, _ in chunk], text) for chunk, text in zip(chunks, texts)]
+        chunk = chunks[too_long]
+        chunks[too_long:too_long + 1] = [chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]]
+
+
+def _row_results(rows, outcome, **extra):
+    return [{'id': row.id, 'attempts': row.attempts, 'outcome': outcome, **extra} for row in rows]
+
+
+def claim_notifications(app, limit):
+    """
+    Nhận một lô thông báo đến hạn bằng SKIP LOCKED rồi dựng nội dung gửi (token, chat, delay, văn bản đã render).
+    Dòng thường được gửi từng tin; dòng `digest` chỉ được nhận khi cả nhóm (chat, cửa hàng) đến lượt và được gộp
+    thành một hoặc vài tin theo template digest (nhóm chỉ có một đơn thì dùng template đơn mới bình thường).
+    Token/template lấy từ kế hoạch gửi đã cache (get_recipient_plan) nên thay đổi cài đặt Telegram áp dụng cả cho
+    tin đang chờ, và việc render không cần đọc DB.
+    Trả về (deliveries, results) với `results` là các dòng không thể gửi (người nhận đã tắt Telegram, template lỗi).
+    """
+    with app.app_context():
+        now = datetime.now(timezone.utc)
+        table = NotificationOutbox.__table__
+        window_seconds = settings_store.get_int('TELEGRAM_DIGEST_WINDOW_SECONDS') or app.config['DEFAULT_TELEGRAM_DIGEST_WINDOW_SECONDS']
+        threshold = settings_store.get_int('TELEGRAM_DIGEST_THRESHOLD') or app.config['DEFAULT_TELEGRAM_DIGEST_THRESHOLD']
+
+        claimed = _claim_rows(table, table.c.digest.is_(False), now, limit)
+        ready_groups = _ready_digest_groups(table, now, window_seconds, threshold)
+        claimed += _claim_rows(
+            table,
+            and_(table.c.digest.is_(True), tuple_(table.c.chat_id, table.c.store_id).in_(ready_groups)),
+            now, limit * DIGEST_CLAIM_FACTOR
+        )
+        db.session.commit()
+        if not claimed:
+            return [], []
+
+        # Dòng thường: mỗi dòng một nhóm; dòng digest: gom theo (chat, cửa hàng)
+        groups = defaultdict(list)
+        for row in sorted(claimed, key=lambda row: row.id):
+            groups[('digest', row.chat_id, row.store_id) if row.digest else ('single', row.id)].append(row)
+
+        deliveries, results = [], []
+        for rows in groups.values():
+            first = rows[0]
+            plan = get_recipient_plan(app, first.user_id, first.message_type) if first.user_id else ()
+            entry = next((entry for entry in plan if entry.recipient_user_id == first.recipient_user_id), None)
+            if not entry:
+                results.extend(_row_results(rows, 'failed', error="Người nhận đã tắt hoặc chưa cấu hình Telegram."))
+                continue
+            try:
+                items = [(row, json.loads(row.payload)) for row in rows]
+                username = items[0][1].get('username', '')
+                if len(items) == 1 or not entry.digest_template:
+                    messages = [([row], render_notification(entry.template, data, username)) for row, data in items]
+                else:
+                    messages = _digest_messages(entry.digest_template, items, username)
+            except Exception as e:
+                results.extend(_row_results(rows, 'failed', error=f"Lỗi render template: {e}"))
+                continue
+            for message_rows, text in messages:
+                deliveries.append({'rows': message_rows, 'token': entry.token, 'chat_id': entry.chat_id, 'delay': entry.delay, 'text': text})
+        return deliveries, results
+
+
+def finish_notifications(app, results):
+    """
+    Ghi kết quả gửi: 'sent'; 'failed' (lỗi vĩnh viễn); 'retry' (backoff lũy thừa tới NOTIFICATION_MAX_ATTEMPTS);
+    'deferred' (bị giới hạn tốc độ hoặc chưa tới lượt chat, không tính là một lần thử).
+    """
+    with app.app_context():
+        now = datetime.now(timezone.utc)
+        table = NotificationOutbox.__table__
+        max_attempts = app.config['NOTIFICATION_MAX_ATTEMPTS']
+        base_seconds = app.config['NOTIFICATION_RETRY_BASE_SECONDS']
+
+        sent_ids = [result['id'] for result in results if result['outcome'] == 'sent']
+        if sent_ids:
+            db.session.execute(
+                update(table).where(table.c.id.in_(sent_ids)).values(status='sent', sent_at=now, next_attempt_at=None, last_error=None)
+            )
+        for result in results:
+            outcome = result['outcome']
+            if outcome == 'sent':
+                continue
+            error = str(result.get('error') or '')[:1000]
+            if outcome == 'deferred':
+                values = {'attempts': table.c.attempts - 1, 'next_attempt_at': now + timedelta(seconds=result['retry_after'])}
+            elif outcome == 'retry' and result['attempts'] < max_attempts:
+                delay = result.get('retry_after') or base_seconds * 2 ** (result['attempts'] - 1) * random.uniform(0.8, 1.2)
+                values = {'next_attempt_at': now + timedelta(seconds=delay), 'last_error': error}
+            else:
+                values = {'status': 'failed', 'next_attempt_at': None, 'last_error': error}
+            db.session.execute(update(table).where(table.c.id == result['id']).values(**values))
+        db.session.commit()
+
+
+class NotificationDispatcher:
+    """
+    Gửi thông báo trong `notification_outbox` trên một event loop asyncio riêng với một `httpx.AsyncClient` dùng chung.
+    Các chat khác nhau được gửi đồng thời; mỗi bot bị giới hạn bởi token bucket toàn cục
+    (TELEGRAM_GLOBAL_RATE_PER_SECOND), mỗi chat cách nhau ít nhất max(TELEGRAM_CHAT_MIN_INTERVAL_SECONDS, delay
+    của người nhận). 429 từ Telegram đẩy lùi cả chat theo `retry_after`.
+    Khi chạy nhiều worker chỉ scheduler leader gửi, để giới hạn tốc độ được tính ở một nơi.
+    """
+    def __init__(self, app, membership=None):
+        self.app = app
+        self.membership = membership
+        self.batch_size = app.config['NOTIFICATION_BATCH_SIZE']
+        self.poll_seconds = app.config['NOTIFICATION_POLL_SECONDS']
+        self.chat_min_interval = app.config['TELEGRAM_CHAT_MIN_INTERVAL_SECONDS']
+        # Chat phải chờ lâu hơn mức này thì tin còn lại được hoãn về outbox thay vì giữ cả lô
+        self.max_chat_wait = app.config['TELEGRAM_MAX_CHAT_WAIT_SECONDS']
+        self.limiter = RequestGovernor(
+            app.config['TELEGRAM_GLOBAL_RATE_PER_SECOND'], app.config['TELEGRAM_GLOBAL_BURST'], 0, 1, 300
+        )
+
+        self._thread = None
+        self._loop = None
+        self._stop_event = None
+        self._chat_ready_at = {}
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run_forever, name="notification-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._loop and self._stop_event:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def _run_forever(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        async with httpx.AsyncClient(timeout=10) as http_client:
+            self.http_client = http_client
+            print("--- Notification dispatcher đã khởi động ---")
+            while not self._stop_event.is_set():
+                handled = 0
+                if self.membership is None or self.membership.is_leader:
+                    try:
+                        handled = await self._dispatch_batch()
+                    except Exception as e:
+                        print(f"LỖI trong notification dispatcher: {e}")
+                if handled:
+                    continue
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        print("--- Notification dispatcher đã dừng ---")
+
+    async def _dispatch_batch(self):
+        deliveries, results = await asyncio.to_thread(claim_notifications, self.app, self.batch_size)
+        by_chat = defaultdict(list)
+        for delivery in deliveries:
+            by_chat[(delivery['token'], delivery['chat_id'])].append(delivery)
+
+        for chat_results in await asyncio.gather(*(self._send_chat(items) for items in by_chat.values())):
+            results.extend(chat_results)
+        if results:
+            await asyncio.to_thread(finish_notifications, self.app, results)
+        return len(deliveries) + len(results)
+
+    async def _send_chat(self, items):
+        """Gửi lần lượt các tin của một chat, giữ khoảng cách giữa hai tin; các chat khác chạy song song."""
+        results = []
+        for index, item in enumerate(items):
+            chat_key = (item['token'], item['chat_id'])
+            wait = self._chat_ready_at.get(chat_key, 0) - time.monotonic()
+            if wait > self.max_chat_wait:
+                for rest in items[index:]:
+                    results.extend(_row_results(rest['rows'], 'deferred', retry_after=wait))
+                break
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await asyncio.sleep(self.limiter.reserve(item['token']))
+
+            result = await self._send_one(item)
+            results.extend(_row_results(item['rows'], **result))
+            spacing = max(self.chat_min_interval, item['delay'] or 0, result.get('retry_after') or 0)
+            self._chat_ready_at[chat_key] = time.monotonic() + spacing
+        return results
+
+    async def _send_one(self, item):
+        """Gửi một tin (có thể là digest của nhiều dòng). Trả về {'outcome', 'error', 'retry_after'}."""
+        url = f"{TELEGRAM_API_URL}/bot{item['token']}/sendMessage"
+        payload = {'chat_id': item['chat_id'], 'text': item['text'], 'parse_mode': 'MarkdownV2'}
+        started_at = time.perf_counter()
+        try:
+            response = await self.http_client.post(url, json=payload)
+        except httpx.HTTPError as e:
+            TELEGRAM_SEND_FAILURES.labels(reason='network').inc()
+            return {'outcome': 'retry', 'error': f"Lỗi kết nối Telegram: {e}"}
+        finally:
+            TELEGRAM_SEND_LATENCY.observe(time.perf_counter() - started_at)
+
+        if response.status_code < 400:
+            return {'outcome': 'sent'}
+
+        TELEGRAM_SEND_FAILURES.labels(reason=str(response.status_code)).inc()
+        error = f"Lỗi từ API Telegram ({response.status_code}): {response.text}"
+        print(f"{error} cho chat_id {item['chat_id']}")
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get('parameters', {}).get('retry_after')
+            except ValueError:
+                retry_after = None
+            if retry_after is None:
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            return {'outcome': 'deferred', 'error': error, 'retry_after': float(retry_after or self.chat_min_interval)}
+        if response.status_code >= 500:
+            return {'outcome': 'retry', 'error': error}
+        # 400/403...: chat sai, bot bị chặn, MarkdownV2 hỏng — thử lại cũng vô ích
+        return {'outcome': 'failed', 'error': error}
@@ -1,11 +1,20 @@
 # app/notifications.py
 
 import asyncio
+import hashlib
 import httpx
 from jinja2 import Environment, TemplateError
+import json
 import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
 
-from .models import AppUser, Setting, db
+from sqlalchemy import insert
+
+from .metrics import TELEGRAM_SEND_FAILURES, TELEGRAM_SEND_LATENCY
+from .models import AppUser, NotificationOutbox, db
+from .settings_cache import settings_store
 
 def escape_markdown_v2(text: str) -> str:
     """Hàm thoát các ký tự đặc biệt cho định dạng MarkdownV2 của Telegram."""
@@ -60,16 +69,204 @@ async def send_test_telegram_message(bot_token: str, chat_id: str, template_cont
     except Exception as e:
         return False, f"Lỗi khi kết nối đến Telegram: {e}"
 
+def system_recipient(system_settings: dict):
+    """Người nhận ảo cho kênh hệ thống (không có id), hoặc None nếu chưa cấu hình bot/chat hệ thống."""
+    system_bot_token = system_settings.get('TELEGRAM_BOT_TOKEN')
+    system_chat_id = system_settings.get('TELEGRAM_CHAT_ID')
+    if not (system_bot_token and system_chat_id):
+        return None
+    system_user = AppUser(username="System", telegram_bot_token=system_bot_token, telegram_chat_id=system_chat_id, telegram_enabled=True)
+    system_user.can_customize_telegram_delay = False # Hệ thống dùng delay mặc định
+    system_user.can_customize_telegram_templates = False # Hệ thống dùng template mặc định
+    return system_user
+
+def new_order_recipients(event_user, system_settings: dict) -> list:
+    """
+    Những ai nhận thông báo đơn mới của `event_user`: chính người dùng, admin quản lý (nếu có)
+    và kênh hệ thống (một AppUser ảo, không có id) nếu đã cấu hình.
+    """
+    recipients = [event_user]
+    if event_user.parent and event_user.parent.is_admin():
+        recipients.append(event_user.parent)
+    system_user = system_recipient(system_settings)
+    if system_user:
+        recipients.append(system_user)
+    return recipients
+
+def resolve_recipient(app, user, system_settings: dict, message_type: str):
+    """Trả về (token, chat_id, delay, template_content) cho một người nhận, hoặc None nếu chưa bật/cấu hình Telegram."""
+    if not (user.telegram_enabled and user.telegram_chat_id):
+        return None
+    token_to_use = user.telegram_bot_token or system_settings.get('TELEGRAM_BOT_TOKEN')
+    if not token_to_use:
+        return None
+
+    delay = user.telegram_send_delay_seconds if user.can_customize_telegram_delay and user.telegram_send_delay_seconds is not None else int(system_settings.get('TELEGRAM_SEND_DELAY_SECONDS', 2))
+
+    template_content = None
+    if user.can_customize_telegram_templates:
+        template_content = getattr(user, f'telegram_template_{message_type}', None)
+    if not template_content:
+        template_content = system_settings.get(f'DEFAULT_TELEGRAM_TEMPLATE_{message_type.upper()}')
+    if not template_content:
+        template_content = app.config.get(f'DEFAULT_TELEGRAM_TEMPLATE_{message_type.upper()}')
+    if not template_content:
+        return None
+    return token_to_use, user.telegram_chat_id, delay, template_content
+
+def render_notification(template, data: dict, username: str) -> str:
+    """Thoát MarkdownV2 cho dữ liệu (trừ `product_list` đã được thoát sẵn) rồi render template đã biên dịch."""
+    render_data = {}
+    for key, value in data.items():
+        render_data[key] = escape_markdown_v2(value) if key != 'product_list' else value
+    render_data.setdefault('username', escape_markdown_v2(username))
+    render_data.setdefault('bot_username', escape_markdown_v2('BotHeThong'))
+    return template.render(render_data)
+
+def render_digest(template, orders_data: list, username: str, chunk_index=1, chunk_count=1, order_count=None) -> str:
+    """Render tin gộp nhiều đơn: mỗi đơn là một dict đã thoát MarkdownV2 trong biến `orders`."""
+    orders = [
+        {key: escape_markdown_v2(value) if key != 'product_list' else value for key, value in data.items()}
+        for data in orders_data
+    ]
+    return template.render(
+        store_name=orders[0]['store_name'] if orders else '',
+        orders=orders,
+        order_count=order_count or len(orders),
+        chunk_index=chunk_index,
+        chunk_count=chunk_count,
+        username=escape_markdown_v2(username),
+    )
+
+def digest_enabled(user, system_settings: dict) -> bool:
+    """Chế độ gộp của người nhận: 'on'/'off' riêng của người dùng, mặc định theo cài đặt hệ thống TELEGRAM_DIGEST_ENABLED."""
+    mode = getattr(user, 'telegram_digest_mode', None)
+    if mode in ('on', 'off'):
+        return mode == 'on'
+    return (system_settings.get('TELEGRAM_DIGEST_ENABLED') or 'False').lower() == 'true'
+
+# --- Cache trong tiến trình: template đã biên dịch và kế hoạch gửi theo người dùng sở hữu sự kiện ---
+
+TEMPLATE_CACHE_SIZE = 128
+
+# Một người nhận đã được giải quyết xong: không cần đọc DB hay biên dịch template khi render
+RecipientPlan = namedtuple('RecipientPlan', 'recipient_user_id owner_username token chat_id delay digest template digest_template')
+
+_jinja_env = Environment()
+_template_cache = OrderedDict()
+_plan_cache = {}
+_plan_generation = 0
+_cache_lock = threading.Lock()
+
+def compile_template(template_content: str):
+    """Template Jinja đã biên dịch, giữ trong LRU theo SHA-256 của nội dung. Lỗi cú pháp ném TemplateError."""
+    key = hashlib.sha256(template_content.encode('utf-8')).hexdigest()
+    with _cache_lock:
+        template = _template_cache.get(key)
+        if template is not None:
+            _template_cache.move_to_end(key)
+            return template
+    template = _jinja_env.from_string(template_content)
+    with _cache_lock:
+        _template_cache[key] = template
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+    return template
+
+def _build_recipient_plan(app, user_id: int, message_type: str) -> tuple:
+    event_user = db.session.get(AppUser, user_id)
+    if not event_user:
+        return ()
+    system_settings = settings_store.snapshot()
+
+    plan, seen_chats = [], set()
+    for user in new_order_recipients(event_user, system_settings):
+        resolved = resolve_recipient(app, user, system_settings, message_type)
+        # Người nhận trùng chat_id chỉ nhận một lần
+        if not resolved or resolved[1] in seen_chats:
+            continue
+        token, chat_id, delay, template_content = resolved
+        try:
+            template = compile_template(template_content)
+            digest_template = None
+            if message_type == 'new_order':
+                digest_resolved = resolve_recipient(app, user, system_settings, 'new_order_digest')
+                digest_template = compile_template(digest_resolved[3]) if digest_resolved else None
+        except TemplateError as e:
+            print(f"LỖI cú pháp template Telegram của '{user.username}', bỏ qua người nhận này: {e}")
+            continue
+        seen_chats.add(chat_id)
+        plan.append(RecipientPlan(
+            user.id, event_user.username, token, chat_id, delay,
+            bool(digest_template) and digest_enabled(user, system_settings), template, digest_template
+        ))
+    return tuple(plan)
+
+def get_recipient_plan(app, user_id: int, message_type: str) -> tuple:
+    """
+    Kế hoạch gửi (token, chat, delay, template đã biên dịch) cho mọi người nhận sự kiện của `user_id`:
+    chủ sở hữu, admin quản lý và kênh hệ thống. Được giữ trong tiến trình tới khi `invalidate_recipient_plans`
+    được gọi ở tiến trình này, khi phiên bản cài đặt (SETTINGS_VERSION) đổi ở bất kỳ tiến trình nào,
+    hoặc tối đa RECIPIENT_PLAN_TTL_SECONDS.
+    """
+    key = (user_id, message_type)
+    now = time.monotonic()
+    version = settings_store.version
+    with _cache_lock:
+        cached = _plan_cache.get(key)
+        generation = _plan_generation
+    if cached and cached[0] > now and cached[1] == version:
+        return cached[2]
+
+    plan = _build_recipient_plan(app, user_id, message_type)
+    with _cache_lock:
+        # Bị invalidate trong lúc đang dựng thì không lưu bản có thể đã cũ
+        if generation == _plan_generation:
+            _plan_cache[key] = (now + app.config['RECIPIENT_PLAN_TTL_SECONDS'], version, plan)
+    return plan
+
+def invalidate_recipient_plans():
+    """
+    Gọi sau khi lưu cài đặt Telegram (cá nhân, hệ thống, template) hoặc đổi quan hệ/quyền của người dùng.
+    Kế hoạch của một người phụ thuộc cả admin quản lý và kênh hệ thống nên xóa toàn bộ.
+    """
+    global _plan_generation
+    with _cache_lock:
+        _plan_cache.clear()
+        _plan_generation += 1
+
+def enqueue_notifications(app, message_type: str, user_id: int, store_id: int, data_list: list) -> int:
+    """
+    Ghi vào `notification_outbox` một dòng cho mỗi (dữ liệu, người nhận trong kế hoạch gửi). Không commit: người gọi
+    ghi cùng transaction với đơn hàng, nên đơn đã lưu thì chắc chắn có thông báo và ngược lại.
+    Dòng của người nhận bật chế độ gộp được đánh dấu `digest` để dispatcher gom theo (chat, cửa hàng).
+    Trả về số dòng đã thêm.
+    """
+    plan = get_recipient_plan(app, user_id, message_type) if data_list else ()
+    if not plan:
+        return 0
+
+    rows = [
+        {
+            'message_type': message_type, 'store_id': store_id, 'user_id': user_id,
+            'recipient_user_id': entry.recipient_user_id, 'chat_id': entry.chat_id, 'digest': entry.digest,
+            'payload': json.dumps({'username': entry.owner_username, **data}), 'status': 'pending', 'attempts': 0,
+        }
+        for data in data_list
+        for entry in plan
+    ]
+    db.session.execute(insert(NotificationOutbox.__table__), rows)
+    return len(rows)
+
 async def send_telegram_message(app, message_type: str, data: dict, user_id: int):
     """
     Hàm gửi tin nhắn Telegram thông minh.
     MODIFIED: Cải thiện logic xác định người nhận và thêm log chi tiết.
+    Thông báo đơn mới khi đồng bộ không đi qua hàm này mà qua outbox (enqueue_notifications + NotificationDispatcher).
     """
     with app.app_context():
-        system_settings = {s.key: s.value for s in Setting.query.all()}
+        system_settings = settings_store.snapshot()
         system_bot_token = system_settings.get('TELEGRAM_BOT_TOKEN')
-        system_chat_id = system_settings.get('TELEGRAM_CHAT_ID')
-        jinja_env = Environment()
 
         if message_type == 'system_test':
             # ... (Phần này giữ nguyên)
@@ -82,84 +279,44 @@ async def send_telegram_message(app, message_type: str, data: dict, user_id: int
 
         unique_send_tasks = set()
         
-        # --- LOGIC MỚI: Xử lý người nhận cho đơn hàng mới ---
+        # --- Người nhận cho đơn hàng mới: chủ cửa hàng, admin quản lý, kênh hệ thống ---
         if message_type == 'new_order':
-            print(f"--- Bắt đầu xử lý thông báo đơn hàng cho user: '{event_user.username}' ---")
-            potential_recipients = []
-            
-            # 1. Thêm chính người dùng sở hữu cửa hàng
-            potential_recipients.append(event_user)
-            print(f"[+] Đã thêm user '{event_user.username}' vào danh sách nhận tin.")
-
-            # 2. Thêm admin quản lý của người dùng đó (nếu có)
-            if event_user.parent and event_user.parent.is_admin():
-                potential_recipients.append(event_user.parent)
-                print(f"[+] Đã thêm admin quản lý '{event_user.parent.username}' vào danh sách nhận tin.")
-            else:
-                print(f"[-] User '{event_user.username}' không có admin quản lý hoặc người quản lý không phải vai trò 'admin'.")
-
-            # 3. Luôn gửi một bản sao đến kênh hệ thống (nếu được cấu hình)
-            if system_bot_token and system_chat_id:
-                # Tạo một "người nhận ảo" cho hệ thống để xử lý chung
-                system_recipient = AppUser(username="System", telegram_bot_token=system_bot_token, telegram_chat_id=system_chat_id, telegram_enabled=True)
-                system_recipient.can_customize_telegram_delay = False # Hệ thống dùng delay mặc định
-                system_recipient.can_customize_telegram_templates = False # Hệ thống dùng template mặc định
-                potential_recipients.append(system_recipient)
-                print("[+] Đã thêm kênh hệ thống vào danh sách nhận tin.")
-
-            # 4. Lọc danh sách người nhận và tạo tác vụ gửi tin
-            for user in potential_recipients:
-                if user.telegram_enabled and user.telegram_chat_id:
-                    token_to_use = user.telegram_bot_token or system_bot_token
-                    chat_id_to_use = user.telegram_chat_id
-                    
-                    if token_to_use and chat_id_to_use:
-                        delay = user.telegram_send_delay_seconds if user.can_customize_telegram_delay and user.telegram_send_delay_seconds is not None else int(system_settings.get('TELEGRAM_SEND_DELAY_SECONDS', 2))
-                        
-                        template_content = None
-                        if user.can_customize_telegram_templates:
-                            template_content = getattr(user, f'telegram_template_{message_type}', None)
-                        if not template_content:
-                            template_content = system_settings.get(f'DEFAULT_TELEGRAM_TEMPLATE_{message_type.upper()}')
-                        if not template_content:
-                            template_content = app.config.get(f'DEFAULT_TELEGRAM_TEMPLATE_{message_type.upper()}')
-
-                        if template_content:
-                            unique_send_tasks.add((token_to_use, chat_id_to_use, delay, template_content))
-                            print(f"    -> Đã tạo tác vụ gửi tin cho '{user.username}' đến chat_id: {chat_id_to_use}")
-                else:
-                    print(f"    -> Bỏ qua '{user.username}' vì chưa bật hoặc chưa cấu hình Telegram.")
-            print("-----------------------------------------------------------------")
+            for entry in get_recipient_plan(app, user_id, message_type):
+                unique_send_tasks.add((entry.token, entry.chat_id, entry.delay, entry.template))
+                print(f"    -> Đã tạo tác vụ gửi tin đến chat_id: {entry.chat_id}")
         
         # --- Logic cho user test (giữ nguyên) ---
         elif message_type == 'user_test':
             if event_user.telegram_enabled and event_user.telegram_chat_id:
                 token_to_use = event_user.telegram_bot_token or system_bot_token
                 template_content = system_settings.get(f'DEFAULT_TELEGRAM_TEMPLATE_{message_type.upper()}', app.config.get(f'DEFAULT_TELEGRAM_TEMPLATE_{message_type.upper()}'))
-                unique_send_tasks.add((token_to_use, event_user.telegram_chat_id, 0, template_content))
+                try:
+                    unique_send_tasks.add((token_to_use, event_user.telegram_chat_id, 0, compile_template(template_content)))
+                except TemplateError as e:
+                    print(f"LỖI cú pháp template '{message_type}': {e}")
 
         if not unique_send_tasks:
             print(f"Thông báo: Không có tác vụ gửi tin nào được tạo cho sự kiện '{message_type}' của user ID {user_id}.")
             return
 
         # --- Phần gửi tin nhắn (giữ nguyên) ---
-        render_data = {}
-        for key, value in data.items():
-            render_data[key] = escape_markdown_v2(value) if key != 'product_list' else value
-        
-        render_data.setdefault('username', escape_markdown_v2(event_user.username))
-        render_data.setdefault('bot_username', escape_markdown_v2('BotHeThong'))
-
         async with httpx.AsyncClient() as client:
-            for token, chat_id, delay, template_content in unique_send_tasks:
+            for token, chat_id, delay, template in unique_send_tasks:
                 try:
-                    template = jinja_env.from_string(template_content)
-                    message = template.render(render_data)
+                    message = render_notification(template, data, event_user.username)
                     url = f"https://api.telegram.org/bot{token}/sendMessage"
                     payload = {'chat_id': chat_id, 'text': message, 'parse_mode': 'MarkdownV2'}
-                    response = await client.post(url, json=payload, timeout=10)
+                    started_at = time.perf_counter()
+                    try:
+                        response = await client.post(url, json=payload, timeout=10)
+                    except httpx.HTTPError:
+                        TELEGRAM_SEND_FAILURES.labels(reason='network').inc()
+                        raise
+                    finally:
+                        TELEGRAM_SEND_LATENCY.observe(time.perf_counter() - started_at)
 
                     if response.status_code >= 400:
+                        TELEGRAM_SEND_FAILURES.labels(reason=str(response.status_code)).inc()
                         print(f"Lỗi từ API Telegram ({response.status_code}) cho chat_id {chat_id}: {response.text}")
                     else:
                         print(f"Đã gửi thông báo đến chat_id: {chat_id}")
@@ -167,4 +324,6 @@ async def send_telegram_message(app, message_type: str, data: dict, user_id: int
                     if delay > 0:
                         await asyncio.sleep(delay)
                 except Exception as e:
+                    if not isinstance(e, httpx.HTTPError):
+                        TELEGRAM_SEND_FAILURES.labels(reason='error').inc()
                     print(f"LỖI khi gửi thông báo đến chat_id {chat_id}: {e}")
\ No newline at end of file
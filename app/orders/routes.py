@@ -2,9 +2,7 @@
 
 from flask import render_template, request, jsonify, abort, current_app, Response
 from flask_login import login_required, current_user
-from sqlalchemy import or_, and_, desc, select
 from sqlalchemy.orm import joinedload
-from woocommerce import API
 from decimal import Decimal
 import json
 import html 
@@ -19,26 +17,31 @@ from app import db
 from app.models import (
     WooCommerceOrder, 
     WooCommerceStore, 
-    Setting, 
     AppUser, 
-    OrderLineItem,
     FulfillmentSetting
 )
-from app.services import get_visible_orders_query, get_visible_stores_query
-from app.services.fulfillment_service import get_fulfillment_service
+from app.services import get_visibility_scope, get_visible_orders_query, get_visible_stores_query
+from app.services.fulfillment_service import get_fulfillment_service, record_fulfillment
+from app.services.order_listing import build_order_rows, order_list_query
+from app.services.order_search import order_search_clause
+from app.services.pagination import keyset_paginate
+from app.services.product_cache import get_product_details
+from app.services.woo_client import get_woo_client
+from app.metrics import query_budget
+from app.settings_cache import settings_store
 
 
 # ... (Tất cả các hàm từ manage_all_orders đến api_get_fulfillment_products giữ nguyên không đổi) ...
 @orders_bp.route('/')
 @login_required
+@query_budget('ORDERS_PAGE_QUERY_BUDGET')
 def manage_all_orders():
-    page = request.args.get('page', 1, type=int)
-    base_query = db.session.query(WooCommerceOrder, WooCommerceStore, AppUser.username.label('owner_username'))\
-        .join(WooCommerceStore, WooCommerceOrder.store_id == WooCommerceStore.id)\
-        .outerjoin(AppUser, WooCommerceStore.user_id == AppUser.id)
+    base_query = order_list_query()
     
-    visible_orders_subquery = get_visible_orders_query(current_user).with_entities(WooCommerceOrder.id).subquery()
-    base_query = base_query.filter(WooCommerceOrder.id.in_(select(visible_orders_subquery)))
+    # Truy vấn gốc đã join woocommerce_store: lọc phạm vi trực tiếp trên cửa hàng
+    store_filter = get_visibility_scope(current_user).store_filter
+    if store_filter is not None:
+        base_query = base_query.filter(store_filter)
 
     search_query = request.args.get('search_query')
     selected_store_id = request.args.get('store_id', type=int)
@@ -49,30 +52,9 @@ def manage_all_orders():
     selected_user_id = request.args.get('user_id', type=int)
     selected_fulfillment_status = request.args.get('fulfillment_status')
 
-    if search_query:
-        search_term = f"%{search_query}%"
-        try:
-            search_int = int(search_query)
-            base_query = base_query.filter(or_(
-                WooCommerceOrder.wc_order_id == search_int,
-                WooCommerceOrder.customer_name.ilike(search_term),
-                WooCommerceOrder.billing_phone.ilike(search_term),
-                WooCommerceOrder.billing_email.ilike(search_term),
-                WooCommerceOrder.line_items.any(or_(
-                    OrderLineItem.product_name.ilike(search_term),
-                    OrderLineItem.sku.ilike(search_term)
-                ))
-            ))
-        except ValueError:
-            base_query = base_query.filter(or_(
-                WooCommerceOrder.customer_name.ilike(search_term),
-                WooCommerceOrder.billing_phone.ilike(search_term),
-                WooCommerceOrder.billing_email.ilike(search_term),
-                WooCommerceOrder.line_items.any(or_(
-                    OrderLineItem.product_name.ilike(search_term),
-                    OrderLineItem.sku.ilike(search_term)
-                ))
-            ))
+    search_clause = order_search_clause(search_query)
+    if search_clause is not None:
+        base_query = base_query.filter(search_clause)
     
     if selected_store_id:
         base_query = base_query.filter(WooCommerceOrder.store_id == selected_store_id)
@@ -84,12 +66,9 @@ def manage_all_orders():
         base_query = base_query.filter(WooCommerceOrder.order_created_at <= end_date)
 
     if selected_fulfillment_status == 'fulfilled':
-        base_query = base_query.filter(WooCommerceOrder.note.ilike('%[Fulfilled by%'))
+        base_query = base_query.filter(WooCommerceOrder.fulfillment_status == 'fulfilled')
     elif selected_fulfillment_status == 'not_fulfilled':
-        base_query = base_query.filter(or_(
-            WooCommerceOrder.note == None,
-            WooCommerceOrder.note.notilike('%[Fulfilled by%')
-        ))
+        base_query = base_query.filter(WooCommerceOrder.fulfillment_status.is_(None))
 
     user_ids_to_filter = None
     if current_user.is_super_admin() and (selected_admin_id or selected_user_id):
@@ -105,14 +84,14 @@ def manage_all_orders():
     if user_ids_to_filter:
         base_query = base_query.filter(WooCommerceStore.user_id.in_(user_ids_to_filter))
 
-    orders_pagination = base_query.order_by(desc(WooCommerceOrder.order_created_at)).paginate(page=page, per_page=30, error_out=False)
+    orders_pagination = keyset_paginate(
+        base_query, (WooCommerceOrder.order_created_at, WooCommerceOrder.id),
+        lambda row: (row.order_created_at, row.id),
+        after=request.args.get('after'), before=request.args.get('before'),
+        per_page=30, count_cap=current_app.config['LIST_COUNT_CAP']
+    )
     
-    orders_with_details = []
-    for order_obj, store_obj, owner_username_str in orders_pagination.items:
-        order_obj.store = store_obj
-        order_obj.owner_username = owner_username_str or 'Chưa gán'
-        order_obj.is_fulfilled = '[Fulfilled by' in (order_obj.note or '')
-        orders_with_details.append(order_obj)
+    orders_with_details = build_order_rows(orders_pagination.items)
     
     stores_for_filter = get_visible_stores_query(current_user).order_by(WooCommerceStore.name).all()
     admins_for_filter, users_for_filter = [], []
@@ -128,11 +107,11 @@ def manage_all_orders():
         users_for_filter = current_user.children.all()
     
     statuses = [('processing', 'Đang xử lý'), ('completed', 'Hoàn thành'), ('on-hold', 'Tạm giữ'), ('pending', 'Chờ thanh toán'), ('cancelled', 'Đã hủy'), ('refunded', 'Đã hoàn tiền'), ('failed', 'Thất bại')]
-    columns_config_json = Setting.get_value('ORDER_TABLE_COLUMNS', '[]')
-    columns_config = json.loads(columns_config_json)
+    columns_config = settings_store.get_json('ORDER_TABLE_COLUMNS', [])
     
     query_params = request.args.copy()
-    query_params.pop('page', None)
+    for key in ('page', 'after', 'before'):
+        query_params.pop(key, None)
     
     return render_template(
         'orders/manage_orders.html', title='Quản lý Đơn hàng',
@@ -166,7 +145,7 @@ def update_status(order_id):
     new_status = data.get('status')
     store = order.store
     try:
-        wcapi = API(url=store.store_url, consumer_key=store.consumer_key, consumer_secret=store.consumer_secret, version="wc/v3", timeout=20)
+        wcapi = get_woo_client(store)
         response = wcapi.put(f"orders/{order.wc_order_id}", {"status": new_status})
         if response.status_code == 200:
             updated_order_data = response.json()
@@ -183,7 +162,7 @@ def update_status(order_id):
 def get_refund_details(order_id):
     order = get_visible_orders_query(current_user).filter_by(id=order_id).first_or_404()
     try:
-        wcapi = API(url=order.store.store_url, consumer_key=order.store.consumer_key, consumer_secret=order.store.consumer_secret, version="wc/v3", timeout=20)
+        wcapi = get_woo_client(order.store)
         order_response = wcapi.get(f"orders/{order.wc_order_id}")
         order_response.raise_for_status()
         order_data = order_response.json()
@@ -211,7 +190,7 @@ def process_refund(order_id):
     order = get_visible_orders_query(current_user).filter_by(id=order_id).first_or_404()
     data = request.get_json()
     try:
-        wcapi = API(url=order.store.store_url, consumer_key=order.store.consumer_key, consumer_secret=store.consumer_secret, version="wc/v3", timeout=30)
+        wcapi = get_woo_client(order.store)
         response = wcapi.post(f"orders/{order.wc_order_id}/refunds", data)
         if response.status_code == 201:
             from app.worker import check_single_store_job
@@ -238,7 +217,7 @@ def get_fulfillment_template(provider_name):
 def api_get_fulfillment_details(order_id):
     order = get_visible_orders_query(current_user).filter(WooCommerceOrder.id == order_id).first_or_404()
     try:
-        wcapi = API(url=order.store.store_url, consumer_key=order.store.consumer_key, consumer_secret=order.store.consumer_secret, version="wc/v3", timeout=15)
+        wcapi = get_woo_client(order.store)
         woo_order_response = wcapi.get(f"orders/{order.wc_order_id}")
         woo_order_response.raise_for_status()
         woo_order_data = woo_order_response.json()
@@ -278,10 +257,12 @@ def process_fulfillment(order_id):
     service = get_fulfillment_service(provider_name, setting.api_key)
     if not service: return jsonify({"success": False, "message": "Nhà cung cấp không được hỗ trợ."}), 404
     success, message = service.create_order(order_payload, printer_value)
+    record_fulfillment(order, provider_name, success, message, user_id=current_user.id)
     if success:
+        # Ghi chú chỉ để người dùng thấy mã đơn bên nhà cung cấp; trạng thái fulfill nằm ở fulfillment_status
         note_content = f"\n[Fulfilled by {provider_name.title()} - {message}]"
         order.note = (order.note or '') + note_content
-        db.session.commit()
+    db.session.commit()
     return jsonify({"success": success, "message": message})
 
 @orders_bp.route('/api/fulfillment_products/<provider_name>')
@@ -311,7 +292,6 @@ def export_orders():
     ).filter(WooCommerceOrder.id.in_(order_ids)).all()
 
     api_clients = {}
-    product_details_cache = {} # Cache để tránh gọi API cho cùng 1 sản phẩm nhiều lần
     all_rows_data = []
 
     # Lấy dữ liệu thô của các đơn hàng từ API
@@ -322,17 +302,7 @@ def export_orders():
         
         store_id = order_db.store.id
         if store_id not in api_clients:
-            try:
-                api_clients[store_id] = API(
-                    url=order_db.store.store_url,
-                    consumer_key=order_db.store.consumer_key,
-                    consumer_secret=order_db.store.consumer_secret,
-                    version="wc/v3",
-                    timeout=20
-                )
-            except Exception as e:
-                current_app.logger.error(f"Failed to create API client for store {order_db.store.name}: {e}")
-                continue
+            api_clients[store_id] = get_woo_client(order_db.store)
         
         wcapi = api_clients[store_id]
         
@@ -341,15 +311,26 @@ def export_orders():
             response.raise_for_status()
             order_api_data = response.json()
             order_api_data['_store_url'] = order_db.store.store_url
-            order_api_data['_wcapi'] = wcapi # Gắn wcapi vào để dùng lại sau này
+            order_api_data['_store_id'] = store_id
             raw_orders_data.append(order_api_data)
         except Exception as e:
             current_app.logger.error(f"Failed to get data for WC Order ID {order_db.wc_order_id}: {e}")
 
+    # Lấy link và ảnh sản phẩm qua product_cache (dùng chung với worker), mỗi cửa hàng một lần
+    product_ids_by_store = {}
+    for order_data in raw_orders_data:
+        product_ids_by_store.setdefault(order_data['_store_id'], set()).update(
+            item.get('product_id') for item in order_data.get('line_items', [])
+        )
+    product_details_by_store = {
+        store_id: get_product_details(store_id, api_clients[store_id], product_ids)
+        for store_id, product_ids in product_ids_by_store.items()
+    }
+
     # Xử lý dữ liệu và tạo các hàng cho Excel
     for order_data in raw_orders_data:
         billing_info = order_data.get('billing', {})
-        wcapi = order_data.get('_wcapi')
+        product_details = product_details_by_store.get(order_data['_store_id'], {})
 
         common_info = {
             "DOMAIN": urlparse(order_data.get('_store_url', '')).netloc,
@@ -370,29 +351,9 @@ def export_orders():
         }
 
         for item in order_data.get('line_items', []):
-            product_id = item.get('product_id')
-            product_url = ''
-            image_url = ''
-
-            # <<< SỬA ĐỔI: Lấy thông tin chi tiết của sản phẩm để có URL và ảnh >>>
-            if product_id and wcapi:
-                # Kiểm tra cache trước khi gọi API
-                if product_id in product_details_cache:
-                    product_url = product_details_cache[product_id]['url']
-                    image_url = product_details_cache[product_id]['image']
-                else:
-                    try:
-                        res_product = wcapi.get(f"products/{product_id}")
-                        res_product.raise_for_status()
-                        product_data = res_product.json()
-                        product_url = product_data.get('permalink', '')
-                        images = product_data.get('images', [])
-                        if images:
-                            image_url = images[0].get('src', '')
-                        # Lưu vào cache
-                        product_details_cache[product_id] = {'url': product_url, 'image': image_url}
-                    except Exception as e:
-                        current_app.logger.warning(f"Could not fetch details for product_id {product_id}: {e}")
+            product_info = product_details.get(item.get('product_id'), {})
+            product_url = product_info.get('url') or ''
+            image_url = product_info.get('image') or ''
 
             meta_data = item.get('meta_data', [])
             variations = []
@@ -1,26 +1,75 @@
 # app/services/__init__.py
 
 from app.models import AppUser, WooCommerceStore, WooCommerceOrder
-from sqlalchemy import func
+from flask import current_app, g, has_request_context
+from sqlalchemy import func, or_, select
 from app import db
+from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 import json
+import threading
+import time
 
-def get_visible_user_ids(current_user):
-    if current_user.is_super_admin():
-        user_ids = [user.id for user in AppUser.query.with_entities(AppUser.id).all()]
-    elif current_user.is_admin():
-        child_ids = [child.id for child in current_user.children.with_entities(AppUser.id).all()]
-        user_ids = [current_user.id] + child_ids
-    else:
-        user_ids = [current_user.id]
+# --- Phạm vi dữ liệu người dùng được xem ---
+# Biểu diễn bằng điều kiện SQL (subquery trên app_user.parent_id / woocommerce_store.user_id) thay vì kéo danh sách
+# id về Python rồi dựng `IN (...)` khổng lồ: câu truy vấn có kích thước cố định dù admin có hàng nghìn cửa hàng.
+
+VisibilityScope = namedtuple('VisibilityScope', 'user_filter store_filter')
+
+_visible_user_ids_cache = {}
+_visible_user_ids_lock = threading.Lock()
+
+def _visible_user_ids_select(user):
+    return select(AppUser.id).where(or_(AppUser.id == user.id, AppUser.parent_id == user.id))
+
+def _cached_visible_user_ids(user, ttl_seconds):
+    """Danh sách id (chính admin và các user con) giữ tối đa `ttl_seconds` giây cho mỗi admin."""
+    now = time.monotonic()
+    with _visible_user_ids_lock:
+        cached = _visible_user_ids_cache.get(user.id)
+    if cached and cached[0] > now:
+        return cached[1]
+    user_ids = tuple(db.session.scalars(_visible_user_ids_select(user)).all())
+    with _visible_user_ids_lock:
+        _visible_user_ids_cache[user.id] = (now + ttl_seconds, user_ids)
     return user_ids
 
+def invalidate_visibility_cache():
+    """Gọi sau khi đổi quan hệ admin/user con để tiến trình này không dùng danh sách id cũ (các tiến trình khác: tối đa TTL)."""
+    with _visible_user_ids_lock:
+        _visible_user_ids_cache.clear()
+
+def _build_visibility_scope(user):
+    if user.is_super_admin():
+        return VisibilityScope(None, None)
+    if user.is_admin():
+        ttl_seconds = current_app.config['VISIBILITY_CACHE_SECONDS']
+        user_ids = _cached_visible_user_ids(user, ttl_seconds) if ttl_seconds else _visible_user_ids_select(user)
+        return VisibilityScope(AppUser.id.in_(user_ids), WooCommerceStore.user_id.in_(user_ids))
+    return VisibilityScope(AppUser.id == user.id, WooCommerceStore.user_id == user.id)
+
+def get_visibility_scope(user):
+    """
+    Điều kiện lọc người dùng/cửa hàng mà `user` được xem (None = không giới hạn, với super admin).
+    Được ghi nhớ trong `g` nên mỗi request chỉ dựng một lần cho mỗi người dùng, dù được gọi nhiều lần.
+    """
+    if not has_request_context():
+        return _build_visibility_scope(user)
+    scopes = g.setdefault('visibility_scopes', {})
+    if user.id not in scopes:
+        scopes[user.id] = _build_visibility_scope(user)
+    return scopes[user.id]
+
+def get_visible_users_query(current_user):
+    user_filter = get_visibility_scope(current_user).user_filter
+    return AppUser.query if user_filter is None else AppUser.query.filter(user_filter)
+
+def get_visible_user_ids(current_user):
+    return [user.id for user in get_visible_users_query(current_user).with_entities(AppUser.id).all()]
+
 def get_visible_stores_query(current_user):
-    if current_user.is_super_admin():
-        return WooCommerceStore.query
-    visible_ids = get_visible_user_ids(current_user)
-    return WooCommerceStore.query.filter(WooCommerceStore.user_id.in_(visible_ids))
+    store_filter = get_visibility_scope(current_user).store_filter
+    return WooCommerceStore.query if store_filter is None else WooCommerceStore.query.filter(store_filter)
 
 def can_user_modify_store(user, store):
     if not user or not store:
@@ -34,13 +83,10 @@ def can_user_modify_store(user, store):
     return False
 
 def get_visible_orders_query(current_user):
-    if current_user.is_super_admin():
+    store_filter = get_visibility_scope(current_user).store_filter
+    if store_filter is None:
         return WooCommerceOrder.query
-    visible_stores_query = get_visible_stores_query(current_user).with_entities(WooCommerceStore.id)
-    visible_store_ids = [item.id for item in visible_stores_query.all()]
-    if not visible_store_ids:
-        return WooCommerceOrder.query.filter(db.false())
-    return WooCommerceOrder.query.filter(WooCommerceOrder.store_id.in_(visible_store_ids))
+    return WooCommerceOrder.query.filter(WooCommerceOrder.store_id.in_(select(WooCommerceStore.id).where(store_filter)))
 
 def get_dashboard_statistics(current_user, start_date=None, end_date=None):
     orders_query = get_visible_orders_query(current_user)
@@ -1,7 +1,12 @@
 # app/services/fulfillment_service.py
 
+import re
+
 from flask import current_app
 
+from app import db
+from app.models import FulfillmentRecord
+
 # --- IMPORT CÁC SERVICE TỪ THƯ MỤC PROVIDERS ---
 # Mỗi nhà cung cấp có một file riêng và được import tại đây.
 from .providers.mangotee_service import MangoTeeService
@@ -37,4 +42,30 @@ def get_fulfillment_service(provider_name, api_key):
         return service_class(api_key=api_key)
     except (ValueError, TypeError) as e:
         current_app.logger.error(f"Lỗi khi khởi tạo service '{provider_name}': {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+# --- GHI NHẬN KẾT QUẢ FULFILLMENT ---
+# Thông báo thành công của nhà cung cấp có dạng "... Order ID: <mã>" (xem MangoTeeService.create_order).
+# Migration 9f2c7b4d1e58 dùng cùng mẫu để backfill từ ghi chú cũ.
+_PROVIDER_ORDER_ID = re.compile(r'Order ID:\s*(\S+)')
+
+def record_fulfillment(order, provider_name, success, message, user_id=None):
+    """
+    Lưu một lần gửi đơn sang nhà cung cấp vào `fulfillment_record`. Nếu thành công, đặt
+    `order.fulfillment_status = 'fulfilled'` để bộ lọc danh sách đơn hàng dùng được index.
+    Không commit.
+    """
+    match = _PROVIDER_ORDER_ID.search(message or '') if success else None
+    record = FulfillmentRecord(
+        order_id=order.id,
+        provider=provider_name,
+        provider_order_id=match.group(1) if match else None,
+        status='submitted' if success else 'failed',
+        message=message,
+        user_id=user_id,
+    )
+    db.session.add(record)
+    if success:
+        order.fulfillment_status = 'fulfilled'
+    return record
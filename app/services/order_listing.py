@@ -0,0 +1,55 @@
+# app/services/order_listing.py
+
+from collections import defaultdict, namedtuple
+from types import SimpleNamespace
+
+from sqlalchemy import select
+
+from app import db
+from app.models import AppUser, OrderLineItem, WooCommerceOrder, WooCommerceStore
+
+# Cột chỉ phục vụ tìm kiếm/đồng bộ, không hiển thị: không tải cho danh sách (search_document có thể khá dài)
+ORDER_LIST_EXCLUDED_COLUMNS = ('search_document', 'billing_phone_digits', 'content_hash')
+
+StoreRef = namedtuple('StoreRef', 'id name')
+
+
+def order_list_query():
+    """
+    Truy vấn gốc của danh sách đơn hàng: chỉ lấy cột (không tải instance ORM), kèm tên cửa hàng và người sở hữu.
+    Các bộ lọc của route áp dụng lên WooCommerceOrder/WooCommerceStore như bình thường.
+    """
+    order_columns = [column for column in WooCommerceOrder.__table__.c if column.name not in ORDER_LIST_EXCLUDED_COLUMNS]
+    return db.session.query(
+        *order_columns, WooCommerceStore.name.label('store_name'), AppUser.username.label('owner_username')
+    ).select_from(WooCommerceOrder)\
+        .join(WooCommerceStore, WooCommerceOrder.store_id == WooCommerceStore.id)\
+        .outerjoin(AppUser, WooCommerceStore.user_id == AppUser.id)
+
+
+def build_order_rows(rows) -> list:
+    """
+    Dựng đối tượng hiển thị cho từng dòng của `order_list_query`: cùng tên thuộc tính như WooCommerceOrder
+    (để template và cấu hình cột ORDER_TABLE_COLUMNS dùng được), cộng `store`, `owner_username`, `is_fulfilled`
+    và `line_items`. Line item của cả trang được tải bằng một truy vấn thay vì lazy-load từng đơn.
+    """
+    order_ids = [row.id for row in rows]
+    items_by_order = defaultdict(list)
+    if order_ids:
+        item_rows = db.session.execute(
+            select(OrderLineItem.order_id, OrderLineItem.product_name, OrderLineItem.sku, OrderLineItem.quantity, OrderLineItem.image_url)
+            .where(OrderLineItem.order_id.in_(order_ids))
+            .order_by(OrderLineItem.order_id, OrderLineItem.id)
+        ).all()
+        for item in item_rows:
+            items_by_order[item.order_id].append(item)
+
+    orders = []
+    for row in rows:
+        fields = row._asdict()
+        fields['store'] = StoreRef(row.store_id, fields.pop('store_name'))
+        fields['owner_username'] = row.owner_username or 'Chưa gán'
+        fields['is_fulfilled'] = row.fulfillment_status == 'fulfilled'
+        fields['line_items'] = items_by_order[row.id]
+        orders.append(SimpleNamespace(**fields))
+    return orders
@@ -0,0 +1,64 @@
+# app/services/order_search.py
+
+import re
+
+from sqlalchemy import func, literal_column, or_
+
+from app.models import WooCommerceOrder
+
+# Cấu hình 'simple': không stem, không bỏ stopword (tên sản phẩm, SKU, email không phải văn bản tiếng Anh).
+# Biểu thức phải giống hệt index ix_woocommerce_order_search_tsv thì Postgres mới dùng được index.
+SEARCH_CONFIG = literal_column("'simple'::regconfig")
+
+# Trigram cần tối thiểu 3 ký tự; tìm SĐT ngắn hơn thì chỉ so theo search_document như các từ khóa khác
+MIN_PHONE_DIGITS = 3
+
+_NON_DIGITS = re.compile(r'\D')
+_PHONE_QUERY = re.compile(r'^\+?[\d\s().-]+$')
+
+
+def phone_digits(phone) -> str:
+    """'+84 (912) 345-678' -> '84912345678'."""
+    return _NON_DIGITS.sub('', phone or '')
+
+
+def build_search_document(order_level_data: dict, line_items_data: list) -> str:
+    """
+    Văn bản tìm kiếm của một đơn: tên khách, SĐT, email, rồi tên sản phẩm và SKU của từng line item.
+    Mỗi giá trị một dòng để từ khóa không khớp vắt qua hai trường khác nhau.
+    Migration backfill (d5a8c3e1f072) dựng cùng định dạng bằng SQL; sửa ở đây thì sửa cả ở đó.
+    """
+    parts = [order_level_data.get('customer_name'), order_level_data.get('billing_phone'), order_level_data.get('billing_email')]
+    for item in line_items_data:
+        parts.extend((item.get('product_name'), item.get('sku')))
+    return '\n'.join(part for part in parts if part)
+
+
+def search_vector():
+    return func.to_tsvector(SEARCH_CONFIG, WooCommerceOrder.search_document)
+
+
+def order_search_clause(search_query: str):
+    """
+    Điều kiện WHERE cho ô tìm kiếm của danh sách đơn hàng, chỉ dùng các cột có index:
+    - số nguyên: khớp chính xác `wc_order_id` (như trước);
+    - chuỗi con trong tên khách/SĐT/email/tên sản phẩm/SKU: ILIKE trên `search_document` (GIN pg_trgm);
+    - nhiều từ: thêm khớp toàn văn (đủ các từ, không cần đúng thứ tự) qua index tsvector;
+    - chuỗi giống SĐT: so phần chữ số với `billing_phone_digits` (GIN pg_trgm), bỏ qua khoảng trắng, dấu chấm, gạch.
+    Trả về None nếu từ khóa rỗng.
+    """
+    term = (search_query or '').strip()
+    if not term:
+        return None
+
+    conditions = [WooCommerceOrder.search_document.ilike(f"%{term}%")]
+    try:
+        conditions.append(WooCommerceOrder.wc_order_id == int(term))
+    except ValueError:
+        pass
+    if len(term.split()) > 1:
+        conditions.append(search_vector().op('@@')(func.plainto_tsquery(SEARCH_CONFIG, term)))
+    digits = phone_digits(term)
+    if _PHONE_QUERY.match(term) and len(digits) >= MIN_PHONE_DIGITS:
+        conditions.append(WooCommerceOrder.billing_phone_digits.like(f"%{digits}%"))
+    return or_(*conditions)
@@ -0,0 +1,98 @@
+# app/services/pagination.py
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import func, select, tuple_
+
+from app import db
+
+
+def encode_cursor(values) -> str:
+    """Giá trị khóa sắp xếp của một dòng -> chuỗi base64 dùng trong URL (client không cần hiểu nội dung)."""
+    raw = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: str, columns) -> tuple:
+    """Ngược lại của `encode_cursor`, ép kiểu theo cột. Cursor hỏng/bị sửa tay trả về None (quay về trang đầu)."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+        decoded = []
+        for column, value in zip(columns, values):
+            python_type = column.type.python_type
+            decoded.append(datetime.fromisoformat(value) if python_type is datetime else python_type(value))
+        return tuple(decoded)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        return None
+
+
+class KeysetPage:
+    """Một trang kết quả phân trang theo khóa (seek): chỉ biết trang trước/sau, không có số trang."""
+    def __init__(self, items, next_cursor, prev_cursor, total, total_is_capped):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_is_capped = total_is_capped
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def capped_count(query, cap: int):
+    """COUNT(*) dừng ở `cap + 1` dòng: trả về (số dòng, có bị cắt không)."""
+    limited = query.order_by(None).limit(cap + 1).subquery()
+    total = db.session.scalar(select(func.count()).select_from(limited))
+    return min(total, cap), total > cap
+
+
+def keyset_paginate(query, columns, row_key, after=None, before=None, per_page=30, descending=True, count_cap=None):
+    """
+    Phân trang `query` theo bộ cột `columns` (phải duy nhất, không NULL, ví dụ (order_created_at, id)) bằng
+    điều kiện `(cột...) < (giá trị...)` thay vì OFFSET: trang thứ 500 tốn như trang đầu nếu có index trên các cột này.
+    `row_key(row)` trả về giá trị các cột đó của một dòng kết quả. `after`/`before` là cursor từ trang trước;
+    `count_cap` bật đếm tổng (giới hạn) để hiển thị, None thì không đếm.
+    """
+    total, total_is_capped = capped_count(query, count_cap) if count_cap else (None, False)
+
+    key = tuple_(*columns)
+    after_values = decode_cursor(after, columns)
+    before_values = decode_cursor(before, columns) if after_values is None else None
+    backwards = before_values is not None
+
+    # Đi lùi: đảo chiều sắp xếp và điều kiện, lấy xong thì đảo lại danh sách
+    step_down = descending != backwards
+    if after_values is not None:
+        query = query.filter(key < after_values if descending else key > after_values)
+    elif backwards:
+        query = query.filter(key > before_values if descending else key < before_values)
+    query = query.order_by(*[column.desc() if step_down else column.asc() for column in columns])
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    first_key = encode_cursor(row_key(rows[0])) if rows else None
+    last_key = encode_cursor(row_key(rows[-1])) if rows else None
+    if backwards:
+        next_cursor = last_key
+        prev_cursor = first_key if has_more else None
+    else:
+        next_cursor = last_key if has_more else None
+        prev_cursor = first_key if after_values is not None else None
+    return KeysetPage(rows, next_cursor, prev_cursor, total, total_is_capped)
@@ -0,0 +1,123 @@
+# app/services/product_cache.py
+
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import db
+from app.metrics import PRODUCT_LOOKUPS
+from app.models import ProductCache
+
+# WooCommerce giới hạn per_page tối đa là 100
+PRODUCT_BATCH_SIZE = 100
+PRODUCT_FIELDS = 'id,images,permalink,date_modified_gmt'
+
+
+def _parse_gmt(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def _product_row(product_data: dict) -> dict:
+    images = product_data.get('images') or []
+    return {
+        'image_url': images[0].get('src') if images else None,
+        'permalink': product_data.get('permalink') or None,
+        'product_modified_at': _parse_gmt(product_data.get('date_modified_gmt')),
+    }
+
+
+def _fetch_products(wcapi, product_ids) -> dict:
+    """
+    Lấy các sản phẩm còn thiếu theo lô bằng `products?include=...` (tối đa PRODUCT_BATCH_SIZE id mỗi request),
+    chỉ xin các trường cần thiết qua `_fields`. Sản phẩm không được trả về (đã xóa, không tồn tại)
+    vẫn được lưu rỗng để không gọi lại liên tục; lô bị lỗi thì bỏ qua để lần sau thử lại.
+    """
+    fetched = {}
+    for start in range(0, len(product_ids), PRODUCT_BATCH_SIZE):
+        chunk = product_ids[start:start + PRODUCT_BATCH_SIZE]
+        params = {
+            'include': ','.join(str(product_id) for product_id in chunk),
+            'per_page': PRODUCT_BATCH_SIZE,
+            '_fields': PRODUCT_FIELDS,
+        }
+        try:
+            response = wcapi.get("products", params=params)
+            response.raise_for_status()
+            products = response.json()
+            if not isinstance(products, list):
+                raise ValueError(f"Phản hồi không hợp lệ: {products}")
+        except Exception as e:
+            current_app.logger.warning(f"Không thể lấy lô {len(chunk)} sản phẩm ({params['include']}): {e}")
+            continue
+
+        returned = {product.get('id'): product for product in products if isinstance(product, dict)}
+        for product_id in chunk:
+            fetched[product_id] = _product_row(returned.get(product_id, {}))
+    return fetched
+
+
+def get_product_details(store_id: int, wcapi, product_ids) -> dict:
+    """
+    Đọc thông tin ảnh/permalink của các sản phẩm qua bảng `product_cache`.
+    Chỉ gọi API cho sản phẩm chưa có trong cache hoặc đã quá `PRODUCT_CACHE_TTL_HOURS`.
+
+    Returns:
+        dict {product_id: {'image': str|None, 'url': str|None}}
+    """
+    wanted = {int(product_id) for product_id in product_ids if product_id}
+    if not wanted:
+        return {}
+
+    now = datetime.now(timezone.utc)
+    fresh_after = now - timedelta(hours=current_app.config['PRODUCT_CACHE_TTL_HOURS'])
+
+    details, stale = {}, {}
+    cached_rows = ProductCache.query.filter(
+        ProductCache.store_id == store_id,
+        ProductCache.product_id.in_(wanted)
+    ).all()
+    for row in cached_rows:
+        target = details if row.fetched_at and row.fetched_at >= fresh_after else stale
+        target[row.product_id] = {'image': row.image_url, 'url': row.permalink}
+
+    missing = sorted(wanted - details.keys())
+    if details:
+        PRODUCT_LOOKUPS.labels(source='cache').inc(len(details))
+    if not missing:
+        return details
+
+    fetched = _fetch_products(wcapi, missing)
+    if fetched:
+        rows = [{'store_id': store_id, 'product_id': product_id, 'fetched_at': now, **row} for product_id, row in fetched.items()]
+        stmt = pg_insert(ProductCache.__table__).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            constraint='_store_product_uc',
+            set_={key: stmt.excluded[key] for key in ('image_url', 'permalink', 'product_modified_at', 'fetched_at')}
+        )
+        try:
+            db.session.execute(stmt)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.warning(f"Không thể lưu product_cache cho cửa hàng ID {store_id}: {e}")
+
+        for product_id, row in fetched.items():
+            details[product_id] = {'image': row['image_url'], 'url': row['permalink']}
+        PRODUCT_LOOKUPS.labels(source='api').inc(len(fetched))
+
+    # Không làm mới được thì dùng tạm bản ghi cũ còn hơn không có ảnh
+    for product_id in missing:
+        if product_id not in details:
+            if product_id in stale:
+                details[product_id] = stale[product_id]
+                PRODUCT_LOOKUPS.labels(source='stale').inc()
+            else:
+                PRODUCT_LOOKUPS.labels(source='missing').inc()
+
+    return details
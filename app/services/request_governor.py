@@ -0,0 +1,157 @@
+# app/services/request_governor.py
+
+import random
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+
+from flask import current_app
+
+# Mã lỗi tạm thời: đáng thử lại và tính vào circuit breaker
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+    """Header Retry-After có thể là số giây hoặc một HTTP-date. Trả về số giây (float) hoặc None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class _HostBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+
+class RequestGovernor:
+    """
+    Bộ điều tiết dùng chung cho mọi lời gọi WooCommerce trong tiến trình (cả client đồng bộ lẫn bất đồng bộ):
+    - token bucket theo host (`WOO_HOST_RATE_PER_SECOND`, `WOO_HOST_BURST`);
+    - khi host trả 429/503 kèm Retry-After, cả host bị tạm dừng trong khoảng đó;
+    - backoff lũy thừa có jitter giữa các lần thử lại.
+    Chỉ tính toán thời gian chờ; việc ngủ do client gọi (time.sleep hoặc asyncio.sleep).
+    """
+    def __init__(self, rate_per_second, burst, max_retries, retry_base_seconds, retry_max_seconds):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, host) -> float:
+        """Giữ chỗ một token cho host; trả về số giây phải chờ trước khi gửi request."""
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = _HostBucket(self.rate_per_second, self.burst)
+            now = time.monotonic()
+            bucket.tokens = min(bucket.capacity, bucket.tokens + (now - bucket.updated_at) * bucket.rate)
+            bucket.updated_at = now
+            # Token có thể âm: các request xếp hàng nối tiếp nhau thay vì cùng thức dậy một lúc
+            bucket.tokens -= 1
+            wait = -bucket.tokens / bucket.rate if bucket.tokens < 0 else 0.0
+            return max(wait, bucket.blocked_until - now)
+
+    def block_host(self, host, seconds):
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = _HostBucket(self.rate_per_second, self.burst)
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + min(seconds, self.retry_max_seconds))
+
+    def backoff(self, attempt) -> float:
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def retry_delay(self, host, status_code, retry_after_header, attempt):
+        """
+        Sau khi nhận phản hồi: trả về số giây cần chờ trước khi thử lại, hoặc None nếu không nên thử lại.
+        Retry-After của 429/503 được áp cho cả host.
+        """
+        if status_code not in RETRYABLE_STATUS_CODES:
+            return None
+        retry_after = parse_retry_after(retry_after_header)
+        if retry_after is not None and status_code in (429, 503):
+            self.block_host(host, retry_after)
+        if attempt >= self.max_retries:
+            return None
+        return retry_after if retry_after is not None else self.backoff(attempt)
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_request_governor() -> RequestGovernor:
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            config = current_app.config
+            _governor = RequestGovernor(
+                config['WOO_HOST_RATE_PER_SECOND'], config['WOO_HOST_BURST'], config['WOO_MAX_RETRIES'],
+                config['WOO_RETRY_BASE_SECONDS'], config['WOO_RETRY_MAX_SECONDS']
+            )
+        return _governor
+
+
+# --- Circuit breaker theo cửa hàng, lưu trên bảng woocommerce_store ---
+
+def breaker_allows(store, now=None) -> bool:
+    """
+    Cửa hàng có được gọi ở lượt này không. Breaker 'open' đã tới giờ thăm dò thì chuyển sang 'half_open'
+    (cho đúng một lượt thử). Không commit.
+    """
+    if store.breaker_state != 'open':
+        return True
+    now = now or datetime.now(timezone.utc)
+    if store.breaker_next_probe_at and store.breaker_next_probe_at > now:
+        return False
+    store.breaker_state = 'half_open'
+    return True
+
+
+def record_breaker_success(store):
+    if store.breaker_state != 'closed' or store.breaker_failures:
+        if store.breaker_state != 'closed':
+            print(f"--- Cửa hàng '{store.name}' đã phản hồi bình thường trở lại, đóng circuit breaker ---")
+        store.breaker_state = 'closed'
+        store.breaker_failures = 0
+        store.breaker_next_probe_at = None
+        store.breaker_last_error = None
+
+
+def record_breaker_failure(store, error, now=None):
+    """Đếm lỗi liên tiếp; đủ ngưỡng (hoặc thăm dò half-open thất bại) thì mở breaker với thời gian thăm dò tăng dần."""
+    config = current_app.config
+    now = now or datetime.now(timezone.utc)
+    store.breaker_failures = (store.breaker_failures or 0) + 1
+    store.breaker_last_error = str(error)[:500]
+
+    threshold = config['BREAKER_FAILURE_THRESHOLD']
+    if store.breaker_state == 'half_open' or store.breaker_failures >= threshold:
+        probe_minutes = min(
+            config['BREAKER_MAX_PROBE_MINUTES'],
+            config['BREAKER_PROBE_MINUTES'] * 2 ** max(0, store.breaker_failures - threshold)
+        )
+        if store.breaker_state == 'closed':
+            store.breaker_opened_at = now
+            print(f"--- Mở circuit breaker cho '{store.name}' sau {store.breaker_failures} lỗi liên tiếp, thăm dò lại sau {probe_minutes} phút ---")
+        store.breaker_state = 'open'
+        store.breaker_next_probe_at = now + timedelta(minutes=probe_minutes)
@@ -0,0 +1,17 @@
+# app/services/webhook_signature.py
+
+import base64
+import hashlib
+import hmac
+
+
+def sign_webhook_payload(secret: str, body: bytes) -> str:
+    """Chữ ký giống WooCommerce: base64(HMAC-SHA256(secret, raw body)), đặt trong header X-WC-Webhook-Signature."""
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def verify_webhook_signature(secret: str, body: bytes, signature: str) -> bool:
+    if not secret or not signature:
+        return False
+    return hmac.compare_digest(sign_webhook_payload(secret, body), signature.strip())
@@ -0,0 +1,235 @@
+# app/services/woo_client.py
+
+import asyncio
+import threading
+import time
+from json import dumps as jsonencode
+from urllib.parse import urlencode, urlparse
+
+import httpx
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from woocommerce.oauth import OAuth
+
+from ..metrics import observe_woo_request
+from .request_governor import get_request_governor
+
+API_VERSION = "wc/v3"
+USER_AGENT = "WooCommerce-Python-REST-API/3.0.0"
+
+
+class WooApiError(Exception):
+    """WooCommerce trả về lỗi (JSON có `message`) thay vì dữ liệu mong đợi."""
+
+
+def build_woo_request(store_url, consumer_key, consumer_secret, method, endpoint, params=None):
+    """
+    Dựng URL, params và auth giống hệt thư viện `woocommerce.API`
+    (Basic Auth qua HTTPS, OAuth1 khi store chạy HTTP).
+    Trả về (url, params, auth).
+    """
+    params = dict(params or {})
+    url = store_url if store_url.endswith("/") else f"{store_url}/"
+    url = f"{url}wp-json/{API_VERSION}/{endpoint}"
+
+    if store_url.startswith("https"):
+        return url, params, (consumer_key, consumer_secret)
+
+    url = f"{url}?{urlencode(params)}" if params else url
+    oauth = OAuth(
+        url=url,
+        consumer_key=consumer_key,
+        consumer_secret=consumer_secret,
+        version=API_VERSION,
+        method=method,
+        oauth_timestamp=int(time.time())
+    )
+    return oauth.get_oauth_url(), {}, None
+
+
+class AsyncWooClient:
+    """
+    Client WooCommerce bất đồng bộ dùng chung một `httpx.AsyncClient` (có pool kết nối).
+    Giao diện tương tự `woocommerce.API`: get/post/put trả về `httpx.Response`.
+    """
+    def __init__(self, http_client: httpx.AsyncClient, store_url, consumer_key, consumer_secret, timeout=20, governor=None):
+        self.http_client = http_client
+        self.store_url = store_url
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.timeout = timeout
+        self.governor = governor
+        self.host = urlparse(store_url).netloc
+
+    async def request(self, method, endpoint, data=None, params=None):
+        content = None
+        headers = {"user-agent": USER_AGENT, "accept": "application/json"}
+        if data is not None:
+            content = jsonencode(data, ensure_ascii=False).encode('utf-8')
+            headers["content-type"] = "application/json;charset=utf-8"
+
+        attempt = 0
+        while True:
+            if self.governor:
+                await asyncio.sleep(self.governor.reserve(self.host))
+            url, request_params, auth = build_woo_request(
+                self.store_url, self.consumer_key, self.consumer_secret, method, endpoint, params
+            )
+            started_at = time.perf_counter()
+            try:
+                response = await self.http_client.request(
+                    method, url, params=request_params, auth=auth, content=content, headers=headers, timeout=self.timeout
+                )
+            except httpx.TransportError:
+                observe_woo_request(endpoint, method, 'error', time.perf_counter() - started_at)
+                if not self.governor or method != "GET" or attempt >= self.governor.max_retries:
+                    raise
+                await asyncio.sleep(self.governor.backoff(attempt))
+                attempt += 1
+                continue
+            observe_woo_request(endpoint, method, response.status_code, time.perf_counter() - started_at)
+            delay = self.governor.retry_delay(self.host, response.status_code, response.headers.get('Retry-After'), attempt) if self.governor else None
+            if delay is None or method != "GET":
+                return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, endpoint, params=None):
+        return await self.request("GET", endpoint, params=params)
+
+    async def post(self, endpoint, data, params=None):
+        return await self.request("POST", endpoint, data=data, params=params)
+
+    async def put(self, endpoint, data, params=None):
+        return await self.request("PUT", endpoint, data=data, params=params)
+
+
+class WooClient:
+    """
+    Client WooCommerce đồng bộ dùng chung một `requests.Session` (keep-alive, pool kết nối)
+    thay vì mỗi lời gọi mở một kết nối TCP/TLS mới như `woocommerce.API`.
+    Giao diện giữ nguyên: get/post/put/delete trả về `requests.Response`.
+    """
+    def __init__(self, session: requests.Session, store_url, consumer_key, consumer_secret, timeout=20, governor=None):
+        self.session = session
+        self.store_url = store_url
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.timeout = timeout
+        self.governor = governor
+        self.host = urlparse(store_url).netloc
+
+    @property
+    def fingerprint(self):
+        return (self.store_url, self.consumer_key, self.consumer_secret, self.timeout)
+
+    def request(self, method, endpoint, data=None, params=None):
+        """
+        Gửi request qua governor (nếu có): chờ token của host, thử lại GET khi gặp 429/5xx/lỗi mạng
+        với backoff hoặc theo Retry-After. POST/PUT/DELETE không tự thử lại để tránh ghi trùng.
+        """
+        headers = {"user-agent": USER_AGENT, "accept": "application/json"}
+        if data is not None:
+            data = jsonencode(data, ensure_ascii=False).encode('utf-8')
+            headers["content-type"] = "application/json;charset=utf-8"
+
+        attempt = 0
+        while True:
+            if self.governor:
+                time.sleep(self.governor.reserve(self.host))
+            url, request_params, auth = build_woo_request(
+                self.store_url, self.consumer_key, self.consumer_secret, method, endpoint, params
+            )
+            started_at = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url, params=request_params, auth=auth, data=data, headers=headers, timeout=self.timeout
+                )
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                observe_woo_request(endpoint, method, 'error', time.perf_counter() - started_at)
+                if not self.governor or method != "GET" or attempt >= self.governor.max_retries:
+                    raise
+                time.sleep(self.governor.backoff(attempt))
+                attempt += 1
+                continue
+            observe_woo_request(endpoint, method, response.status_code, time.perf_counter() - started_at)
+            delay = self.governor.retry_delay(self.host, response.status_code, response.headers.get('Retry-After'), attempt) if self.governor else None
+            if delay is None or method != "GET":
+                return response
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, endpoint, **kwargs):
+        return self.request("GET", endpoint, params=kwargs.get('params'))
+
+    def post(self, endpoint, data, **kwargs):
+        return self.request("POST", endpoint, data=data, params=kwargs.get('params'))
+
+    def put(self, endpoint, data, **kwargs):
+        return self.request("PUT", endpoint, data=data, params=kwargs.get('params'))
+
+    def delete(self, endpoint, **kwargs):
+        return self.request("DELETE", endpoint, params=kwargs.get('params'))
+
+
+# --- Registry client dùng chung trong tiến trình, khóa theo store id ---
+
+_registry_lock = threading.Lock()
+_shared_session = None
+_clients = {}
+
+
+def get_shared_session() -> requests.Session:
+    """Session HTTP dùng chung cho mọi lời gọi WooCommerce đồng bộ trong tiến trình."""
+    global _shared_session
+    with _registry_lock:
+        if _shared_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=current_app.config['WOO_POOL_CONNECTIONS'],
+                pool_maxsize=current_app.config['WOO_POOL_MAXSIZE']
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _shared_session = session
+        return _shared_session
+
+
+def get_store_timeout(store) -> int:
+    return store.api_timeout_seconds or current_app.config['WOO_DEFAULT_TIMEOUT']
+
+
+def build_woo_client(store_url, consumer_key, consumer_secret, timeout) -> WooClient:
+    """
+    Tạo client mới qua session dùng chung và RequestGovernor (token bucket theo host, Retry-After).
+    Dùng trực tiếp cho thông tin kết nối chưa lưu (kiểm tra kết nối); cửa hàng đã lưu thì dùng get_woo_client.
+    """
+    return WooClient(
+        get_shared_session(), store_url, consumer_key, consumer_secret,
+        timeout=timeout, governor=get_request_governor()
+    )
+
+
+def get_woo_client(store) -> WooClient:
+    """
+    Trả về client dùng lại được cho cửa hàng. Client được tạo lại nếu URL, khóa API
+    hoặc timeout của cửa hàng đã thay đổi (kể cả khi được sửa từ tiến trình khác).
+    """
+    timeout = get_store_timeout(store)
+    fingerprint = (store.store_url, store.consumer_key, store.consumer_secret, timeout)
+    with _registry_lock:
+        cached = _clients.get(store.id)
+    if cached is not None and cached.fingerprint == fingerprint:
+        return cached
+
+    client = build_woo_client(store.store_url, store.consumer_key, store.consumer_secret, timeout)
+    with _registry_lock:
+        _clients[store.id] = client
+    return client
+
+
+def invalidate_woo_client(store_id):
+    """Gọi khi thông tin kết nối của cửa hàng bị sửa hoặc cửa hàng bị xóa."""
+    with _registry_lock:
+        _clients.pop(store_id, None)
@@ -1,7 +1,7 @@
 # app/settings/forms.py
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, BooleanField, IntegerField, TextAreaField, HiddenField
+from wtforms import StringField, SubmitField, BooleanField, IntegerField, TextAreaField, HiddenField, SelectField
 from wtforms.validators import DataRequired, NumberRange, Optional
 
 # MODIFIED: Thêm validators cho form mới
@@ -18,6 +18,17 @@ class SystemTelegramForm(FlaskForm):
         validators=[DataRequired(), NumberRange(min=0)],
         default=2
     )
+    telegram_digest_enabled = BooleanField('Gộp thông báo đơn mới (digest) cho người dùng không tự chọn')
+    telegram_digest_window_seconds = IntegerField(
+        'Cửa sổ gộp (giây)',
+        validators=[DataRequired(), NumberRange(min=5)],
+        default=60
+    )
+    telegram_digest_threshold = IntegerField(
+        'Gửi ngay khi gom đủ (đơn)',
+        validators=[DataRequired(), NumberRange(min=2)],
+        default=5
+    )
     submit_telegram = SubmitField('Lưu Cài đặt Telegram')
 
 
@@ -45,6 +56,11 @@ class SystemTemplateForm(FlaskForm):
         validators=[DataRequired()],
         render_kw={'rows': 10}
     )
+    telegram_template_new_order_digest = TextAreaField(
+        'Template gộp nhiều đơn hàng mới (digest)',
+        validators=[DataRequired()],
+        render_kw={'rows': 6}
+    )
     telegram_template_system_test = TextAreaField(
         'Template cho tin nhắn thử của hệ thống',
         validators=[DataRequired()],
@@ -60,6 +76,11 @@ class PersonalSettingsForm(FlaskForm):
     telegram_bot_token = StringField('Bot Token Cá nhân', validators=[Optional()])
     telegram_chat_id = StringField('Chat ID Cá nhân', validators=[Optional()])
     telegram_enabled = BooleanField('Bật thông báo Telegram cá nhân')
+    telegram_digest_mode = SelectField(
+        'Gộp thông báo đơn mới (digest)',
+        choices=[('', 'Theo cài đặt hệ thống'), ('on', 'Bật: gộp các đơn đến dồn dập thành một tin'), ('off', 'Tắt: mỗi đơn một tin')],
+        default=''
+    )
 
     telegram_send_delay_seconds = IntegerField(
         'Độ trễ gửi tin nhắn (giây)',
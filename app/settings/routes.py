@@ -9,9 +9,9 @@ from . import settings_bp
 # === START: DỌN DẸP VÀ GỘP CÁC IMPORT ===
 from .forms import (SystemTelegramForm, SystemWorkerForm, SystemTableForm, 
                     SystemTemplateForm, PersonalSettingsForm, FulfillmentSettingsForm)
-from app import db, worker
+from app import db
 from app.models import Setting, AppUser, FulfillmentSetting
-from app.notifications import send_telegram_message, send_test_telegram_message
+from app.notifications import invalidate_recipient_plans, send_telegram_message, send_test_telegram_message
 from app.decorators import super_admin_required, admin_or_super_admin_required
 # === END: DỌN DẸP VÀ GỘP CÁC IMPORT ===
 
@@ -25,25 +25,25 @@ def system():
     template_form = SystemTemplateForm()
 
     if telegram_form.submit_telegram.data and telegram_form.validate_on_submit():
-        Setting.set_value('TELEGRAM_BOT_TOKEN', telegram_form.telegram_bot_token.data)
-        Setting.set_value('TELEGRAM_CHAT_ID', telegram_form.telegram_chat_id.data)
-        Setting.set_value('TELEGRAM_SEND_DELAY_SECONDS', str(telegram_form.telegram_send_delay_seconds.data))
+        Setting.set_values({
+            'TELEGRAM_BOT_TOKEN': telegram_form.telegram_bot_token.data,
+            'TELEGRAM_CHAT_ID': telegram_form.telegram_chat_id.data,
+            'TELEGRAM_SEND_DELAY_SECONDS': telegram_form.telegram_send_delay_seconds.data,
+            'TELEGRAM_DIGEST_ENABLED': telegram_form.telegram_digest_enabled.data,
+            'TELEGRAM_DIGEST_WINDOW_SECONDS': telegram_form.telegram_digest_window_seconds.data,
+            'TELEGRAM_DIGEST_THRESHOLD': telegram_form.telegram_digest_threshold.data,
+        })
         flash('Đã cập nhật cài đặt Telegram của hệ thống.', 'success')
         return redirect(url_for('settings.system'))
 
     if worker_form.submit_worker.data and worker_form.validate_on_submit():
-        old_interval = Setting.get_value('CHECK_INTERVAL_MINUTES', '5')
-        new_interval = str(worker_form.check_interval_minutes.data)
-        
-        Setting.set_value('CHECK_INTERVAL_MINUTES', new_interval)
-        Setting.set_value('FETCH_PRODUCT_IMAGES', str(worker_form.fetch_product_images.data))
-        
-        if old_interval != new_interval:
-            flash('Đã cập nhật cài đặt Worker. Đang khởi động lại bộ lập lịch...', 'info')
-            worker.init_scheduler(current_app._get_current_object())
-        else:
-            flash('Đã cập nhật cài đặt Worker.', 'success')
-            
+        # Không khởi động lại scheduler ở đây: tiến trình web không chạy worker. `flask run-worker` tự đọc lại
+        # lịch đồng bộ khi SETTINGS_VERSION đổi (set_values tăng phiên bản).
+        Setting.set_values({
+            'CHECK_INTERVAL_MINUTES': worker_form.check_interval_minutes.data,
+            'FETCH_PRODUCT_IMAGES': worker_form.fetch_product_images.data,
+        })
+        flash('Đã cập nhật cài đặt Worker.', 'success')
         return redirect(url_for('settings.system'))
 
     if table_form.submit_table.data and table_form.validate_on_submit():
@@ -52,8 +52,11 @@ def system():
         return redirect(url_for('settings.system'))
 
     if template_form.submit_template.data and template_form.validate_on_submit():
-        Setting.set_value('DEFAULT_TELEGRAM_TEMPLATE_NEW_ORDER', template_form.telegram_template_new_order.data)
-        Setting.set_value('DEFAULT_TELEGRAM_TEMPLATE_SYSTEM_TEST', template_form.telegram_template_system_test.data)
+        Setting.set_values({
+            'DEFAULT_TELEGRAM_TEMPLATE_NEW_ORDER': template_form.telegram_template_new_order.data,
+            'DEFAULT_TELEGRAM_TEMPLATE_NEW_ORDER_DIGEST': template_form.telegram_template_new_order_digest.data,
+            'DEFAULT_TELEGRAM_TEMPLATE_SYSTEM_TEST': template_form.telegram_template_system_test.data,
+        })
         flash('Đã cập nhật các template tin nhắn của hệ thống.', 'success')
         return redirect(url_for('settings.system'))
 
@@ -61,11 +64,15 @@ def system():
         telegram_form.telegram_bot_token.data = Setting.get_value('TELEGRAM_BOT_TOKEN', '')
         telegram_form.telegram_chat_id.data = Setting.get_value('TELEGRAM_CHAT_ID', '')
         telegram_form.telegram_send_delay_seconds.data = int(Setting.get_value('TELEGRAM_SEND_DELAY_SECONDS', current_app.config['DEFAULT_TELEGRAM_SEND_DELAY_SECONDS']))
+        telegram_form.telegram_digest_enabled.data = Setting.get_value('TELEGRAM_DIGEST_ENABLED', 'False').lower() == 'true'
+        telegram_form.telegram_digest_window_seconds.data = int(Setting.get_value('TELEGRAM_DIGEST_WINDOW_SECONDS', current_app.config['DEFAULT_TELEGRAM_DIGEST_WINDOW_SECONDS']))
+        telegram_form.telegram_digest_threshold.data = int(Setting.get_value('TELEGRAM_DIGEST_THRESHOLD', current_app.config['DEFAULT_TELEGRAM_DIGEST_THRESHOLD']))
         
         worker_form.check_interval_minutes.data = int(Setting.get_value('CHECK_INTERVAL_MINUTES', current_app.config['DEFAULT_CHECK_INTERVAL_MINUTES']))
         worker_form.fetch_product_images.data = Setting.get_value('FETCH_PRODUCT_IMAGES', 'False').lower() == 'true'
 
         template_form.telegram_template_new_order.data = Setting.get_value('DEFAULT_TELEGRAM_TEMPLATE_NEW_ORDER', current_app.config['DEFAULT_TELEGRAM_TEMPLATE_NEW_ORDER'])
+        template_form.telegram_template_new_order_digest.data = Setting.get_value('DEFAULT_TELEGRAM_TEMPLATE_NEW_ORDER_DIGEST', current_app.config['DEFAULT_TELEGRAM_TEMPLATE_NEW_ORDER_DIGEST'])
         template_form.telegram_template_system_test.data = Setting.get_value('DEFAULT_TELEGRAM_TEMPLATE_SYSTEM_TEST', current_app.config['DEFAULT_TELEGRAM_TEMPLATE_SYSTEM_TEST'])
 
     try:
@@ -100,13 +107,17 @@ def personal():
         current_user.telegram_bot_token = form.telegram_bot_token.data
         current_user.telegram_chat_id = form.telegram_chat_id.data
         current_user.telegram_enabled = form.telegram_enabled.data
+        current_user.telegram_digest_mode = form.telegram_digest_mode.data or None
         
         if current_user.can_customize_telegram_delay:
             current_user.telegram_send_delay_seconds = form.telegram_send_delay_seconds.data
         if current_user.can_customize_telegram_templates:
             current_user.telegram_template_new_order = form.telegram_template_new_order.data
 
+        # Kế hoạch gửi Telegram đã cache ở các tiến trình khác phụ thuộc cài đặt này
+        Setting.bump_version()
         db.session.commit()
+        invalidate_recipient_plans()
         flash('Đã cập nhật cài đặt cá nhân của bạn.', 'success')
         return redirect(url_for('settings.personal'))
 
@@ -114,6 +125,7 @@ def personal():
         form.telegram_bot_token.data = current_user.telegram_bot_token
         form.telegram_chat_id.data = current_user.telegram_chat_id
         form.telegram_enabled.data = current_user.telegram_enabled
+        form.telegram_digest_mode.data = current_user.telegram_digest_mode or ''
         
         if current_user.can_customize_telegram_delay:
             form.telegram_send_delay_seconds.data = current_user.telegram_send_delay_seconds
@@ -0,0 +1,107 @@
+# app/settings_cache.py
+
+import json
+import threading
+import time
+from types import MappingProxyType
+
+from flask import current_app
+from sqlalchemy import select
+
+from app import db
+from .models import Setting
+
+
+class SettingsStore:
+    """
+    Bản sao trong bộ nhớ của bảng `setting`, kèm giá trị đã parse (bool, int, JSON) để đường nóng không phải
+    truy vấn DB và json.loads mỗi lần.
+    Mỗi tiến trình chỉ đọc lại dòng SETTINGS_VERSION tối đa mỗi SETTINGS_VERSION_CHECK_SECONDS giây
+    (truy vấn theo khóa chính). Khi phiên bản đổi (Setting.set_values/bump_version ở bất kỳ tiến trình nào), toàn bộ
+    bảng được nạp lại. Tiến trình vừa ghi thì bỏ cache ngay nên thấy giá trị mới tức thì.
+    Các giá trị trả về (snapshot, JSON) dùng chung giữa các luồng: chỉ đọc, không sửa.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = None
+        self._parsed = {}
+        self._version = None
+        self._next_check = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+            self._parsed = {}
+
+    def _refresh(self):
+        """
+        Trả về (cài đặt, phiên bản) đã đọc/nạp trong lúc giữ lock. Người gọi dùng giá trị trả về thay vì đọc lại
+        self._values, vì luồng khác có thể invalidate() ngay sau khi lock được nhả.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._values is not None and now < self._next_check:
+                return self._values, self._version
+            loaded_version = self._version if self._values is not None else None
+        next_check = now + current_app.config['SETTINGS_VERSION_CHECK_SECONDS']
+
+        if loaded_version is not None:
+            version = db.session.execute(select(Setting.value).where(Setting.key == Setting.VERSION_KEY)).scalar()
+            if (version or '') == loaded_version:
+                with self._lock:
+                    # Bị invalidate() trong lúc truy vấn thì nạp lại toàn bộ bên dưới
+                    if self._values is not None and self._version == loaded_version:
+                        self._next_check = next_check
+                        return self._values, self._version
+
+        values = dict(db.session.execute(select(Setting.key, Setting.value)).all())
+        with self._lock:
+            self._values = MappingProxyType(values)
+            self._parsed = {}
+            # Chưa từng ghi cài đặt nào thì chưa có dòng phiên bản: dùng chuỗi rỗng để vẫn so sánh được
+            self._version = values.get(Setting.VERSION_KEY) or ''
+            self._next_check = next_check
+            return self._values, self._version
+
+    @property
+    def version(self) -> str:
+        return self._refresh()[1]
+
+    def snapshot(self):
+        """Toàn bộ cài đặt dạng {key: value} (chỉ đọc)."""
+        return self._refresh()[0]
+
+    def get(self, key, default=None):
+        value = self.snapshot().get(key)
+        return default if value is None else value
+
+    def _get_parsed(self, key, kind, parse, default):
+        values = self.snapshot()
+        raw = values.get(key)
+        if raw is None:
+            return default
+        with self._lock:
+            if (key, kind) in self._parsed:
+                return self._parsed[(key, kind)]
+        try:
+            value = parse(raw)
+        except (TypeError, ValueError):
+            value = default
+        with self._lock:
+            # Chỉ lưu nếu chưa bị nạp lại trong lúc parse
+            if self._values is values:
+                self._parsed[(key, kind)] = value
+        return value
+
+    def get_bool(self, key, default=False) -> bool:
+        return self._get_parsed(key, 'bool', lambda raw: raw.lower() == 'true', default)
+
+    def get_int(self, key, default=None):
+        return self._get_parsed(key, 'int', int, default)
+
+    def get_json(self, key, default=None):
+        # json.JSONDecodeError là lớp con của ValueError
+        return self._get_parsed(key, 'json', json.loads, default)
+
+
+settings_store = SettingsStore()
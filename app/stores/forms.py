@@ -1,8 +1,8 @@
 # app/stores/forms.py
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, SubmitField, SelectField
-from wtforms.validators import DataRequired, Length, URL, Optional
+from wtforms import StringField, TextAreaField, SubmitField, SelectField, IntegerField
+from wtforms.validators import DataRequired, Length, URL, Optional, NumberRange
 
 class StoreForm(FlaskForm):
     """
@@ -31,6 +31,14 @@ class StoreForm(FlaskForm):
                     Length(max=255)],
         render_kw={"rows": 2}
     )
+    api_timeout_seconds = IntegerField(
+        'Timeout API (giây)',
+        validators=[Optional(), NumberRange(min=1, max=120, message="Timeout phải từ 1 đến 120 giây.")]
+    )
+    webhook_secret = StringField(
+        'Webhook Secret',
+        validators=[Optional(), Length(max=255)]
+    )
     note = TextAreaField(
         'Ghi chú', 
         validators=[Optional()],
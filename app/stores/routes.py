@@ -2,7 +2,6 @@
 
 from flask import render_template, redirect, url_for, flash, request, current_app, jsonify
 from flask_login import login_required, current_user
-from woocommerce import API
 import requests
 import json
 from datetime import datetime, timezone # Thêm import này
@@ -11,10 +10,11 @@ from . import stores_bp
 from .forms import StoreForm
 from app import db
 from app import worker
-from app.models import WooCommerceStore, AppUser, BackgroundTask
+from app.models import WooCommerceStore, AppUser, Setting
 from app.decorators import can_add_store_required
-from app.services import get_visible_stores_query, get_visible_user_ids, can_user_modify_store
-import uuid
+from app.services import get_visible_stores_query, get_visible_users_query, can_user_modify_store
+from app.services.pagination import keyset_paginate
+from app.services.woo_client import build_woo_client, invalidate_woo_client
 
 def _check_woo_connection(url, key, secret):
     """
@@ -23,13 +23,7 @@ def _check_woo_connection(url, key, secret):
     if not url or not key or not secret:
         return False, "URL, Consumer Key, và Consumer Secret không được để trống."
     try:
-        wcapi = API(
-            url=url,
-            consumer_key=key,
-            consumer_secret=secret,
-            version="wc/v3",
-            timeout=20
-        )
+        wcapi = build_woo_client(url, key, secret, current_app.config['WOO_DEFAULT_TIMEOUT'])
         response = wcapi.get("system_status")
         
         try:
@@ -54,9 +48,13 @@ def _check_woo_connection(url, key, secret):
 @stores_bp.route('/')
 @login_required
 def manage():
-    page = request.args.get('page', 1, type=int)
     base_query = get_visible_stores_query(current_user)
-    stores_pagination = base_query.order_by(WooCommerceStore.name).paginate(page=page, per_page=30)
+    stores_pagination = keyset_paginate(
+        base_query, (WooCommerceStore.name, WooCommerceStore.id),
+        lambda store: (store.name, store.id),
+        after=request.args.get('after'), before=request.args.get('before'),
+        per_page=30, descending=False, count_cap=current_app.config['LIST_COUNT_CAP']
+    )
     
     return render_template(
         'stores/manage_stores.html', 
@@ -71,8 +69,7 @@ def manage():
 def add():
     form = StoreForm()
     if current_user.is_super_admin() or current_user.is_admin():
-        visible_ids = get_visible_user_ids(current_user)
-        users_for_choices = AppUser.query.filter(AppUser.id.in_(visible_ids)).order_by(AppUser.username).all()
+        users_for_choices = get_visible_users_query(current_user).order_by(AppUser.username).all()
         form.user_id.choices = [(user.id, user.username) for user in users_for_choices]
         form.user_id.choices.insert(0, (0, 'Chưa gán'))
     else:
@@ -85,6 +82,8 @@ def add():
             store_url=form.store_url.data,
             consumer_key=form.consumer_key.data,
             consumer_secret=form.consumer_secret.data,
+            api_timeout_seconds=form.api_timeout_seconds.data,
+            webhook_secret=form.webhook_secret.data or None,
             note=form.note.data,
         )
 
@@ -100,6 +99,8 @@ def add():
                 new_store.user_id = current_user.id
         
         db.session.add(new_store)
+        # Báo cho sync engine của các tiến trình worker đọc lại danh sách cửa hàng
+        Setting.bump_version()
         db.session.commit()
         worker.add_or_update_store_job(current_app._get_current_object(), new_store.id)
         flash(f'Đã thêm cửa hàng "{new_store.name}" thành công! Hệ thống sẽ chỉ thông báo cho các đơn hàng mới kể từ bây giờ.', 'success')
@@ -118,8 +119,7 @@ def edit(store_id):
 
     form = StoreForm(obj=store)
     if current_user.is_super_admin() or current_user.is_admin():
-        visible_ids = get_visible_user_ids(current_user)
-        users_for_choices = AppUser.query.filter(AppUser.id.in_(visible_ids)).order_by(AppUser.username).all()
+        users_for_choices = get_visible_users_query(current_user).order_by(AppUser.username).all()
         form.user_id.choices = [(user.id, user.username) for user in users_for_choices]
         form.user_id.choices.insert(0, (0, 'Chưa gán'))
     else:
@@ -127,10 +127,25 @@ def edit(store_id):
             del form.user_id
         
     if form.validate_on_submit():
+        old_store_url = store.store_url
+        old_webhook_secret = store.webhook_secret
         form.populate_obj(store)
+        if store.store_url != old_store_url:
+            # Cửa hàng mới có thể xử lý `_fields` khác, cần kiểm tra lại
+            store.supports_field_projection = None
+        store.webhook_secret = store.webhook_secret or None
+        if store.breaker_state != 'closed':
+            # Người dùng vừa sửa thông tin kết nối: cho thử lại ngay ở lượt tới
+            store.breaker_next_probe_at = None
+        if store.webhook_secret != old_webhook_secret:
+            # Secret mới: chỉ tin webhook sau khi nhận được sự kiện ký bằng secret này
+            store.webhook_last_received_at = None
+            store.webhook_missed_at = None
         if 'user_id' in form and form.user_id.data == 0:
             store.user_id = None
+        Setting.bump_version()
         db.session.commit()
+        invalidate_woo_client(store.id)
         worker.add_or_update_store_job(current_app._get_current_object(), store.id)
         flash(f'Đã cập nhật cửa hàng "{store.name}"!', 'success')
         return redirect(url_for('stores.manage'))
@@ -149,7 +164,9 @@ def delete(store_id):
         flash('Bạn không có quyền xóa cửa hàng này.', 'danger')
         return redirect(url_for('stores.manage'))
     worker.remove_store_job(store_id)
+    invalidate_woo_client(store_id)
     db.session.delete(store)
+    Setting.bump_version()
     db.session.commit()
     flash(f'Đã xóa cửa hàng "{store.name}".', 'success')
     return redirect(url_for('stores.manage'))
@@ -178,13 +195,11 @@ def sync_history(store_id):
         flash('Bạn không có quyền thực hiện hành động này.', 'danger')
         return redirect(url_for('stores.manage'))
 
-    job_id = str(uuid.uuid4())
-    new_task = BackgroundTask(
-        job_id=job_id, name=f"Đồng bộ lịch sử cho: {store.name}", user_id=current_user.id
-    )
-    db.session.add(new_task)
-    db.session.commit()
-    worker.executor.submit(worker.sync_history_for_store, current_app._get_current_object(), store_id, job_id)
+    if store.is_syncing_history:
+        flash(f'Cửa hàng "{store.name}" đang được đồng bộ lịch sử.', 'warning')
+        return redirect(url_for('jobs.view'))
+
+    worker.enqueue_history_sync(store, current_user.id)
     flash(f'Đã bắt đầu tác vụ đồng bộ lịch sử cho "{store.name}".', 'success')
     return redirect(url_for('jobs.view'))
 
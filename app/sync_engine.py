@@ -0,0 +1,266 @@
+# app/sync_engine.py
+
+import asyncio
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import httpx
+from sqlalchemy.orm import load_only
+
+from .cluster import local_worker_id
+from .metrics import SCHEDULER_LAG
+from .models import WooCommerceStore
+from .services.request_governor import get_request_governor
+from .services.woo_client import AsyncWooClient
+from .settings_cache import settings_store
+
+
+class SyncEngine:
+    """
+    Bộ máy đồng bộ đơn hàng chạy trên một event loop asyncio duy nhất (trong một thread riêng).
+    Thay cho việc mỗi cửa hàng chiếm một job APScheduler: các lời gọi HTTP đều là bất đồng bộ,
+    có giới hạn đồng thời toàn cục và giới hạn theo từng host, nên một cửa hàng chậm
+    không làm các cửa hàng khác lỡ chu kỳ.
+    Phần ghi DB vẫn dùng SQLAlchemy đồng bộ và được đẩy sang thread pool qua `asyncio.to_thread`; pool này
+    là executor mặc định riêng của event loop, đủ SYNC_MAX_CONCURRENCY thread để giới hạn toàn cục là giới hạn thật.
+    Mỗi tick cũng xử lý hàng đợi webhook; cửa hàng có webhook ổn định chỉ được polling đối soát
+    theo WEBHOOK_RECONCILE_MINUTES.
+    Khi chạy nhiều worker, hash ring của WorkerMembership chỉ quyết định engine nào *thử* polling cửa hàng nào;
+    mỗi lượt chỉ chạy khi giành được lease polling của cửa hàng (worker.get_store_sync_target), nên hai engine
+    có ring lệch nhau trong lúc cụm thay đổi cũng không polling trùng.
+    """
+    def __init__(self, app, membership=None):
+        self.app = app
+        # WorkerMembership: khi chạy nhiều worker, mỗi engine chỉ polling các cửa hàng thuộc phần của mình
+        self.membership = membership
+        self.worker_id = membership.worker_id if membership else local_worker_id()
+        self.max_concurrency = app.config['SYNC_MAX_CONCURRENCY']
+        self.max_per_host = app.config['SYNC_MAX_PER_HOST']
+        self.tick_seconds = app.config['SYNC_TICK_SECONDS']
+        self.http_timeout = app.config['SYNC_HTTP_TIMEOUT']
+        self.catchup_max_pages = app.config['SYNC_CATCHUP_MAX_PAGES']
+        self.jitter = app.config['SYNC_INTERVAL_JITTER']
+        self.schedule_refresh_seconds = app.config['SYNC_SCHEDULE_REFRESH_SECONDS']
+        with app.app_context():
+            self.governor = get_request_governor()
+
+        self._thread = None
+        self._loop = None
+        self._stop_event = None
+        self._next_run = {}
+        self._last_run = {}
+        self._in_flight = set()
+        self._tasks = set()
+        self._global_limit = None
+        self._host_limits = {}
+        # Danh sách cửa hàng đang hoạt động (id, chu kỳ thích ứng, webhook ổn định) đọc từ DB lần gần nhất
+        self._schedule_rows = None
+        self._schedule_version = None
+        self._schedule_loaded_at = 0.0
+
+    # --- API dùng từ các thread khác (route, CLI) ---
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run_forever, name="sync-engine", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._loop and self._stop_event:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        self._thread = None
+
+    @property
+    def running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def request_sync(self, store_id, delay_seconds=0):
+        """Đặt lịch cho cửa hàng chạy lại sau `delay_seconds` giây (mặc định: ngay ở tick kế tiếp)."""
+        run_at = time.monotonic() + delay_seconds
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._next_run.__setitem__, store_id, run_at)
+        else:
+            self._next_run[store_id] = run_at
+
+    def invalidate_schedule(self):
+        """Đọc lại danh sách cửa hàng từ DB ở tick kế tiếp (cửa hàng vừa được thêm/sửa/xóa trong tiến trình này)."""
+        self._schedule_loaded_at = 0.0
+
+    def remove_store(self, store_id):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._next_run.pop, store_id, None)
+            self._loop.call_soon_threadsafe(self._last_run.pop, store_id, None)
+        else:
+            self._next_run.pop(store_id, None)
+            self._last_run.pop(store_id, None)
+
+    # --- Bên trong event loop ---
+
+    def _run_forever(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._global_limit = asyncio.Semaphore(self.max_concurrency)
+        self._host_limits = defaultdict(lambda: asyncio.Semaphore(self.max_per_host))
+        # Executor mặc định của loop (asyncio.to_thread dùng nó) thường chỉ có min(32, số CPU + 4) thread, ít hơn
+        # giới hạn toàn cục; thêm một thread cho phần việc mỗi tick (webhook, lịch) không phải chờ sau các cửa hàng.
+        self._loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self.max_concurrency + 1, thread_name_prefix="sync-engine-db")
+        )
+
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=self.http_timeout) as http_client:
+            self.http_client = http_client
+            print(f"--- Sync engine đã khởi động (tối đa {self.max_concurrency} cửa hàng đồng thời, {self.max_per_host}/host) ---")
+            while not self._stop_event.is_set():
+                try:
+                    await self._dispatch_due_stores()
+                except Exception as e:
+                    print(f"LỖI trong vòng lặp sync engine: {e}")
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=self.tick_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        print("--- Sync engine đã dừng ---")
+
+    def _load_store_rows(self):
+        """
+        [(store_id, chu kỳ thích ứng, webhook ổn định)] của các cửa hàng đang hoạt động. Chỉ truy vấn lại DB sau
+        SYNC_SCHEDULE_REFRESH_SECONDS, khi SETTINGS_VERSION đổi (cài đặt đổi, cửa hàng được thêm/sửa/xóa ở tiến trình
+        web) hoặc sau invalidate_schedule(); các tick khác dùng lại kết quả cũ. Phải gọi trong application context.
+        """
+        now = time.monotonic()
+        version = settings_store.version
+        if (self._schedule_rows is not None and version == self._schedule_version
+                and now - self._schedule_loaded_at < self.schedule_refresh_seconds):
+            return self._schedule_rows
+
+        stores = WooCommerceStore.query.filter_by(is_active=True).options(
+            load_only(
+                WooCommerceStore.id, WooCommerceStore.poll_interval_seconds, WooCommerceStore.webhook_secret,
+                WooCommerceStore.webhook_last_received_at, WooCommerceStore.webhook_missed_at
+            )
+        ).all()
+        self._schedule_rows = [(store.id, store.poll_interval_seconds, store.webhook_healthy) for store in stores]
+        self._schedule_version = version
+        self._schedule_loaded_at = now
+        return self._schedule_rows
+
+    def _load_schedule(self):
+        """
+        Trả về {store_id: chu kỳ (giây)}. Chu kỳ của từng cửa hàng do worker tính từ nhịp đơn;
+        tổng số lượt gọi được giữ không vượt ngân sách như khi mọi cửa hàng dùng chung CHECK_INTERVAL_MINUTES.
+        Lọc theo hash ring được làm lại mỗi tick (trong bộ nhớ) vì ring có thể đổi giữa hai lần đọc DB.
+        """
+        from . import worker
+        with self.app.app_context():
+            base_seconds = worker.get_check_interval_seconds()
+            rows = self._load_store_rows()
+        reconcile_seconds = max(base_seconds, self.app.config['WEBHOOK_RECONCILE_MINUTES'] * 60)
+        max_seconds = self.app.config['SYNC_MAX_INTERVAL_SECONDS']
+
+        if self.membership:
+            rows = [row for row in rows if self.membership.owns(row[0])]
+
+        intervals, adaptive = {}, {}
+        for store_id, poll_interval_seconds, webhook_healthy in rows:
+            if webhook_healthy:
+                intervals[store_id] = reconcile_seconds
+            else:
+                adaptive[store_id] = poll_interval_seconds or base_seconds
+
+        # Số lượt gọi/giây mà các cửa hàng thích ứng đòi hỏi so với ngân sách len(adaptive) / base_seconds
+        demand = sum(1 / seconds for seconds in adaptive.values())
+        budget = len(adaptive) / base_seconds
+        scale = demand / budget if budget and demand > budget else 1
+        for store_id, seconds in adaptive.items():
+            intervals[store_id] = min(max_seconds, seconds * scale) if scale > 1 else seconds
+        return intervals
+
+    async def _dispatch_due_stores(self):
+        from . import worker
+        # Webhook đã nhận được xử lý trước, để polling đối soát không tính nhầm chúng là "bị bỏ sót"
+        await asyncio.to_thread(worker.drain_webhook_events, self.app)
+
+        intervals = await asyncio.to_thread(self._load_schedule)
+        now = time.monotonic()
+
+        for store_id in list(self._next_run):
+            if store_id not in intervals:
+                self._next_run.pop(store_id, None)
+                self._last_run.pop(store_id, None)
+        for store_id, interval_seconds in intervals.items():
+            if store_id not in self._next_run:
+                # Rải lần chạy đầu tiên trong một chu kỳ để các cửa hàng không cùng bắn một lúc
+                self._next_run[store_id] = now + random.uniform(0, interval_seconds)
+            elif store_id in self._last_run:
+                # Chu kỳ có thể ngắn lại (đổi cài đặt, webhook mất ổn định): không bắt chờ hết chu kỳ cũ
+                self._next_run[store_id] = min(self._next_run[store_id], self._last_run[store_id] + interval_seconds)
+
+        for store_id, run_at in list(self._next_run.items()):
+            if run_at <= now and store_id not in self._in_flight:
+                SCHEDULER_LAG.observe(now - run_at)
+                self._in_flight.add(store_id)
+                self._last_run[store_id] = now
+                # Jitter quanh chu kỳ để các cửa hàng cùng chu kỳ không bắn đồng loạt
+                self._next_run[store_id] = now + intervals[store_id] * random.uniform(1 - self.jitter, 1 + self.jitter)
+                task = asyncio.create_task(self._sync_store(store_id))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _sync_store(self, store_id):
+        from . import worker
+        try:
+            async with self._global_limit:
+                target = await asyncio.to_thread(worker.get_store_sync_target, self.app, store_id, self.worker_id)
+                if not target:
+                    return
+
+                host = urlparse(target['store_url']).netloc
+                client = AsyncWooClient(
+                    self.http_client, target['store_url'], target['consumer_key'], target['consumer_secret'],
+                    timeout=target['timeout'], governor=self.governor
+                )
+                cursor = target['cursor']
+                new_count = updated_count = 0
+                failed = False
+                error = None
+                started_at = time.perf_counter()
+
+                # Đi theo con trỏ tới khi hết đơn hoặc hết ngân sách trang của lượt này
+                try:
+                    for _ in range(self.catchup_max_pages):
+                        async with self._host_limits[host]:
+                            response = await client.get("orders", params=cursor.next_params())
+                        counts = await asyncio.to_thread(worker.apply_catch_up_page, self.app, store_id, cursor, response.json())
+                        if counts is None:
+                            failed = True
+                            break
+                        new_count += counts[0]
+                        updated_count += counts[1]
+                        if cursor.drained:
+                            break
+                except Exception as e:
+                    # Lỗi phía cửa hàng (timeout, 5xx, JSON hỏng, lỗi API): tính vào circuit breaker
+                    error = e
+
+                await asyncio.to_thread(
+                    worker.finish_sync_run, self.app, store_id, self.worker_id, new_count, updated_count, cursor,
+                    not failed, error, time.perf_counter() - started_at
+                )
+                if not cursor.drained and not failed and error is None:
+                    # Còn tồn đọng: xếp lại ngay, nhưng phải chờ sau các cửa hàng khác đang đợi slot
+                    self.request_sync(store_id)
+        except Exception as e:
+            print(f"LỖI nghiêm trọng khi đồng bộ cửa hàng ID {store_id}: {e}")
+        finally:
+            self._in_flight.discard(store_id)
@@ -0,0 +1,203 @@
+# app/task_queue.py
+
+import json
+import os
+import random
+import socket
+import threading
+import traceback
+import uuid
+from datetime import datetime, timezone, timedelta
+
+from flask import current_app
+from sqlalchemy import select, update, or_, and_
+
+from app import db
+from .models import BackgroundTask
+
+# task_type -> hàm xử lý handler(app, job_id, payload)
+_task_handlers = {}
+
+
+def register_task_handler(task_type, handler):
+    _task_handlers[task_type] = handler
+
+
+def enqueue_task(task_type, name, payload=None, user_id=None, store_id=None, priority=0, max_attempts=None):
+    """
+    Đưa một tác vụ vào hàng đợi `background_task`. Tác vụ sẽ được một tiến trình `flask run-tasks`
+    (hoặc runner trong tiến trình dev) nhận và chạy. Priority lớn hơn được chạy trước.
+    """
+    task = BackgroundTask(
+        job_id=str(uuid.uuid4()),
+        name=name,
+        task_type=task_type,
+        payload=json.dumps(payload or {}),
+        user_id=user_id,
+        store_id=store_id,
+        priority=priority,
+        max_attempts=max_attempts or current_app.config['TASK_MAX_ATTEMPTS'],
+        status='queued',
+    )
+    db.session.add(task)
+    db.session.commit()
+    return task
+
+
+def touch_task(task):
+    """Heartbeat của tác vụ đang chạy: lùi visibility timeout để runner khác không nhận lại. Không commit."""
+    now = datetime.now(timezone.utc)
+    task.heartbeat_at = now
+    task.locked_until = now + timedelta(seconds=current_app.config['TASK_VISIBILITY_TIMEOUT_SECONDS'])
+
+
+def claim_task(worker_id):
+    """
+    Nhận một tác vụ bằng `SELECT ... FOR UPDATE SKIP LOCKED`: tác vụ 'queued' đã tới hạn, hoặc tác vụ
+    'running' đã quá visibility timeout (runner cũ đã chết). Trả về (job_id, task_type, payload) hoặc None.
+    """
+    now = datetime.now(timezone.utc)
+    table = BackgroundTask.__table__
+    claimable = (
+        select(table.c.id)
+        .where(
+            table.c.task_type.isnot(None),
+            or_(
+                and_(table.c.status == 'queued', or_(table.c.run_after.is_(None), table.c.run_after <= now)),
+                and_(table.c.status == 'running', table.c.locked_until < now),
+            )
+        )
+        .order_by(table.c.priority.desc(), table.c.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    claimed = db.session.execute(
+        update(table)
+        .where(table.c.id == claimable.scalar_subquery())
+        .values(
+            status='running',
+            attempts=table.c.attempts + 1,
+            locked_by=worker_id,
+            locked_until=now + timedelta(seconds=current_app.config['TASK_VISIBILITY_TIMEOUT_SECONDS']),
+            heartbeat_at=now,
+        )
+        .returning(table.c.job_id, table.c.task_type, table.c.payload)
+    ).first()
+    db.session.commit()
+    return claimed
+
+
+def _sweep_cancelling_tasks():
+    """Tác vụ đang chờ hủy mà runner đã chết (quá visibility timeout) được đóng lại là 'cancelled'."""
+    now = datetime.now(timezone.utc)
+    table = BackgroundTask.__table__
+    db.session.execute(
+        update(table)
+        .where(table.c.status == 'cancelling', table.c.locked_until < now)
+        .values(status='cancelled', end_time=now, locked_by=None, locked_until=None)
+    )
+    db.session.commit()
+
+
+def _finish_task(job_id, error=None):
+    """
+    Sau khi handler kết thúc: handler tự đặt trạng thái cuối (complete/failed/cancelled).
+    Tác vụ chưa ở trạng thái cuối mà đã bị yêu cầu hủy (kể cả khi handler thoát sớm không chạy gì) được đóng là
+    'cancelled' ngay: bỏ lock thì _sweep_cancelling_tasks không còn nhặt được nó nữa.
+    Nếu handler ném lỗi, tác vụ được xếp lại với backoff lũy thừa cho tới khi hết `max_attempts`.
+    """
+    task = BackgroundTask.query.filter_by(job_id=job_id).first()
+    if not task:
+        return
+    now = datetime.now(timezone.utc)
+    task.locked_by = None
+    task.locked_until = None
+
+    finished = task.status in ('complete', 'failed', 'cancelled')
+    if not finished and (task.status == 'cancelling' or task.requested_cancellation):
+        task.status = 'cancelled'
+        task.end_time = now
+    elif error is not None:
+        if task.attempts < task.max_attempts:
+            delay = current_app.config['TASK_RETRY_BASE_SECONDS'] * 2 ** (task.attempts - 1)
+            task.status = 'queued'
+            task.run_after = now + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+            task.log = f"Lần thử {task.attempts}/{task.max_attempts} lỗi, sẽ thử lại sau ~{int(delay)} giây: {str(error)[:400]}"
+        else:
+            task.status = 'failed'
+            task.log = f"Lỗi sau {task.attempts} lần thử: {str(error)[:500]}"
+            task.end_time = now
+    elif task.status == 'running':
+        # Handler trả về mà không đặt trạng thái cuối (ví dụ tác vụ đang được chạy ở tiến trình khác): xem lại sau
+        task.status = 'queued'
+        task.run_after = now + timedelta(seconds=current_app.config['TASK_VISIBILITY_TIMEOUT_SECONDS'])
+    db.session.commit()
+
+
+def run_next_task(app, worker_id):
+    """Nhận và chạy một tác vụ. Trả về False nếu hàng đợi trống."""
+    with app.app_context():
+        _sweep_cancelling_tasks()
+        claimed = claim_task(worker_id)
+    if not claimed:
+        return False
+
+    handler = _task_handlers.get(claimed.task_type)
+    error = None
+    try:
+        if handler is None:
+            raise LookupError(f"Không có handler cho loại tác vụ '{claimed.task_type}'")
+        handler(app, claimed.job_id, json.loads(claimed.payload or '{}'))
+    except Exception as e:
+        print(f"LỖI khi chạy tác vụ {claimed.job_id} ({claimed.task_type}): {e}")
+        traceback.print_exc()
+        error = e
+
+    with app.app_context():
+        try:
+            _finish_task(claimed.job_id, error)
+        except Exception as e:
+            db.session.rollback()
+            print(f"LỖI khi cập nhật trạng thái tác vụ {claimed.job_id}: {e}")
+    return True
+
+
+class TaskRunner:
+    """
+    Chạy `concurrency` thread, mỗi thread lặp: nhận tác vụ từ hàng đợi Postgres, chạy, rồi nhận tiếp.
+    Nhiều tiến trình (trên nhiều máy) có thể cùng chạy TaskRunner trên một database.
+    """
+    def __init__(self, app, concurrency=None):
+        self.app = app
+        self.concurrency = concurrency or app.config['TASK_WORKER_CONCURRENCY']
+        self.poll_seconds = app.config['TASK_POLL_SECONDS']
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.concurrency):
+            thread = threading.Thread(target=self._loop, args=(f"{self.worker_id}:{index}",), name=f"task-runner-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"--- Task runner {self.worker_id} đã khởi động ({self.concurrency} luồng) ---")
+
+    def stop(self, timeout=10):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    def wait(self):
+        while any(thread.is_alive() for thread in self._threads):
+            for thread in self._threads:
+                thread.join(timeout=1)
+
+    def _loop(self, worker_id):
+        while not self._stop_event.is_set():
+            try:
+                if run_next_task(self.app, worker_id):
+                    continue
+            except Exception as e:
+                print(f"LỖI trong task runner {worker_id}: {e}")
+            self._stop_event.wait(self.poll_seconds)
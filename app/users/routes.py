@@ -5,7 +5,9 @@ from flask_login import current_user, login_required
 from . import users_bp
 from .forms import UserManagementForm
 from app import db
-from app.models import AppUser, WooCommerceStore
+from app.models import AppUser, Setting, WooCommerceStore
+from app.notifications import invalidate_recipient_plans
+from app.services import invalidate_visibility_cache
 from app.decorators import admin_or_super_admin_required, super_admin_required
 
 @users_bp.route('/')
@@ -52,6 +54,7 @@ def add():
 
         db.session.add(new_user)
         db.session.commit()
+        invalidate_visibility_cache()
         flash(f'Đã tạo người dùng "{new_user.username}" thành công!', 'success')
         return redirect(url_for('users.manage'))
 
@@ -97,7 +100,10 @@ def edit(user_id):
         user_to_edit.can_delete_store = form.can_delete_store.data
         user_to_edit.can_view_orders = form.can_view_orders.data
 
+        Setting.bump_version()
         db.session.commit()
+        invalidate_recipient_plans()
+        invalidate_visibility_cache()
         flash(f'Đã cập nhật thông tin cho người dùng "{user_to_edit.username}".', 'success')
         return redirect(url_for('users.manage'))
     
@@ -133,7 +139,10 @@ def delete(user_id):
         child.parent_id = None
         
     db.session.delete(user_to_delete)
+    Setting.bump_version()
     db.session.commit()
+    invalidate_recipient_plans()
+    invalidate_visibility_cache()
     flash(f'Đã xóa người dùng "{username}" và các liên kết.', 'success')
     return redirect(url_for('users.manage'))
 
@@ -170,6 +179,9 @@ def delete_selected():
         db.session.delete(user_to_delete)
         deleted_count += 1
         
+    Setting.bump_version()
     db.session.commit()
+    invalidate_recipient_plans()
+    invalidate_visibility_cache()
     flash(f'Đã xóa thành công {deleted_count} người dùng.', 'success')
     return jsonify({'status': 'success'})
\ No newline at end of file
@@ -0,0 +1,10 @@
+# app/webhooks/__init__.py
+
+from flask import Blueprint
+
+# Tạo một Blueprint tên là 'webhooks'.
+# Nhận webhook từ WooCommerce, không yêu cầu đăng nhập (xác thực bằng chữ ký HMAC).
+webhooks_bp = Blueprint('webhooks', __name__)
+
+# Import file routes của module webhooks để đăng ký các route vào blueprint này.
+from . import routes
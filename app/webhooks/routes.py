@@ -0,0 +1,63 @@
+# app/webhooks/routes.py
+
+import json
+from datetime import datetime, timezone
+
+from flask import request, jsonify, current_app
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from . import webhooks_bp
+from app import db
+from app.models import WooCommerceStore, WebhookEvent
+from app.services.webhook_signature import verify_webhook_signature
+
+# Chỉ các topic này được đưa vào hàng đợi; topic khác vẫn trả 200 để WooCommerce không tự tắt webhook
+ORDER_WEBHOOK_TOPICS = ('order.created', 'order.updated')
+
+
+@webhooks_bp.route('/woocommerce/<int:store_id>', methods=['POST'])
+def woocommerce(store_id):
+    """
+    Nhận webhook đơn hàng từ WooCommerce. Payload chỉ được lưu vào bảng `webhook_event`
+    rồi trả lời ngay; việc ghi đơn và gửi thông báo do sync engine đảm nhận.
+    """
+    store = db.session.get(WooCommerceStore, store_id)
+    if not store or not store.webhook_secret:
+        return jsonify({'error': 'not found'}), 404
+
+    topic = request.headers.get('X-WC-Webhook-Topic')
+    if not topic:
+        # WooCommerce gửi ping "webhook_id=<id>" (không có chữ ký) khi webhook vừa được tạo
+        if request.form.get('webhook_id'):
+            return jsonify({'status': 'pong'}), 200
+        return jsonify({'error': 'missing topic'}), 400
+
+    body = request.get_data()
+    if not verify_webhook_signature(store.webhook_secret, body, request.headers.get('X-WC-Webhook-Signature')):
+        current_app.logger.warning(f"Webhook sai chữ ký cho cửa hàng ID {store_id} (topic: {topic}).")
+        return jsonify({'error': 'invalid signature'}), 401
+
+    if topic not in ORDER_WEBHOOK_TOPICS:
+        return jsonify({'status': 'ignored'}), 200
+
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return jsonify({'error': 'invalid json'}), 400
+    if not isinstance(payload, dict) or 'id' not in payload:
+        return jsonify({'error': 'invalid payload'}), 400
+
+    now = datetime.now(timezone.utc)
+    # WooCommerce gửi lại cùng Delivery-ID khi retry: bỏ qua bản trùng
+    stmt = pg_insert(WebhookEvent.__table__).values(
+        store_id=store_id,
+        topic=topic,
+        delivery_id=request.headers.get('X-WC-Webhook-Delivery-ID'),
+        payload=body.decode('utf-8'),
+        received_at=now,
+        attempts=0,
+    ).on_conflict_do_nothing(constraint='_store_delivery_uc')
+    db.session.execute(stmt)
+    store.webhook_last_received_at = now
+    db.session.commit()
+    return jsonify({'status': 'queued'}), 202
@@ -1,24 +1,47 @@
 # app/worker.py
 
 import atexit
-import asyncio
 from datetime import datetime, timezone, timedelta
 import json
-from woocommerce import API
-from apscheduler.schedulers.background import BackgroundScheduler
 from flask import current_app
+from sqlalchemy import insert, update, delete, select, literal_column, bindparam, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import html
+import queue
 import re
+import threading
+import time
 
 from app import db
-from .models import WooCommerceStore, WooCommerceOrder, Setting, BackgroundTask, OrderLineItem
-from .notifications import send_telegram_message, escape_markdown_v2
+from .metrics import count_synced_orders, observe_sync_run, start_worker_metrics_server
+from .models import WooCommerceStore, WooCommerceOrder, BackgroundTask, OrderLineItem, WebhookEvent
+from .notifications import enqueue_notifications, escape_markdown_v2
+from .services.order_search import build_search_document, phone_digits
+from .services.product_cache import get_product_details
+from .settings_cache import settings_store
+from .services.request_governor import breaker_allows, record_breaker_success, record_breaker_failure
+from .services.woo_client import WooApiError, WooClient, get_woo_client, get_store_timeout
+from .cluster import WorkerMembership, local_worker_id
+from .notification_dispatcher import NotificationDispatcher
+from .sync_engine import SyncEngine
+from .task_queue import TaskRunner, enqueue_task, register_task_handler, touch_task
 
-scheduler = BackgroundScheduler(daemon=True, timezone="UTC")
-executor = ThreadPoolExecutor(max_workers=2)
+engine = None
+task_runner = None
+membership = None
+dispatcher = None
 
-def _extract_order_details(order_data: dict, wcapi: API, should_fetch_images: bool) -> dict:
+# Các trường đơn hàng mà _extract_order_details thực sự dùng. Gửi qua `_fields` để WooCommerce
+# bỏ meta_data cấp đơn, _links, tax_lines, coupon_lines... khỏi mỗi trang 100 đơn.
+ORDER_SYNC_FIELDS = (
+    'id', 'status', 'currency', 'total', 'shipping_total', 'customer_note', 'payment_method_title',
+    'date_created_gmt', 'date_modified_gmt', 'billing', 'shipping', 'line_items',
+)
+
+def _extract_order_details(order_data: dict, product_details: dict) -> dict:
+    """`product_details` là kết quả của `get_product_details` (rỗng nếu không lấy ảnh sản phẩm)."""
     line_items_data = []
     for item in order_data.get('line_items', []):
         variation_values = []
@@ -32,14 +55,7 @@ def _extract_order_details(order_data: dict, wcapi: API, should_fetch_images: bo
         
         variations_json = json.dumps(variation_values) if variation_values else None
         
-        image_url = None
-        if should_fetch_images and item.get('product_id'):
-            try:
-                product_data = wcapi.get(f"products/{item.get('product_id')}").json()
-                if product_data and product_data.get('images'):
-                    image_url = product_data['images'][0].get('src')
-            except Exception as e:
-                print(f"Không thể lấy ảnh cho sản phẩm ID {item.get('product_id')}: {e}")
+        image_url = product_details.get(item.get('product_id'), {}).get('image')
 
         line_items_data.append({
             'wc_line_item_id': item.get('id'),
@@ -73,17 +89,22 @@ def _extract_order_details(order_data: dict, wcapi: API, should_fetch_images: bo
         "billing_address": format_address(order_data.get('billing')),
         "shipping_address": format_address(order_data.get('shipping')),
     }
+    order_level_data['content_hash'] = _order_fingerprint(order_level_data, line_items_data)
+    # Suy ra từ các trường đã có trong fingerprint nên thêm sau khi tính hash
+    order_level_data['search_document'] = build_search_document(order_level_data, line_items_data)
+    order_level_data['billing_phone_digits'] = phone_digits(order_level_data['billing_phone']) or None
     
     return {'order': order_level_data, 'line_items': line_items_data}
 
 def format_products_for_notification(line_items) -> str:
+    """`line_items` là danh sách dict line item như `_extract_order_details` trả về."""
     if not line_items: return "- Không có sản phẩm."
     lines = []
     for item in line_items:
-        escaped_name = escape_markdown_v2(item.product_name)
-        line = f"\\- {escaped_name} \\(SL: {item.quantity}\\)"
+        escaped_name = escape_markdown_v2(item['product_name'])
+        line = f"\\- {escaped_name} \\(SL: {item['quantity']}\\)"
         
-        variations = item.variations_list
+        variations = json.loads(item['variations']) if item.get('variations') else []
         variations_str = ", ".join(variations)
         if variations_str:
             safe_variations_for_code = variations_str.replace('`', "'")
@@ -91,236 +112,961 @@ def format_products_for_notification(line_items) -> str:
         lines.append(line)
     return "\n".join(lines)
 
+LINE_ITEM_COLUMNS = ('wc_line_item_id', 'product_name', 'quantity', 'sku', 'price', 'image_url', 'variations')
+
+def _line_item_row(item_data: dict) -> dict:
+    return {key: value for key, value in item_data.items() if key != 'product_id'}
+
+def _order_fingerprint(order_level_data: dict, line_items_data: list) -> str:
+    """
+    Dấu vân tay nội dung của đơn hàng trên các trường đã chuẩn hóa mà ta lưu.
+    Bỏ qua `order_modified_at` để các lần sửa chỉ-meta bên WooCommerce không bị coi là thay đổi.
+    """
+    payload = {
+        'order': {key: value for key, value in order_level_data.items() if key not in ('order_modified_at', 'content_hash')},
+        'line_items': sorted((_line_item_row(item) for item in line_items_data), key=lambda item: item['wc_line_item_id'] or 0),
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+def _diff_line_items(order_id: int, existing_items: list, new_items: list):
+    """
+    So khớp line item theo `wc_line_item_id`: trả về (dòng cần INSERT, dòng cần UPDATE, id cần DELETE)
+    thay vì xóa hết rồi chèn lại.
+    """
+    existing_by_wc_id = {}
+    to_delete = []
+    for item in existing_items:
+        if item.wc_line_item_id in existing_by_wc_id:
+            to_delete.append(item.id)
+        else:
+            existing_by_wc_id[item.wc_line_item_id] = item
+
+    to_insert, to_update = [], []
+    for item_data in new_items:
+        row = _line_item_row(item_data)
+        current = existing_by_wc_id.pop(row['wc_line_item_id'], None)
+        if current is None:
+            to_insert.append({'order_id': order_id, **row})
+        elif any(getattr(current, key) != row[key] for key in LINE_ITEM_COLUMNS):
+            to_update.append({'b_id': current.id, **{f'b_{key}': row[key] for key in LINE_ITEM_COLUMNS}})
+
+    to_delete.extend(item.id for item in existing_by_wc_id.values())
+    return to_insert, to_update, to_delete
+
+def _bulk_write_orders(store_id: int, details_list: list, update_existing: bool = True) -> list:
+    """
+    Ghi cả một trang đơn hàng bằng ít câu lệnh nhất có thể:
+    - Một truy vấn lấy `content_hash` hiện có; đơn không đổi nội dung được bỏ qua hoàn toàn.
+    - Đơn hàng: một lệnh `INSERT ... ON CONFLICT (wc_order_id, store_id)` (ràng buộc `_wc_order_store_uc`).
+      Với `update_existing=False` (đồng bộ lịch sử) đơn đã tồn tại được giữ nguyên.
+    - Line item: đơn mới được chèn bằng một lệnh INSERT nhiều dòng; đơn cập nhật được so khớp
+      theo `wc_line_item_id` và chỉ ghi các dòng thực sự thay đổi.
+    Không commit. Trả về danh sách (full_details, is_new) của các đơn đã được ghi.
+    """
+    details_by_wc_id = {details['order']['wc_order_id']: details for details in details_list}
+    if not details_by_wc_id:
+        return []
+
+    order_table = WooCommerceOrder.__table__
+    item_table = OrderLineItem.__table__
+
+    existing_hashes = dict(db.session.execute(
+        select(order_table.c.wc_order_id, order_table.c.content_hash)
+        .where(order_table.c.store_id == store_id, order_table.c.wc_order_id.in_(details_by_wc_id.keys()))
+    ).all())
+    changed = [
+        details for wc_order_id, details in details_by_wc_id.items()
+        if wc_order_id not in existing_hashes
+        or (update_existing and existing_hashes[wc_order_id] != details['order']['content_hash'])
+    ]
+    skipped = len(details_by_wc_id) - len(changed)
+    if skipped:
+        print(f"Bỏ qua {skipped} đơn không thay đổi nội dung (cửa hàng ID {store_id}).")
+    if not changed:
+        return []
+
+    order_rows = [{'store_id': store_id, **details['order']} for details in changed]
+    stmt = pg_insert(order_table).values(order_rows)
+    if update_existing:
+        stmt = stmt.on_conflict_do_update(
+            constraint='_wc_order_store_uc',
+            set_={key: stmt.excluded[key] for key in order_rows[0] if key not in ('store_id', 'wc_order_id')},
+            # Webhook có thể tới trễ hơn polling: không ghi đè bản mới hơn bằng payload cũ
+            where=or_(
+                order_table.c.order_modified_at.is_(None),
+                stmt.excluded.order_modified_at.is_(None),
+                order_table.c.order_modified_at <= stmt.excluded.order_modified_at
+            )
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(constraint='_wc_order_store_uc')
+    # xmax = 0 chỉ đúng với dòng vừa được INSERT (không phải UPDATE do xung đột)
+    stmt = stmt.returning(order_table.c.id, order_table.c.wc_order_id, literal_column('xmax = 0').label('is_new'))
+    written = db.session.execute(stmt).all()
+    if not written:
+        return []
+
+    items_to_insert, items_to_update, items_to_delete = [], [], []
+    updated_order_ids = [row.id for row in written if not row.is_new]
+    existing_items_by_order = {}
+    if updated_order_ids:
+        existing_rows = db.session.execute(
+            select(item_table.c.id, item_table.c.order_id, *[item_table.c[key] for key in LINE_ITEM_COLUMNS])
+            .where(item_table.c.order_id.in_(updated_order_ids))
+        ).all()
+        for item in existing_rows:
+            existing_items_by_order.setdefault(item.order_id, []).append(item)
+
+    for row in written:
+        new_items = details_by_wc_id[row.wc_order_id]['line_items']
+        to_insert, to_update, to_delete = _diff_line_items(row.id, existing_items_by_order.get(row.id, []), new_items)
+        items_to_insert.extend(to_insert)
+        items_to_update.extend(to_update)
+        items_to_delete.extend(to_delete)
+
+    if items_to_delete:
+        db.session.execute(delete(item_table).where(item_table.c.id.in_(items_to_delete)))
+    if items_to_update:
+        db.session.execute(
+            update(item_table)
+            .where(item_table.c.id == bindparam('b_id'))
+            .values({key: bindparam(f'b_{key}') for key in LINE_ITEM_COLUMNS}),
+            items_to_update
+        )
+    if items_to_insert:
+        db.session.execute(insert(item_table).values(items_to_insert))
+
+    return [(details_by_wc_id[row.wc_order_id], bool(row.is_new)) for row in written]
+
+def _write_orders_individually(store_id: int, details_list: list, update_existing: bool = True, on_new_orders=None) -> list:
+    """Đường dự phòng: ghi từng đơn một, mỗi đơn một transaction để lỗi của một đơn không ảnh hưởng các đơn khác."""
+    written = []
+    for full_details in details_list:
+        wc_order_id = full_details['order']['wc_order_id']
+        try:
+            existing_order = WooCommerceOrder.query.filter_by(wc_order_id=wc_order_id, store_id=store_id).first()
+
+            if existing_order:
+                if not update_existing or existing_order.content_hash == full_details['order']['content_hash']:
+                    continue
+                incoming_modified_at = full_details['order'].get('order_modified_at')
+                if existing_order.order_modified_at and incoming_modified_at and incoming_modified_at < existing_order.order_modified_at:
+                    continue
+                for key, value in full_details['order'].items():
+                    setattr(existing_order, key, value)
+                existing_items = {}
+                for item in existing_order.line_items:
+                    if item.wc_line_item_id in existing_items:
+                        db.session.delete(item)
+                    else:
+                        existing_items[item.wc_line_item_id] = item
+                for item_data in full_details['line_items']:
+                    row = _line_item_row(item_data)
+                    current = existing_items.pop(row['wc_line_item_id'], None)
+                    if current is None:
+                        db.session.add(OrderLineItem(order=existing_order, **row))
+                    else:
+                        for key, value in row.items():
+                            setattr(current, key, value)
+                for leftover in existing_items.values():
+                    db.session.delete(leftover)
+            else:
+                new_order = WooCommerceOrder(store_id=store_id, **full_details['order'])
+                db.session.add(new_order)
+                for item_data in full_details['line_items']:
+                    db.session.add(OrderLineItem(order=new_order, **_line_item_row(item_data)))
+                if on_new_orders:
+                    on_new_orders([full_details])
+
+            db.session.commit()
+            written.append((full_details, existing_order is None))
+        except Exception as single_order_error:
+            print(f"LỖI khi xử lý đơn hàng WC_ID {wc_order_id}: {single_order_error}")
+            db.session.rollback()
+    return written
+
+def _ingest_order_batch(store_id: int, details_list: list, update_existing: bool = True, on_new_orders=None) -> list:
+    """
+    Ghi một trang đơn hàng trong một transaction; nếu thất bại thì lùi về ghi từng đơn.
+    `on_new_orders(list)` (nếu có) được gọi với các đơn mới trước khi commit, để thông báo vào outbox cùng transaction.
+    """
+    if not details_list:
+        return []
+    try:
+        written = _bulk_write_orders(store_id, details_list, update_existing)
+        new_orders = [full_details for full_details, is_new in written if is_new]
+        if on_new_orders and new_orders:
+            on_new_orders(new_orders)
+        db.session.commit()
+        return written
+    except Exception as batch_error:
+        db.session.rollback()
+        print(f"LỖI khi ghi hàng loạt {len(details_list)} đơn cho cửa hàng ID {store_id}, chuyển sang ghi từng đơn: {batch_error}")
+        return _write_orders_individually(store_id, details_list, update_existing, on_new_orders)
+
+def _extract_page_details(orders_page: list, store_id: int, wcapi: WooClient, should_fetch_images: bool) -> list:
+    product_details = {}
+    if should_fetch_images:
+        product_ids = {item.get('product_id') for order_data in orders_page for item in order_data.get('line_items', [])}
+        product_details = get_product_details(store_id, wcapi, product_ids)
+
+    details_list = []
+    for order_data in orders_page:
+        try:
+            details_list.append(_extract_order_details(order_data, product_details))
+        except Exception as extract_error:
+            print(f"LỖI khi đọc dữ liệu đơn hàng WC_ID {order_data.get('id')}: {extract_error}")
+    return details_list
+
+HISTORY_PAGE_SIZE = 100
+HISTORY_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def _history_windows(oldest: datetime, newest: datetime, total_orders: int, orders_per_window: int) -> list:
+    """
+    Chia vòng đời cửa hàng thành các cửa sổ thời gian đều nhau, số cửa sổ suy từ X-WP-Total.
+    Mỗi cửa sổ là khoảng nửa mở (after, before] theo ngày tạo (GMT, tới giây); hai cửa sổ kề nhau dùng chung
+    một mốc nên mỗi đơn thuộc đúng một cửa sổ. Cửa sổ đầu bắt đầu từ 1 giây trước đơn cũ nhất.
+    Trả về trạng thái ban đầu của từng cửa sổ, cũng là phần `windows` của checkpoint.
+    """
+    window_count = max(1, -(-total_orders // orders_per_window))
+    span = (newest - oldest) / window_count
+    boundaries = [oldest - timedelta(seconds=1)] + [oldest + span * i for i in range(1, window_count)] + [newest]
+    boundaries = [boundary.replace(microsecond=0).strftime(HISTORY_DATE_FORMAT) for boundary in boundaries]
+    return [
+        {
+            'after': boundaries[i],
+            'before': boundaries[i + 1],
+            'next_page': 1, 'synced': 0, 'total': None, 'done': False,
+        }
+        for i in range(window_count)
+    ]
+
+def _in_history_window(order_data: dict, window: dict) -> bool:
+    """Đơn có thuộc cửa sổ (after, before] không, xét theo date_created_gmt tới giây."""
+    created = order_data.get('date_created_gmt')
+    if not created:
+        return True
+    created = datetime.fromisoformat(created).replace(microsecond=0, tzinfo=None)
+    after = datetime.strptime(window['after'], HISTORY_DATE_FORMAT)
+    before = datetime.strptime(window['before'], HISTORY_DATE_FORMAT)
+    return after < created <= before
+
+def _fetch_history_window(wcapi: WooClient, base_params: dict, index: int, window: dict, results, stop_event):
+    """
+    Chạy trong thread pool: tải tuần tự các trang của một cửa sổ (từ `next_page`) và đẩy sang writer qua hàng đợi.
+    Tham số `before` của WooCommerce là "nhỏ hơn" nên được đẩy thêm 1 giây để lấy cả mốc `before`; đơn dư ra
+    (nếu phiên bản WooCommerce so sánh bao gồm) bị writer lọc bằng _in_history_window.
+    """
+    page = window['next_page']
+    before = (datetime.strptime(window['before'], HISTORY_DATE_FORMAT) + timedelta(seconds=1)).strftime(HISTORY_DATE_FORMAT)
+    try:
+        while not stop_event.is_set():
+            params = dict(base_params, page=page, after=window['after'], before=before)
+            # Thử lại (backoff, Retry-After) do RequestGovernor của wcapi đảm nhận; trang vẫn lỗi thì cả cửa sổ
+            # vào failed_windows và hàng đợi tác vụ chạy lại từ checkpoint
+            response = wcapi.get("orders", params=params)
+            orders_page = response.json()
+            if not isinstance(orders_page, list):
+                raise ValueError(orders_page.get('message', orders_page) if isinstance(orders_page, dict) else orders_page)
+            window_total = int(response.headers.get('X-WP-Total', 0))
+            results.put(('page', index, (page, orders_page), window_total))
+            if len(orders_page) < HISTORY_PAGE_SIZE:
+                results.put(('done', index, None, None))
+                return
+            page += 1
+    except Exception as e:
+        results.put(('error', index, e, None))
+    results.put(('stopped', index, None, None))
+
+def _history_log(windows: list) -> str:
+    done = sum(1 for window in windows if window['done'])
+    running = [
+        f"#{index + 1}: {window['synced']}/{window['total'] if window['total'] is not None else '?'}"
+        for index, window in enumerate(windows) if not window['done'] and window['synced']
+    ]
+    log = f"Đã xong {done}/{len(windows)} cửa sổ thời gian."
+    if running:
+        log += " Đang chạy " + ", ".join(running[:10])
+    return log
+
+def _acquire_history_lease(store_id: int, job_id: str) -> bool:
+    """Giành lease đồng bộ lịch sử của cửa hàng (nguyên tử). Lease hết hạn của tác vụ đã chết được lấy lại."""
+    now = datetime.now(timezone.utc)
+    store_table = WooCommerceStore.__table__
+    acquired = db.session.execute(
+        update(store_table)
+        .where(
+            store_table.c.id == store_id,
+            or_(store_table.c.history_lease_until.is_(None), store_table.c.history_lease_until < now)
+        )
+        .values(history_lease_until=now + timedelta(seconds=current_app.config['HISTORY_LEASE_SECONDS']), history_lease_job_id=job_id)
+        .returning(store_table.c.id)
+    ).first()
+    db.session.commit()
+    return acquired is not None
+
+def _renew_history_lease(store, task):
+    """Heartbeat: gia hạn lease và đánh dấu tác vụ còn sống. Không commit."""
+    now = datetime.now(timezone.utc)
+    store.history_lease_until = now + timedelta(seconds=current_app.config['HISTORY_LEASE_SECONDS'])
+    touch_task(task)
+
+def _release_history_lease(store_id: int, job_id: str):
+    store_table = WooCommerceStore.__table__
+    db.session.execute(
+        update(store_table)
+        .where(store_table.c.id == store_id, store_table.c.history_lease_job_id == job_id)
+        .values(history_lease_until=None, history_lease_job_id=None)
+    )
+    db.session.commit()
+
+def _acquire_poll_lease(store_id: int, owner: str) -> bool:
+    """
+    Giành lease polling của cửa hàng (nguyên tử, giống lease đồng bộ lịch sử). Chỉ một worker giữ lease tại một
+    thời điểm, nên hai worker có hash ring lệch nhau không polling trùng. Commit luôn cả các thay đổi đang chờ của session.
+    """
+    now = datetime.now(timezone.utc)
+    store_table = WooCommerceStore.__table__
+    acquired = db.session.execute(
+        update(store_table)
+        .where(
+            store_table.c.id == store_id,
+            or_(
+                store_table.c.poll_lease_until.is_(None), store_table.c.poll_lease_until < now,
+                store_table.c.poll_lease_owner == owner
+            )
+        )
+        .values(poll_lease_until=now + timedelta(seconds=current_app.config['SYNC_POLL_LEASE_SECONDS']), poll_lease_owner=owner)
+        .returning(store_table.c.id)
+    ).first()
+    db.session.commit()
+    return acquired is not None
+
+def _renew_poll_lease(store):
+    """Gia hạn lease polling sau mỗi trang. Không commit."""
+    store.poll_lease_until = datetime.now(timezone.utc) + timedelta(seconds=current_app.config['SYNC_POLL_LEASE_SECONDS'])
+
+def _release_poll_lease(store, owner: str):
+    """Nhả lease polling nếu vẫn còn là của `owner` (lease đã hết hạn và bị worker khác lấy thì không đụng tới). Không commit."""
+    if store.poll_lease_owner == owner:
+        store.poll_lease_until = None
+        store.poll_lease_owner = None
+
+def _save_history_checkpoint(store, task, checkpoint: dict):
+    task.checkpoint = json.dumps(checkpoint)
+    task.progress = checkpoint['total_synced']
+    task.log = _history_log(checkpoint['windows'])
+    _renew_history_lease(store, task)
+    db.session.commit()
+
+def _start_history_checkpoint(app, store, task, wcapi: WooClient) -> dict:
+    """Lần chạy đầu: một request per_page=1 sắp theo ngày tạo tăng dần cho cả tổng số đơn lẫn ngày của đơn cũ nhất."""
+    probe = wcapi.get("orders", params=with_field_projection(
+        store, {'per_page': 1, 'orderby': 'date', 'order': 'asc'}, ('id', 'date_created_gmt')
+    ))
+    probe_orders = probe.json()
+    if not isinstance(probe_orders, list):
+        raise ValueError(probe_orders.get('message', probe_orders) if isinstance(probe_orders, dict) else probe_orders)
+    task.total = int(probe.headers.get('X-WP-Total', 0))
+
+    windows = []
+    if probe_orders:
+        oldest = datetime.fromisoformat(probe_orders[0]['date_created_gmt']).replace(tzinfo=timezone.utc)
+        newest = datetime.now(timezone.utc) + timedelta(days=1)
+        windows = _history_windows(oldest, newest, task.total, app.config['HISTORY_WINDOW_ORDERS'])
+    return {'windows': windows, 'total_synced': 0}
+
 def sync_history_for_store(app, store_id: int, job_id: str):
+    """
+    Đồng bộ toàn bộ lịch sử đơn hàng. Vòng đời cửa hàng được chia thành các cửa sổ ngày tạo (after/before)
+    để tránh offset trang sâu; các cửa sổ được tải song song bởi HISTORY_SYNC_CONCURRENCY thread,
+    còn việc ghi DB do một writer duy nhất (thread hiện tại) đảm nhận bằng bulk upsert.
+    Sau mỗi lô đã ghi, vị trí (trang kế tiếp của từng cửa sổ) được lưu vào `BackgroundTask.checkpoint`,
+    nên tác vụ bị gián đoạn sẽ chạy tiếp từ đó thay vì tải lại từ đầu.
+    """
     with app.app_context():
         store = WooCommerceStore.query.get(store_id)
         task = BackgroundTask.query.filter_by(job_id=job_id).first()
-        if not store or not task: return
+        if not store or not task or task.status not in ('queued', 'running'): return
 
-        store.is_syncing_history = True
-        db.session.commit()
-        
-        fetch_images_setting = Setting.query.get('FETCH_PRODUCT_IMAGES')
-        should_fetch_images = fetch_images_setting.value.lower() == 'true' if fetch_images_setting else False
+        if not _acquire_history_lease(store_id, job_id):
+            db.session.refresh(store)
+            if store.history_lease_job_id != job_id:
+                task.status = 'failed'
+                task.log = "Cửa hàng đang được đồng bộ lịch sử bởi một tác vụ khác."
+                task.end_time = datetime.now(timezone.utc)
+                db.session.commit()
+            # Cùng job đang chạy ở tiến trình khác: để tiến trình đó tiếp tục
+            return
+
+        should_fetch_images = _should_fetch_images()
         
         task.status = 'running'
+        touch_task(task)
         db.session.commit()
         
+        stop_event = threading.Event()
         try:
-            wcapi = API(url=store.store_url, consumer_key=store.consumer_key, consumer_secret=store.consumer_secret, version="wc/v3", timeout=30)
-            
-            # === START: SỬA LỖI HIỂN THỊ TIẾN TRÌNH ===
-            # Thay vì .head(), dùng .get() với per_page=1 để lấy header
-            try:
-                response = wcapi.get("orders", params={'per_page': 1})
-                total_orders = int(response.headers.get('X-WP-Total', 0))
-                task.total = total_orders
-                db.session.commit()
-            except Exception as e:
-                print(f"Không thể lấy tổng số đơn hàng, sẽ không hiển thị Total: {e}")
-                task.total = 0
-                db.session.commit()
-            # === END: SỬA LỖI HIỂN THỊ TIẾN TRÌNH ===
-            
-            page = 1
-            total_synced = 0
-            
-            while True:
-                task = BackgroundTask.query.filter_by(job_id=job_id).first()
-                if not task or task.requested_cancellation:
-                    if task: task.status = 'cancelled'
-                    break
+            wcapi = get_woo_client(store)
 
-                task.log = f"Đang lấy trang {page}..."
-                db.session.commit()
-                # Sử dụng lại wcapi đã khởi tạo
-                orders_page_response = wcapi.get("orders", params={'per_page': 50, 'page': page})
-                orders_page = orders_page_response.json()
-                if not orders_page: break
-
-                for order_data in orders_page:
-                    full_details = _extract_order_details(order_data, wcapi, should_fetch_images)
-                    existing_order = WooCommerceOrder.query.filter_by(wc_order_id=order_data['id'], store_id=store.id).first()
-                    
-                    if not existing_order:
-                        history_order = WooCommerceOrder(store_id=store.id, **full_details['order'])
-                        db.session.add(history_order)
-                        for item_data in full_details['line_items']:
-                            item_data.pop('product_id', None)
-                            new_item = OrderLineItem(order=history_order, **item_data)
-                            db.session.add(new_item)
-                    total_synced += 1
+            if task.checkpoint:
+                checkpoint = json.loads(task.checkpoint)
+                print(f"--- Tiếp tục đồng bộ lịch sử '{store.name}' từ checkpoint ({checkpoint['total_synced']} đơn đã xử lý) ---")
+            else:
+                checkpoint = _start_history_checkpoint(app, store, task, wcapi)
+                _save_history_checkpoint(store, task, checkpoint)
 
-                db.session.commit()
-                task.progress = total_synced
-                db.session.commit()
-                page += 1
+            windows = checkpoint['windows']
+            base_params = with_field_projection(store, {
+                'per_page': HISTORY_PAGE_SIZE, 'orderby': 'date', 'order': 'asc', 'dates_are_gmt': 'true'
+            })
+            concurrency = app.config['HISTORY_SYNC_CONCURRENCY']
+            heartbeat_seconds = max(1, app.config['HISTORY_LEASE_SECONDS'] // 3)
+            results = queue.Queue(maxsize=concurrency * 2)
+            failed_windows = []
+            pending = 0
+
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"history-{store_id}") as pool:
+                for index, window in enumerate(windows):
+                    if not window['done']:
+                        pool.submit(_fetch_history_window, wcapi, base_params, index, window, results, stop_event)
+                        pending += 1
+
+                # Writer: nhận kết quả cho tới khi mọi cửa sổ kết thúc (kể cả khi đã hủy, để thread không bị treo ở put)
+                try:
+                    while pending:
+                        try:
+                            kind, index, payload, window_total = results.get(timeout=heartbeat_seconds)
+                        except queue.Empty:
+                            _renew_history_lease(store, task)
+                            db.session.commit()
+                            continue
+
+                        window = windows[index]
+                        if kind in ('done', 'stopped'):
+                            pending -= 1
+                            if kind == 'done':
+                                window['done'] = True
+                                _save_history_checkpoint(store, task, checkpoint)
+                            continue
+                        if kind == 'error':
+                            failed_windows.append(index)
+                            print(f"LỖI khi tải cửa sổ #{index + 1} của '{store.name}': {payload}")
+                            continue
+                        if stop_event.is_set():
+                            continue
 
-            task.status = 'complete'
-            task.log = f"Hoàn tất! Đã xử lý {total_synced} đơn hàng."
+                        page, orders_page = payload
+                        record_field_projection_support(store, orders_page)
+                        # Đơn nằm ở mốc của cửa sổ kề bên được tính ở cửa sổ đó, không đếm/ghi hai lần
+                        orders_page = [order_data for order_data in orders_page if _in_history_window(order_data, window)]
+                        details_list = _extract_page_details(orders_page, store.id, wcapi, should_fetch_images)
+                        written = _ingest_order_batch(store.id, details_list, update_existing=False)
+                        count_synced_orders('history', sum(1 for _, is_new in written if is_new), sum(1 for _, is_new in written if not is_new))
+
+                        checkpoint['total_synced'] += len(orders_page)
+                        window['synced'] += len(orders_page)
+                        window['total'] = window_total
+                        window['next_page'] = page + 1
+
+                        db.session.refresh(task)
+                        if task.requested_cancellation:
+                            stop_event.set()
+                        _save_history_checkpoint(store, task, checkpoint)
+                finally:
+                    if pending:
+                        # Writer gặp lỗi: dừng các thread tải và rút hết hàng đợi để chúng không bị treo ở put()
+                        stop_event.set()
+                        while pending:
+                            if results.get()[0] in ('done', 'stopped'):
+                                pending -= 1
+
+            total_synced = checkpoint['total_synced']
+            if stop_event.is_set():
+                task.status = 'cancelled'
+                task.log = f"Đã hủy sau khi xử lý {total_synced} đơn hàng."
+            elif failed_windows:
+                raise RuntimeError(
+                    f"{len(failed_windows)} cửa sổ thời gian bị lỗi ({', '.join(f'#{i + 1}' for i in sorted(failed_windows))}), "
+                    f"đã xử lý {total_synced} đơn hàng"
+                )
+            else:
+                task.status = 'complete'
+                task.log = f"Hoàn tất! Đã xử lý {total_synced} đơn hàng."
             task.end_time = datetime.now(timezone.utc)
             
-        except Exception as e:
-            if task:
-                task.status = 'failed'
-                task.log = f"Lỗi: {str(e)[:500]}"
-                task.end_time = datetime.now(timezone.utc)
+        except Exception:
+            # Để hàng đợi quyết định thử lại (chạy tiếp từ checkpoint) hay đánh dấu thất bại
+            stop_event.set()
             db.session.rollback()
+            raise
         finally:
-            store.is_syncing_history = False
             db.session.commit()
+            _release_history_lease(store_id, job_id)
 
-def check_single_store_job(app, store_id):
+def _run_sync_history_task(app, job_id, payload):
+    sync_history_for_store(app, payload['store_id'], job_id)
+
+register_task_handler('sync_history', _run_sync_history_task)
+
+def enqueue_history_sync(store, user_id):
+    """Xếp tác vụ đồng bộ lịch sử vào hàng đợi; trả về BackgroundTask vừa tạo."""
+    return enqueue_task(
+        'sync_history', f"Đồng bộ lịch sử cho: {store.name}", payload={'store_id': store.id},
+        user_id=user_id, store_id=store.id
+    )
+
+def with_field_projection(store, params: dict, fields=ORDER_SYNC_FIELDS) -> dict:
+    """Thêm `_fields` vào params, trừ khi cửa hàng đã được ghi nhận là bỏ qua tham số này."""
+    if store.supports_field_projection is not False:
+        params['_fields'] = ','.join(fields)
+    return params
+
+def record_field_projection_support(store, orders_page, fields=ORDER_SYNC_FIELDS):
+    """
+    Lần đầu nhận được dữ liệu, kiểm tra xem cửa hàng có tôn trọng `_fields` hay không
+    (một số plugin/cache bỏ qua nó và trả về đơn hàng đầy đủ) rồi ghi nhớ vào DB.
+    """
+    if store.supports_field_projection is not None or not isinstance(orders_page, list) or not orders_page:
+        return
+    allowed = set(fields)
+    honored = all(set(order_data) <= allowed for order_data in orders_page if isinstance(order_data, dict))
+    store.supports_field_projection = honored
+    db.session.commit()
+    if not honored:
+        print(f"Cửa hàng '{store.name}' bỏ qua tham số _fields, sẽ không gửi tham số này nữa.")
+
+def _order_cursor_key(order_data: dict):
+    return (datetime.fromisoformat(order_data['date_modified_gmt']).replace(tzinfo=timezone.utc), order_data['id'])
+
+class CatchUpCursor:
+    """
+    Con trỏ (date_modified_gmt, id) cho đồng bộ tăng dần kiểu "đuổi kịp": đi qua các trang `orders`
+    sắp theo `modified` tăng dần cho tới khi hết, không làm rơi các đơn có cùng mốc thời gian sửa.
+    """
+    def __init__(self, last_modified, last_order_id=None, per_page=100, project_fields=True):
+        self.last_modified = last_modified
+        self.last_order_id = last_order_id or 0
+        self.per_page = per_page
+        self.project_fields = project_fields
+        self.anchor = last_modified
+        self.page = 1
+        self.drained = False
+
+    @classmethod
+    def from_store(cls, store, per_page=100):
+        last_modified = store.last_checked or (datetime.now(timezone.utc) - timedelta(days=7))
+        return cls(last_modified, store.last_checked_order_id, per_page, store.supports_field_projection is not False)
+
+    @property
+    def position(self):
+        return (self.last_modified, self.last_order_id)
+
+    def next_params(self) -> dict:
+        # `modified_after` so sánh "lớn hơn" theo giây: lùi 1 giây để các đơn trùng mốc vẫn được trả về,
+        # rồi lọc lại bằng khóa (modified, id) trong advance().
+        params = {
+            'orderby': 'modified', 'order': 'asc', 'per_page': self.per_page, 'page': self.page,
+            'modified_after': (self.anchor - timedelta(seconds=1)).isoformat(),
+        }
+        if self.project_fields:
+            params['_fields'] = ','.join(ORDER_SYNC_FIELDS)
+        return params
+
+    def advance(self, orders_page: list) -> list:
+        """Tiến con trỏ theo một trang vừa tải; trả về các đơn chưa xử lý trong trang đó."""
+        fresh = [order_data for order_data in orders_page if _order_cursor_key(order_data) > self.position]
+
+        if len(orders_page) < self.per_page:
+            if fresh:
+                self.last_modified, self.last_order_id = max(map(_order_cursor_key, fresh))
+            self.drained = True
+            return fresh
+
+        # Trang đầy: chỉ chốt con trỏ tới trước mốc thời gian cuối trang, vì các đơn cùng mốc đó
+        # có thể còn nằm ở trang sau (thứ tự giữa các đơn trùng mốc không được đảm bảo).
+        last_modified_in_page = max(_order_cursor_key(order_data)[0] for order_data in orders_page)
+        safe_keys = [key for key in map(_order_cursor_key, fresh) if key[0] < last_modified_in_page]
+        if safe_keys:
+            self.last_modified, self.last_order_id = max(safe_keys)
+            self.anchor = self.last_modified
+            self.page = 1
+        else:
+            # Cả trang cùng một mốc thời gian: giữ mốc, đi tiếp bằng số trang
+            self.page += 1
+        return fresh
+
+def _should_fetch_images() -> bool:
+    return settings_store.get_bool('FETCH_PRODUCT_IMAGES')
+
+def _enqueue_new_order_notifications(app, store, new_orders: list):
+    """Đưa thông báo đơn mới vào notification_outbox (không commit); NotificationDispatcher sẽ gửi."""
+    if not new_orders or not store.user_id:
+        return
+    data_list = []
+    for full_details in new_orders:
+        order = full_details['order']
+        data_list.append({
+            "store_name": store.name, 
+            "order_id": order['wc_order_id'], 
+            "customer_name": order['customer_name'] or "Khách lẻ", 
+            "total_amount": f"${order['total']:,.2f}", 
+            "currency": order['currency'], 
+            "status": order['status'], 
+            "payment_method": order['payment_method_title'], 
+            "product_list": format_products_for_notification(full_details['line_items'])
+        })
+    enqueue_notifications(app, 'new_order', store.user_id, store.id, data_list)
+
+def _ingest_orders_page(app, store, orders_page: list, wcapi: WooClient):
+    """
+    Ghi một trang đơn hàng vào DB, kèm thông báo cho đơn mới trong notification_outbox (cùng transaction).
+    Phải được gọi bên trong application context. Trả về danh sách (full_details, is_new) của các đơn đã được ghi.
+    """
+    if not orders_page:
+        return []
+
+    details_list = _extract_page_details(orders_page, store.id, wcapi, _should_fetch_images())
+    return _ingest_order_batch(
+        store.id, details_list, update_existing=True,
+        on_new_orders=lambda new_orders: _enqueue_new_order_notifications(app, store, new_orders)
+    )
+
+def _count_webhook_misses(written: list, now=None) -> int:
+    """
+    Số đơn vừa ghi mà webhook lẽ ra đã phải đưa về: chỉ tính đơn sửa trước WEBHOOK_MISS_GRACE_SECONDS,
+    đơn vừa sửa có thể vẫn đang có webhook trên đường tới.
+    """
+    now = now or datetime.now(timezone.utc)
+    cutoff = now - timedelta(seconds=current_app.config['WEBHOOK_MISS_GRACE_SECONDS'])
+    return sum(
+        1 for full_details, _ in written
+        if full_details['order'].get('order_modified_at') and full_details['order']['order_modified_at'] < cutoff
+    )
+
+def _apply_catch_up_page(app, store, cursor: CatchUpCursor, orders_response):
+    """
+    Xử lý một trang của chế độ đuổi kịp rồi lưu con trỏ vào cửa hàng. Trả về (mới, cập nhật), hoặc None nếu lỗi ghi DB.
+    Phản hồi lỗi từ WooCommerce được ném ra dưới dạng WooApiError để tính vào circuit breaker.
+    """
+    if not isinstance(orders_response, list):
+        message = orders_response.get('message', 'Không rõ') if isinstance(orders_response, dict) else orders_response
+        raise WooApiError(f"Lỗi API cho '{store.name}': {message}")
+
+    try:
+        record_field_projection_support(store, orders_response)
+        fresh = cursor.advance(orders_response)
+        # Chỉ lượt đối soát (webhook đang được coi là ổn định) mới kiểm tra webhook bỏ sót; xét trước khi ghi
+        reconciling = store.webhook_healthy
+        written = _ingest_orders_page(app, store, fresh, get_woo_client(store))
+        new_count = sum(1 for _, is_new in written if is_new)
+        store.last_checked, store.last_checked_order_id = cursor.position
+        _renew_poll_lease(store)
+        missed = _count_webhook_misses(written) if reconciling else 0
+        if missed:
+            # Đơn thay đổi đã lâu mà webhook chưa đưa về: coi webhook là không tin cậy tới khi nhận được sự kiện mới
+            store.webhook_missed_at = datetime.now(timezone.utc)
+            print(f"Đối soát '{store.name}': webhook đã bỏ sót {missed} đơn, chuyển về chu kỳ polling thường.")
+        db.session.commit()
+        return new_count, len(written) - new_count
+    except Exception as e:
+        print(f"LỖI nghiêm trọng khi đồng bộ '{store.name}': {e}")
+        db.session.rollback()
+        return None
+
+def _print_sync_summary(store_name, new_count, updated_count, cursor: CatchUpCursor, seconds=None):
+    if not new_count and not updated_count:
+        print(f"Không có đơn hàng mới hoặc cập nhật cho '{store_name}'.")
+    backlog_note = "" if cursor.drained else " Còn đơn tồn đọng, sẽ tiếp tục ở lượt sau."
+    duration_note = f" ({seconds:.1f}s)" if seconds is not None else ""
+    print(f"--- Hoàn tất đồng bộ cho '{store_name}'{duration_note}. Đã thêm {new_count} đơn mới, cập nhật {updated_count} đơn.{backlog_note} ---")
+
+def get_check_interval_seconds() -> int:
+    """Chu kỳ polling mặc định (cài đặt CHECK_INTERVAL_MINUTES), dùng khi chưa có dữ liệu về nhịp đơn của cửa hàng."""
+    minutes = settings_store.get_int('CHECK_INTERVAL_MINUTES')
+    if minutes is None or minutes < 0:
+        minutes = current_app.config['DEFAULT_CHECK_INTERVAL_MINUTES']
+    return minutes * 60
+
+def compute_poll_interval(order_rate, base_seconds, config):
+    """
+    Chọn chu kỳ polling sao cho mỗi lượt gặp khoảng SYNC_TARGET_CHANGES_PER_POLL thay đổi,
+    kẹp trong [SYNC_MIN_INTERVAL_SECONDS, SYNC_MAX_INTERVAL_SECONDS]. Trả về (giây, lý do).
+    `order_rate` là số đơn mới/cập nhật mỗi giờ (trung bình trượt), None nếu chưa có dữ liệu.
+    """
+    min_seconds, max_seconds = config['SYNC_MIN_INTERVAL_SECONDS'], config['SYNC_MAX_INTERVAL_SECONDS']
+    if order_rate is None:
+        return max(min_seconds, min(max_seconds, base_seconds)), "Chưa đủ dữ liệu, dùng chu kỳ mặc định"
+    if order_rate < 0.01:
+        return max_seconds, "Không có đơn gần đây"
+
+    ideal = 3600 * config['SYNC_TARGET_CHANGES_PER_POLL'] / order_rate
+    seconds = int(max(min_seconds, min(max_seconds, ideal)))
+    rate_text = f"~{order_rate:.1f} đơn/giờ"
+    if seconds == min_seconds:
+        return seconds, f"Cửa hàng rất bận ({rate_text}), đạt chu kỳ tối thiểu"
+    if seconds < base_seconds:
+        return seconds, f"Cửa hàng bận ({rate_text})"
+    return seconds, f"Cửa hàng ít đơn ({rate_text})"
+
+def _update_poll_interval(store, changes: int, now=None):
+    """
+    Cập nhật trung bình trượt theo thời gian (half-life SYNC_RATE_HALF_LIFE_MINUTES) của số đơn mới/cập nhật
+    mỗi giờ, rồi tính lại chu kỳ polling cho cửa hàng. Không commit.
+    """
+    config = current_app.config
+    now = now or datetime.now(timezone.utc)
+    if store.order_rate_updated_at:
+        elapsed_hours = (now - store.order_rate_updated_at).total_seconds() / 3600
+        if elapsed_hours > 0:
+            observed_rate = changes / elapsed_hours
+            if store.order_rate_ewma is None:
+                store.order_rate_ewma = observed_rate
+            else:
+                weight = 1 - 0.5 ** (elapsed_hours * 60 / config['SYNC_RATE_HALF_LIFE_MINUTES'])
+                store.order_rate_ewma += weight * (observed_rate - store.order_rate_ewma)
+    store.order_rate_updated_at = now
+    store.poll_interval_seconds, store.poll_interval_reason = compute_poll_interval(
+        store.order_rate_ewma, get_check_interval_seconds(), config
+    )
+
+def _finish_sync_run(store, lease_owner, new_count, updated_count, cursor: CatchUpCursor, record_rate=True, error=None, seconds=None):
+    """
+    Kết thúc một lượt đồng bộ: lỗi phía cửa hàng (HTTP, API) được tính vào circuit breaker;
+    lượt thành công đóng breaker và cập nhật nhịp đơn để điều chỉnh chu kỳ. Nhả lease polling trong cùng commit.
+    Thời lượng `seconds` vào histogram chung (không nhãn cửa hàng) và vào log tổng kết của cửa hàng.
+    """
+    if seconds is not None:
+        observe_sync_run(seconds, error)
+    count_synced_orders('poll', new_count, updated_count)
+    try:
+        _release_poll_lease(store, lease_owner)
+        if error is not None:
+            print(f"LỖI khi đồng bộ '{store.name}': {error}")
+            record_breaker_failure(store, error)
+        elif record_rate:
+            record_breaker_success(store)
+            _update_poll_interval(store, new_count + updated_count)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Lỗi khi cập nhật trạng thái đồng bộ cho '{store.name}': {e}")
+    _print_sync_summary(store.name, new_count, updated_count, cursor, seconds)
+
+def get_store_sync_target(app, store_id, lease_owner):
+    """
+    Dùng cho sync engine: trả về thông tin cần thiết để gọi API `orders` cho một cửa hàng,
+    hoặc None nếu cửa hàng không cần đồng bộ ở lượt này. Trả về target nghĩa là `lease_owner` đã giữ
+    lease polling của cửa hàng; người gọi phải kết thúc lượt bằng finish_sync_run để nhả lease.
+    """
     with app.app_context():
         store = db.session.get(WooCommerceStore, store_id)
         if not store or not store.is_active:
-            return
-            
+            return None
+
         if store.is_syncing_history:
             print(f"--- Tạm dừng kiểm tra đơn mới cho '{store.name}' vì đang đồng bộ lịch sử. ---")
-            return
+            return None
+
+        if not breaker_allows(store):
+            return None
+        # Commit của lease cũng lưu trạng thái half-open mà breaker_allows vừa chuyển sang
+        if not _acquire_poll_lease(store_id, lease_owner):
+            print(f"--- Bỏ qua '{store.name}': một worker khác đang polling cửa hàng này. ---")
+            return None
+        if store.breaker_state == 'half_open':
+            print(f"--- Thăm dò lại cửa hàng '{store.name}' (circuit breaker half-open) ---")
 
         print(f"--- Bắt đầu đồng bộ đơn hàng cho: '{store.name}' ---")
-        
-        new_orders_to_notify = []
-        updated_order_count = 0
-        latest_modified_time = None
+        return {
+            'store_id': store.id,
+            'name': store.name,
+            'store_url': store.store_url,
+            'consumer_key': store.consumer_key,
+            'consumer_secret': store.consumer_secret,
+            'timeout': get_store_timeout(store),
+            'cursor': CatchUpCursor.from_store(store),
+        }
 
-        try:
-            setting = db.session.get(Setting, 'FETCH_PRODUCT_IMAGES')
-            should_fetch_images = setting.value.lower() == 'true' if setting else False
-            
-            wcapi = API(url=store.store_url, consumer_key=store.consumer_key, consumer_secret=store.consumer_secret, version="wc/v3", timeout=20)
-            
-            params = {'orderby': 'modified', 'order': 'asc', 'per_page': 100}
-            if store.last_checked:
-                params['modified_after'] = store.last_checked.isoformat()
-            else:
-                params['modified_after'] = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
-            
-            orders_response = wcapi.get("orders", params=params).json()
-            
-            if not isinstance(orders_response, list):
-                print(f"Lỗi API cho '{store.name}': {orders_response.get('message', 'Không rõ')}")
-                return
+def apply_catch_up_page(app, store_id, cursor: CatchUpCursor, orders_response):
+    """Dùng cho sync engine: xử lý một trang mà engine đã tải về bằng HTTP bất đồng bộ."""
+    with app.app_context():
+        store = db.session.get(WooCommerceStore, store_id)
+        if not store:
+            return None
+        return _apply_catch_up_page(app, store, cursor, orders_response)
 
-            if not orders_response:
-                print(f"Không có đơn hàng mới hoặc cập nhật cho '{store.name}'.")
-            else:
-                for order_data in orders_response:
-                    try:
-                        full_details = _extract_order_details(order_data, wcapi, should_fetch_images)
-                        
-                        existing_order = WooCommerceOrder.query.filter_by(
-                            wc_order_id=order_data['id'], store_id=store.id
-                        ).first()
-
-                        if existing_order:
-                            print(f"Đang cập nhật đơn hàng WC_ID {order_data['id']}...")
-                            for key, value in full_details['order'].items():
-                                setattr(existing_order, key, value)
-                            
-                            OrderLineItem.query.filter_by(order_id=existing_order.id).delete()
-                            for item_data in full_details['line_items']:
-                                item_data.pop('product_id', None)
-                                new_item = OrderLineItem(order=existing_order, **item_data)
-                                db.session.add(new_item)
-                            
-                            updated_order_count += 1
-                        else:
-                            print(f"Đang thêm đơn hàng mới WC_ID {order_data['id']}...")
-                            new_order = WooCommerceOrder(store_id=store.id, **full_details['order'])
-                            db.session.add(new_order)
-                            
-                            for item_data in full_details['line_items']:
-                                item_data.pop('product_id', None)
-                                new_item = OrderLineItem(order=new_order, **item_data)
-                                db.session.add(new_item)
-                            
-                            new_orders_to_notify.append(new_order)
-
-                        db.session.commit()
-                        
-                        latest_modified_time = full_details['order']['order_modified_at']
-
-                    except Exception as single_order_error:
-                        print(f"LỖI khi xử lý đơn hàng WC_ID {order_data.get('id')}: {single_order_error}")
-                        db.session.rollback()
-                        continue
-
-            if latest_modified_time:
-                store.last_checked = latest_modified_time
-                db.session.commit()
+def check_single_store_job(app, store_id):
+    """
+    Đồng bộ tăng dần (đồng bộ, chặn) cho một cửa hàng — dùng cho các thao tác thủ công trên giao diện.
+    Đi tối đa SYNC_CATCHUP_MAX_PAGES trang; trả về True nếu đã đuổi kịp hết.
+    """
+    lease_owner = local_worker_id()
+    target = get_store_sync_target(app, store_id, lease_owner)
+    if not target:
+        return True
 
-            print(f"--- Hoàn tất đồng bộ cho '{store.name}'. Đã thêm {len(new_orders_to_notify)} đơn mới, cập nhật {updated_order_count} đơn. ---")
+    with app.app_context():
+        store = db.session.get(WooCommerceStore, store_id)
+        wcapi = get_woo_client(store)
+        cursor = target['cursor']
+        new_count = updated_count = 0
+        failed = False
+        error = None
+        started_at = time.perf_counter()
 
+        try:
+            for _ in range(app.config['SYNC_CATCHUP_MAX_PAGES']):
+                orders_response = wcapi.get("orders", params=cursor.next_params()).json()
+                counts = _apply_catch_up_page(app, store, cursor, orders_response)
+                if counts is None:
+                    failed = True
+                    break
+                new_count += counts[0]
+                updated_count += counts[1]
+                if cursor.drained:
+                    break
         except Exception as e:
-            print(f"LỖI nghiêm trọng khi đồng bộ '{store.name}': {e}")
-            db.session.rollback()
-            return
+            error = e
 
-        if new_orders_to_notify and store.user_id:
-            for order in new_orders_to_notify:
-                try:
-                    notification_data = {
-                        "store_name": store.name, 
-                        "order_id": order.wc_order_id, 
-                        "customer_name": order.customer_name or "Khách lẻ", 
-                        "total_amount": f"${order.total:,.2f}", 
-                        "currency": order.currency, 
-                        "status": order.status, 
-                        "payment_method": order.payment_method_title, 
-                        "product_list": format_products_for_notification(order.line_items)
-                    }
-                    asyncio.run(send_telegram_message(app, message_type='new_order', data=notification_data, user_id=store.user_id))
-                except Exception as notify_error:
-                    print(f"LỖI khi gửi thông báo cho đơn hàng {order.wc_order_id}: {notify_error}")
+        _finish_sync_run(
+            store, lease_owner, new_count, updated_count, cursor,
+            record_rate=not failed, error=error, seconds=time.perf_counter() - started_at
+        )
+        return cursor.drained
 
-def add_or_update_store_job(app, store_id):
+def finish_sync_run(app, store_id, lease_owner, new_count, updated_count, cursor: CatchUpCursor, record_rate=True, error=None, seconds=None):
+    """Dùng cho sync engine: ghi nhận kết quả lượt vừa chạy (breaker, nhịp đơn), nhả lease, rồi in tổng kết."""
     with app.app_context():
-        store = WooCommerceStore.query.get(store_id)
-        setting = Setting.query.get('CHECK_INTERVAL_MINUTES')
-        interval = int(setting.value) if setting and setting.value.isdigit() else 5
-        job_id = f'check_store_{store_id}'
+        store = db.session.get(WooCommerceStore, store_id)
+        if store:
+            _finish_sync_run(store, lease_owner, new_count, updated_count, cursor, record_rate, error, seconds)
+
+def _claim_webhook_events(app, limit):
+    """Nhận (claim) một lô sự kiện webhook chưa xử lý; SKIP LOCKED để nhiều tiến trình không lấy trùng."""
+    now = datetime.now(timezone.utc)
+    event_table = WebhookEvent.__table__
+    claimable = (
+        select(event_table.c.id)
+        .where(
+            event_table.c.processed_at.is_(None),
+            event_table.c.attempts < app.config['WEBHOOK_MAX_ATTEMPTS'],
+            or_(event_table.c.next_attempt_at.is_(None), event_table.c.next_attempt_at <= now)
+        )
+        .order_by(event_table.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    # Đặt trước next_attempt_at như một lease: nếu tiến trình chết giữa chừng, sự kiện sẽ được thử lại sau đó
+    claimed = db.session.execute(
+        update(event_table)
+        .where(event_table.c.id.in_(claimable.scalar_subquery()))
+        .values(attempts=event_table.c.attempts + 1, next_attempt_at=now + timedelta(minutes=5))
+        .returning(event_table.c.id, event_table.c.store_id, event_table.c.payload, event_table.c.attempts)
+    ).all()
+    db.session.commit()
+    return sorted(claimed, key=lambda row: row.id)
+
+def drain_webhook_events(app, limit=None):
+    """
+    Dùng cho sync engine: xử lý các payload webhook đã lưu qua cùng đường ghi và thông báo với polling.
+    Trả về số sự kiện đã xử lý thành công.
+    """
+    with app.app_context():
+        events = _claim_webhook_events(app, limit or app.config['WEBHOOK_DRAIN_BATCH'])
+        if not events:
+            return 0
 
+        events_by_store = {}
+        for event in events:
+            events_by_store.setdefault(event.store_id, []).append(event)
+
+        processed = 0
+        event_table = WebhookEvent.__table__
+        for store_id, store_events in events_by_store.items():
+            event_ids = [event.id for event in store_events]
+            try:
+                store = db.session.get(WooCommerceStore, store_id)
+                if store and store.is_active:
+                    orders_page = [json.loads(event.payload) for event in store_events]
+                    written = _ingest_orders_page(app, store, orders_page, get_woo_client(store))
+                    new_count = sum(1 for _, is_new in written if is_new)
+                    updated_count = len(written) - new_count
+                    count_synced_orders('webhook', new_count, updated_count)
+                    print(f"--- Webhook '{store.name}': {len(store_events)} sự kiện, {new_count} đơn mới, {updated_count} đơn cập nhật. ---")
+                db.session.execute(
+                    update(event_table).where(event_table.c.id.in_(event_ids))
+                    .values(processed_at=datetime.now(timezone.utc), last_error=None)
+                )
+                db.session.commit()
+                processed += len(store_events)
+            except Exception as e:
+                db.session.rollback()
+                print(f"LỖI khi xử lý webhook cho cửa hàng ID {store_id}: {e}")
+                for event in store_events:
+                    db.session.execute(
+                        update(event_table).where(event_table.c.id == event.id)
+                        .values(last_error=str(e), next_attempt_at=datetime.now(timezone.utc) + timedelta(minutes=2 ** event.attempts))
+                    )
+                db.session.commit()
+        return processed
+
+def add_or_update_store_job(app, store_id):
+    """Báo cho sync engine biết cửa hàng vừa được thêm/sửa để nó được kiểm tra ngay ở tick kế tiếp."""
+    if not engine:
+        return
+    with app.app_context():
+        store = db.session.get(WooCommerceStore, store_id)
+        engine.invalidate_schedule()
         if store and store.is_active:
-            scheduler.add_job(
-                func=check_single_store_job,
-                trigger='interval',
-                minutes=interval,
-                id=job_id,
-                replace_existing=True,
-                args=[app, store_id],
-                max_instances=1
-            )
-            print(f"Đã thêm/cập nhật tác vụ cho cửa hàng '{store.name}' (ID: {store_id}) với chu kỳ {interval} phút.")
+            engine.request_sync(store_id)
+            print(f"Đã thêm/cập nhật lịch đồng bộ cho cửa hàng '{store.name}' (ID: {store_id}).")
         else:
-            if scheduler.get_job(job_id):
-                scheduler.remove_job(job_id)
-                print(f"Đã xóa tác vụ cho cửa hàng ID: {store_id} vì không hoạt động.")
+            engine.remove_store(store_id)
+            print(f"Đã xóa lịch đồng bộ cho cửa hàng ID: {store_id} vì không hoạt động.")
 
 def remove_store_job(store_id):
-    job_id = f'check_store_{store_id}'
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
-        print(f"Đã xóa tác vụ cho cửa hàng ID: {store_id}.")
+    if engine:
+        engine.invalidate_schedule()
+        engine.remove_store(store_id)
+        print(f"Đã xóa lịch đồng bộ cho cửa hàng ID: {store_id}.")
 
 def init_scheduler(app):
-    global scheduler
+    """
+    Khởi động phần nền trong tiến trình hiện tại: tham gia cụm worker (heartbeat, leader, chia cửa hàng),
+    sync engine cho phần cửa hàng của mình, notification dispatcher (chỉ gửi khi là leader)
+    và task runner cho hàng đợi tác vụ.
+    Được gọi bởi `flask run-worker` (triển khai thật) và bởi server dev trong run.py.
+    """
+    global engine, task_runner, membership, dispatcher
     with app.app_context():
-        if scheduler.running:
-            try:
-                scheduler.shutdown(wait=False)
-            except Exception as e:
-                print(f"Lỗi khi tắt scheduler cũ: {e}")
-        
-        scheduler = BackgroundScheduler(daemon=True, timezone="UTC")
-        scheduler.start()
-        
-        print("--- Bắt đầu lập lịch cho các cửa hàng ---")
-        active_stores = WooCommerceStore.query.filter_by(is_active=True).all()
-        for store in active_stores:
-            add_or_update_store_job(app, store.id)
-        
-        print(f"--- Hoàn tất lập lịch cho {len(active_stores)} cửa hàng ---")
-        atexit.register(lambda: scheduler.shutdown())
\ No newline at end of file
+        shutdown_scheduler()
+
+        start_worker_metrics_server(app)
+        membership = WorkerMembership(app)
+        membership.start()
+        engine = SyncEngine(app, membership)
+        engine.start()
+        dispatcher = NotificationDispatcher(app, membership)
+        dispatcher.start()
+        task_runner = TaskRunner(app)
+        task_runner.start()
+
+        active_count = WooCommerceStore.query.filter_by(is_active=True).count()
+        owned_count = sum(1 for (store_id,) in WooCommerceStore.query.with_entities(WooCommerceStore.id).filter_by(is_active=True) if membership.owns(store_id))
+        print(f"--- Worker {membership.worker_id} phụ trách {owned_count}/{active_count} cửa hàng đang hoạt động ---")
+        atexit.register(shutdown_scheduler)
+
+def shutdown_scheduler():
+    global engine, task_runner, membership, dispatcher
+    for component, name in (
+        (engine, "sync engine"), (dispatcher, "notification dispatcher"), (task_runner, "task runner"), (membership, "worker membership")
+    ):
+        if component is None:
+            continue
+        try:
+            component.stop()
+        except Exception as e:
+            print(f"Lỗi khi tắt {name}: {e}")
+    engine = dispatcher = task_runner = membership = None
@@ -24,7 +24,130 @@ class Config:
 
     # --- Cấu hình tác vụ nền mặc định ---
     DEFAULT_TELEGRAM_SEND_DELAY_SECONDS = int(os.environ.get('DEFAULT_TELEGRAM_SEND_DELAY_SECONDS', '2'))
+    # Chế độ gộp thông báo (digest): đơn mới của một cửa hàng được gom trong cửa sổ thời gian này (giây)...
+    DEFAULT_TELEGRAM_DIGEST_WINDOW_SECONDS = int(os.environ.get('DEFAULT_TELEGRAM_DIGEST_WINDOW_SECONDS', '60'))
+    # ...hoặc gửi ngay khi gom đủ số đơn này (tối đa một lần mỗi cửa sổ)
+    DEFAULT_TELEGRAM_DIGEST_THRESHOLD = int(os.environ.get('DEFAULT_TELEGRAM_DIGEST_THRESHOLD', '5'))
     DEFAULT_CHECK_INTERVAL_MINUTES = int(os.environ.get('DEFAULT_CHECK_INTERVAL_MINUTES', '5'))
+    # Mỗi tiến trình kiểm tra phiên bản cài đặt (dòng SETTINGS_VERSION) tối đa một lần trong khoảng này (giây);
+    # giữa các lần kiểm tra, cài đặt được đọc từ cache trong bộ nhớ
+    SETTINGS_VERSION_CHECK_SECONDS = int(os.environ.get('SETTINGS_VERSION_CHECK_SECONDS', '5'))
+
+    # --- Cấu hình sync engine (asyncio) ---
+    # Số cửa hàng được đồng bộ đồng thời tối đa trong một tiến trình
+    SYNC_MAX_CONCURRENCY = int(os.environ.get('SYNC_MAX_CONCURRENCY', '50'))
+    # Số request đồng thời tối đa tới cùng một host (tránh dồn tải lên một server chứa nhiều store)
+    SYNC_MAX_PER_HOST = int(os.environ.get('SYNC_MAX_PER_HOST', '4'))
+    # Chu kỳ (giây) engine quét danh sách cửa hàng đến hạn
+    SYNC_TICK_SECONDS = int(os.environ.get('SYNC_TICK_SECONDS', '5'))
+    # Danh sách cửa hàng và chu kỳ của chúng được đọc lại từ DB tối đa mỗi khoảng này (giây), hoặc ngay khi
+    # SETTINGS_VERSION đổi; giữa hai lần đọc, mỗi tick dùng lịch trong bộ nhớ
+    SYNC_SCHEDULE_REFRESH_SECONDS = int(os.environ.get('SYNC_SCHEDULE_REFRESH_SECONDS', '60'))
+    SYNC_HTTP_TIMEOUT = int(os.environ.get('SYNC_HTTP_TIMEOUT', '20'))
+    # Số trang (100 đơn/trang) tối đa một cửa hàng được đi trong một lượt đuổi kịp; phần còn lại để lượt sau
+    SYNC_CATCHUP_MAX_PAGES = int(os.environ.get('SYNC_CATCHUP_MAX_PAGES', '10'))
+    # Chu kỳ polling thích ứng theo nhịp đơn của từng cửa hàng
+    SYNC_MIN_INTERVAL_SECONDS = int(os.environ.get('SYNC_MIN_INTERVAL_SECONDS', '60'))
+    SYNC_MAX_INTERVAL_SECONDS = int(os.environ.get('SYNC_MAX_INTERVAL_SECONDS', '1800'))
+    # Số đơn mới/cập nhật mong muốn gặp trong mỗi lượt polling
+    SYNC_TARGET_CHANGES_PER_POLL = float(os.environ.get('SYNC_TARGET_CHANGES_PER_POLL', '1'))
+    # Half-life (phút) của trung bình trượt nhịp đơn
+    SYNC_RATE_HALF_LIFE_MINUTES = float(os.environ.get('SYNC_RATE_HALF_LIFE_MINUTES', '120'))
+    # Độ lệch ngẫu nhiên (±tỉ lệ) áp lên chu kỳ của mỗi lượt
+    SYNC_INTERVAL_JITTER = float(os.environ.get('SYNC_INTERVAL_JITTER', '0.1'))
+    # Thời hạn lease polling của một cửa hàng (giây), gia hạn sau mỗi trang; worker chết giữa lượt thì hết hạn sau chừng này
+    SYNC_POLL_LEASE_SECONDS = int(os.environ.get('SYNC_POLL_LEASE_SECONDS', '120'))
+
+    # --- Đồng bộ lịch sử ---
+    # Số cửa sổ thời gian được tải song song cho một cửa hàng
+    HISTORY_SYNC_CONCURRENCY = int(os.environ.get('HISTORY_SYNC_CONCURRENCY', '4'))
+    # Số đơn ước tính cho mỗi cửa sổ thời gian (dùng X-WP-Total để chia)
+    HISTORY_WINDOW_ORDERS = int(os.environ.get('HISTORY_WINDOW_ORDERS', '2000'))
+    # Thời hạn (giây) lease đồng bộ lịch sử; tác vụ không heartbeat trong khoảng này bị coi là đã chết
+    HISTORY_LEASE_SECONDS = int(os.environ.get('HISTORY_LEASE_SECONDS', '120'))
+
+    # --- Hàng đợi tác vụ nền (bảng background_task, xem app/task_queue.py) ---
+    # Số tác vụ một tiến trình `flask run-tasks` chạy song song
+    TASK_WORKER_CONCURRENCY = int(os.environ.get('TASK_WORKER_CONCURRENCY', '2'))
+    # Tác vụ không heartbeat trong khoảng này được coi là runner đã chết và được nhận lại
+    TASK_VISIBILITY_TIMEOUT_SECONDS = int(os.environ.get('TASK_VISIBILITY_TIMEOUT_SECONDS', '300'))
+    TASK_POLL_SECONDS = float(os.environ.get('TASK_POLL_SECONDS', '2'))
+    TASK_MAX_ATTEMPTS = int(os.environ.get('TASK_MAX_ATTEMPTS', '3'))
+    # Backoff lũy thừa giữa các lần thử lại: base * 2^(lần thử - 1)
+    TASK_RETRY_BASE_SECONDS = int(os.environ.get('TASK_RETRY_BASE_SECONDS', '30'))
+
+    # --- Cụm worker (`flask run-worker`) ---
+    WORKER_HEARTBEAT_SECONDS = int(os.environ.get('WORKER_HEARTBEAT_SECONDS', '10'))
+    # Worker không heartbeat trong khoảng này bị loại khỏi hash ring, cửa hàng của nó được chia lại
+    WORKER_TTL_SECONDS = int(os.environ.get('WORKER_TTL_SECONDS', '30'))
+
+    # --- Webhook WooCommerce ---
+    # Chu kỳ (phút) polling đối soát cho cửa hàng có webhook hoạt động tốt
+    WEBHOOK_RECONCILE_MINUTES = int(os.environ.get('WEBHOOK_RECONCILE_MINUTES', '60'))
+    # Đơn sửa trong khoảng này (giây) chưa bị tính là webhook bỏ sót khi đối soát: webhook có thể vẫn đang tới
+    WEBHOOK_MISS_GRACE_SECONDS = int(os.environ.get('WEBHOOK_MISS_GRACE_SECONDS', '300'))
+    # Số sự kiện webhook tối đa xử lý trong một tick của sync engine
+    WEBHOOK_DRAIN_BATCH = int(os.environ.get('WEBHOOK_DRAIN_BATCH', '200'))
+    # Số lần thử tối đa cho một sự kiện lỗi trước khi bỏ qua (polling đối soát sẽ bù lại)
+    WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '5'))
+    # Số ngày giữ lại sự kiện webhook đã xử lý (scheduler leader dọn định kỳ)
+    WEBHOOK_RETENTION_DAYS = int(os.environ.get('WEBHOOK_RETENTION_DAYS', '7'))
+
+    # --- Outbox thông báo Telegram (app/notification_dispatcher.py) ---
+    NOTIFICATION_BATCH_SIZE = int(os.environ.get('NOTIFICATION_BATCH_SIZE', '100'))
+    NOTIFICATION_POLL_SECONDS = float(os.environ.get('NOTIFICATION_POLL_SECONDS', '2'))
+    # Số lần thử tối đa cho một tin lỗi (mạng, 5xx); backoff lũy thừa: base * 2^(lần thử - 1)
+    NOTIFICATION_MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_MAX_ATTEMPTS', '5'))
+    NOTIFICATION_RETRY_BASE_SECONDS = int(os.environ.get('NOTIFICATION_RETRY_BASE_SECONDS', '30'))
+    NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', '7'))
+    # Thời gian (giây) kế hoạch gửi Telegram (người nhận, token, template đã biên dịch) được giữ trong tiến trình
+    # trước khi đọc lại từ DB; thường được làm mới sớm hơn khi SETTINGS_VERSION đổi
+    RECIPIENT_PLAN_TTL_SECONDS = int(os.environ.get('RECIPIENT_PLAN_TTL_SECONDS', '60'))
+    # Telegram cho phép khoảng 30 tin/giây mỗi bot và 1 tin/giây mỗi chat
+    TELEGRAM_GLOBAL_RATE_PER_SECOND = float(os.environ.get('TELEGRAM_GLOBAL_RATE_PER_SECOND', '25'))
+    TELEGRAM_GLOBAL_BURST = int(os.environ.get('TELEGRAM_GLOBAL_BURST', '25'))
+    TELEGRAM_CHAT_MIN_INTERVAL_SECONDS = float(os.environ.get('TELEGRAM_CHAT_MIN_INTERVAL_SECONDS', '1'))
+    # Chat phải chờ lâu hơn mức này (nhiều tin dồn, bị 429) thì phần còn lại được hoãn về outbox
+    TELEGRAM_MAX_CHAT_WAIT_SECONDS = float(os.environ.get('TELEGRAM_MAX_CHAT_WAIT_SECONDS', '10'))
+
+    # --- Pool kết nối HTTP tới WooCommerce (requests.Session dùng chung) ---
+    WOO_POOL_CONNECTIONS = int(os.environ.get('WOO_POOL_CONNECTIONS', '50'))
+    WOO_POOL_MAXSIZE = int(os.environ.get('WOO_POOL_MAXSIZE', '10'))
+    WOO_DEFAULT_TIMEOUT = int(os.environ.get('WOO_DEFAULT_TIMEOUT', '20'))
+
+    # --- Điều tiết request tới WooCommerce (app/services/request_governor.py) ---
+    # Token bucket theo host: số request/giây và số request được dồn tối đa
+    WOO_HOST_RATE_PER_SECOND = float(os.environ.get('WOO_HOST_RATE_PER_SECOND', '5'))
+    WOO_HOST_BURST = int(os.environ.get('WOO_HOST_BURST', '10'))
+    # Số lần thử lại GET khi gặp 429/5xx/lỗi mạng, backoff lũy thừa có jitter
+    WOO_MAX_RETRIES = int(os.environ.get('WOO_MAX_RETRIES', '2'))
+    WOO_RETRY_BASE_SECONDS = float(os.environ.get('WOO_RETRY_BASE_SECONDS', '1'))
+    WOO_RETRY_MAX_SECONDS = float(os.environ.get('WOO_RETRY_MAX_SECONDS', '120'))
+    # Circuit breaker: số lượt đồng bộ lỗi liên tiếp trước khi tạm dừng cửa hàng, và chu kỳ thăm dò (tăng gấp đôi tới mức tối đa)
+    BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+    BREAKER_PROBE_MINUTES = int(os.environ.get('BREAKER_PROBE_MINUTES', '15'))
+    BREAKER_MAX_PROBE_MINUTES = int(os.environ.get('BREAKER_MAX_PROBE_MINUTES', '360'))
+
+    # --- Số liệu Prometheus (app/metrics.py) ---
+    # /metrics yêu cầu header `Authorization: Bearer <METRICS_TOKEN>`; không đặt thì /metrics bị tắt
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Cổng endpoint số liệu riêng của `flask run-worker` khi không dùng chung PROMETHEUS_MULTIPROC_DIR với web
+    METRICS_WORKER_PORT = int(os.environ['METRICS_WORKER_PORT']) if os.environ.get('METRICS_WORKER_PORT') else None
+    # Địa chỉ mà endpoint số liệu của worker lắng nghe (không có xác thực): mặc định chỉ localhost
+    METRICS_WORKER_BIND = os.environ.get('METRICS_WORKER_BIND', '127.0.0.1')
+
+    # Thời gian (giờ) một bản ghi trong bảng product_cache được coi là còn mới
+    PRODUCT_CACHE_TTL_HOURS = int(os.environ.get('PRODUCT_CACHE_TTL_HOURS', '24'))
+
+    # --- Danh sách đơn hàng/cửa hàng (phân trang theo khóa, app/services/pagination.py) ---
+    # Đếm tổng tối đa chừng này dòng; nhiều hơn thì hiển thị "N+" thay vì COUNT(*) toàn bộ
+    LIST_COUNT_CAP = int(os.environ.get('LIST_COUNT_CAP', '10000'))
+    # Số câu SQL tối đa của một lần tải trang danh sách đơn hàng: vượt thì metrics.query_budget ghi cảnh báo,
+    # và tests/test_orders_query_budget.py thất bại (lỗi N+1)
+    ORDERS_PAGE_QUERY_BUDGET = int(os.environ.get('ORDERS_PAGE_QUERY_BUDGET', '15'))
+    # > 0: giữ danh sách id người dùng mà một admin được xem (chính admin và user con) trong chừng này giây,
+    # thay cho subquery trên app_user.parent_id trong mỗi truy vấn; 0 = luôn dùng subquery
+    VISIBILITY_CACHE_SECONDS = int(os.environ.get('VISIBILITY_CACHE_SECONDS', '0'))
 
 
     # --- MODIFIED: Added default Telegram message templates ---
@@ -45,6 +168,12 @@ Thanh toán: `{{ payment_method }}`
 {{ product_list }}
 """
     
+    # Template gộp nhiều đơn hàng mới (chế độ digest); tin quá dài được tự tách thành nhiều phần
+    DEFAULT_TELEGRAM_TEMPLATE_NEW_ORDER_DIGEST = """🛍️ Cửa hàng *{{ store_name }}* có *{{ order_count }}* đơn hàng mới\\!{% if chunk_count > 1 %} \\(phần {{ chunk_index }}/{{ chunk_count }}\\){% endif %}
+--------------------------------------
+{% for order in orders %}`#{{ order.order_id }}` {{ order.customer_name }} \\- *{{ order.total_amount }} {{ order.currency }}* `{{ order.status }}`
+{% endfor %}"""
+
     # Template cho tin nhắn thử nghiệm của hệ thống
     DEFAULT_TELEGRAM_TEMPLATE_SYSTEM_TEST = """🎉 Đây là tin nhắn thử từ *Hệ thống* của bạn\\. Cấu hình Telegram đã hoạt động chính xác\\!"""
     
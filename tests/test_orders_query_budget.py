@@ -0,0 +1,102 @@
+# tests/test_orders_query_budget.py
+#
+# Chạy: TEST_DATABASE_URL=postgresql://.../woo_test python -m pytest -q tests
+# Cần một database Postgres RIÊNG cho test (bảng được tạo rồi xóa hết sau khi chạy) và quyền CREATE EXTENSION pg_trgm.
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import event, text
+
+from app import create_app, db
+from app.models import AppUser, OrderLineItem, Setting, WooCommerceOrder, WooCommerceStore
+from config import Config
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="Cần TEST_DATABASE_URL trỏ tới một database Postgres dùng cho test")
+
+ORDER_COUNT = 12
+ITEMS_PER_ORDER = 3
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = TEST_DATABASE_URL
+    WTF_CSRF_ENABLED = False
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        db.session.commit()
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture(scope='module')
+def super_admin(app):
+    user = AppUser(username='admin', role='super_admin', is_active=True, can_view_orders=True)
+    user.set_password('secret')
+    db.session.add(user)
+    db.session.flush()
+
+    store = WooCommerceStore(
+        name='Shop test', store_url='https://shop.example.com', consumer_key='ck', consumer_secret='cs', user_id=user.id
+    )
+    db.session.add(store)
+    db.session.flush()
+
+    now = datetime.now(timezone.utc)
+    for index in range(ORDER_COUNT):
+        order = WooCommerceOrder(
+            wc_order_id=1000 + index, store_id=store.id, status='processing', currency='USD', total=10.0 + index,
+            customer_name=f'Khách {index}', order_created_at=now - timedelta(minutes=index)
+        )
+        db.session.add(order)
+        for item_index in range(ITEMS_PER_ORDER):
+            db.session.add(OrderLineItem(
+                order=order, wc_line_item_id=index * 10 + item_index, product_name=f'Sản phẩm {index}-{item_index}',
+                sku=f'SKU-{index}-{item_index}', quantity=1, price=5.0
+            ))
+
+    Setting.set_values({'ORDER_TABLE_COLUMNS': json.dumps([
+        {"key": "wc_order_id", "label": "Mã đơn", "visible": True, "type": "text"},
+        {"key": "products", "label": "Sản phẩm", "visible": True, "type": "text"},
+        {"key": "total", "label": "Tổng", "visible": True, "type": "currency"},
+    ])})
+    return user
+
+
+def test_orders_page_stays_within_query_budget(app, super_admin):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(super_admin.id)
+        session['_fresh'] = True
+
+    statements = []
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_query)
+    try:
+        response = client.get('/orders/')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_query)
+
+    assert response.status_code == 200
+    html = response.get_data(as_text=True)
+    # Line item của nhiều đơn phải thực sự được render (không phải trang rỗng)
+    for index in range(ORDER_COUNT):
+        for item_index in range(ITEMS_PER_ORDER):
+            assert f'Sản phẩm {index}-{item_index}' in html
+
+    budget = app.config['ORDERS_PAGE_QUERY_BUDGET']
+    assert len(statements) <= budget, f"/orders/ chạy {len(statements)} câu SQL (ngân sách {budget}):\n" + "\n---\n".join(statements)